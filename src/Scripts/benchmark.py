@@ -0,0 +1,374 @@
+﻿"""
+    Benchmarks for the FARSITE-STSim Python scripts. These are run by hand against a real library, and aren't part of
+    the SyncroSim run.
+
+    Usage:
+        python benchmark.py lookups <library.ssim> <syncrosim_dir> <project_id> <scenario_id> <iteration> <timestep>
+            <fuel_model_sa_name> [<canopy_cover_sa_name>]
+        python benchmark.py rasters [<size> ...]
+        python benchmark.py lcp [<size> ...]
+        python benchmark.py tsm [<size> ...]
+        python benchmark.py outputs [<size> ...]
+"""
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import config as cc
+from syncrosim import SynrosimDB, SynrosimSQLiteDB
+
+
+def timeCall(func, repeat = 5):
+    '''
+        Time the specified function call.
+
+        :param func: The function to time. Called with no arguments.
+        :param repeat: The number of times to call the function.
+        :return: The best (minimum) time of a single call, in seconds.
+    '''
+    best = None
+    for i in range(repeat):
+        start = timeit.default_timer()
+        func()
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def benchmarkLookups(library, syncrosim_dir, project_id, scenario_id, iteration, timestep, sa_names, repeat = 5):
+    '''
+        Compare the latency of the datasheet lookups made on each Farsite timestep between the SyncroSim.Console
+        backend (uncached) and the direct SQLite backend.
+    '''
+
+    backends = [('SyncroSim.Console', SynrosimDB(library, syncrosim_dir)),
+                ('SQLite', SynrosimSQLiteDB(library))]
+
+    print 'Lookup latency per call (ms), best of {0}'.format(repeat)
+    print '{0:<40} {1:>20} {2:>12}'.format('Lookup', backends[0][0], backends[1][0])
+
+    totals = [0.0, 0.0]
+    for sa_name in sa_names:
+        lookups = [('getStateAttributeId({0})'.format(sa_name),
+                    lambda db: db.getDataSheetVal(project_id, 'STSim_StateAttributeType', 'Name', sa_name, 'StateAttributeTypeID')),
+                   ('getOutputSpatialRaster({0})'.format(sa_name),
+                    lambda db: db.getOutputSpatialRaster(scenario_id, cc.DATASHEET_OUTPUT_SPATIAL_STATE_ATTR, iteration,
+                                                         timestep, sa_name, 'StateAttributeTypeID'))]
+
+        for name, lookup in lookups:
+            times = [timeCall(lambda: lookup(db), repeat) for _, db in backends]
+            totals = [total + t for total, t in zip(totals, times)]
+            print '{0:<40} {1:>20.3f} {2:>12.3f}'.format(name, times[0] * 1000.0, times[1] * 1000.0)
+
+    print '{0:<40} {1:>20.3f} {2:>12.3f}'.format('Total per timestep', totals[0] * 1000.0, totals[1] * 1000.0)
+
+
+# Raster sizes ( rows = cols) used by the raster benchmarks if none are specified
+DEFAULT_RASTER_SIZES = [256, 1024, 4096]
+
+
+def createTestStratumRaster(filename, size, no_data_fraction = 0.2):
+    '''
+        Create a square Byte stratum raster, with a NoData value of 0 and a border of NoData cells, for benchmarking.
+    '''
+    import numpy as np
+    import gdal
+    from osgeo import osr
+    from gdalconst import GDT_Byte
+
+    x = np.random.randint(1, 10, (size, size)).astype(np.uint8)
+    border = int(size * no_data_fraction / 4)
+    if border:
+        x[:border, :] = 0
+        x[:, :border] = 0
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(26912)
+
+    raster = gdal.GetDriverByName('GTiff').Create(filename, size, size, 1, GDT_Byte)
+    raster.SetGeoTransform((400000.0, 30.0, 0, 3600000.0, 0, -30.0))
+    raster.SetProjection(srs.ExportToWkt())
+    band = raster.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    band.WriteArray(x)
+    raster = None
+
+
+def legacyCall(cmdLine):
+    '''
+        Run the command line the way the scripts used to, before the conversions were done in-process.
+    '''
+    if subprocess.call(cmdLine) <> 0:
+        raise RuntimeError('Error calling "{0}"'.format(cmdLine))
+
+
+def benchmarkRasters(sizes, repeat = 3):
+    '''
+        Compare the latency of the raster conversions done thru the GDAL command line tools against the in-process
+        GDAL versions, at several raster sizes.
+    '''
+    from farsiteUtils import convertToAAIGrid, convertToInt32, generateIgnitionPoints, removeRasterFile
+    from rasterCache import StratumTemplate
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print 'Raster conversion latency per call (ms), best of {0}'.format(repeat)
+        print '{0:<28} {1:>8} {2:>14} {3:>14}'.format('Function', 'Size', 'Subprocess', 'In-process')
+
+        for size in sizes:
+            src = os.path.join(tmp_dir, 'stratum{0}.tif'.format(size))
+            createTestStratumRaster(src, size)
+            dest = os.path.join(tmp_dir, 'dest.tif')
+            shp = os.path.join(tmp_dir, 'ignition.shp')
+            boundary = os.path.join(tmp_dir, 'boundary.shp')
+            stratum_template = StratumTemplate(src, os.path.join(tmp_dir, 'template{0}'.format(size)))
+
+            def legacyAAIGrid():
+                legacyCall('gdal_translate -of "AAIGrid" "{0}" "{1}"'.format(src, src.replace('.tif', '.asc')))
+                removeRasterFile(src.replace('.tif', '.asc'))
+
+            def newAAIGrid():
+                removeRasterFile(convertToAAIGrid(src))
+
+            def legacyPolygonize():
+                # What generateIgnitionPoints used to do, before placing the points
+                for ext in ['.shp', '.shx', '.dbf', '.prj']:
+                    if os.path.exists(boundary.replace('.shp', ext)):
+                        os.remove(boundary.replace('.shp', ext))
+                legacyCall('gdal_translate -ot "Int32" "{0}" "{1}"'.format(src, dest))
+                legacyCall('gdal_polygonize.bat "{0}" "{1}" -f "ESRI Shapefile"'.format(dest, boundary))
+
+            benchmarks = [('convertToAAIGrid', legacyAAIGrid, newAAIGrid),
+                          ('convertToInt32',
+                           lambda: legacyCall('gdal_translate -ot "Int32" "{0}" "{1}"'.format(src, dest)),
+                           lambda: convertToInt32(src, dest)),
+                          ('generateIgnitionPoints', legacyPolygonize,
+                           lambda: generateIgnitionPoints(stratum_template, shp, 1))]
+
+            for name, legacy, new in benchmarks:
+                legacy_time = timeCall(legacy, repeat)
+                new_time = timeCall(new, repeat)
+                print '{0:<28} {1:>8} {2:>14.1f} {3:>14.1f}'.format(name, size, legacy_time * 1000.0, new_time * 1000.0)
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def benchmarkLCP(sizes, latitude = 45, repeat = 3):
+    '''
+        Compare lcpmake.exe against the native LCP writer, at several raster sizes. As well as timing them, this checks
+        the LCP files are the same, reporting any header fields or cell values that differ.
+    '''
+    import numpy as np
+    from farsiteUtils import lcpMakeExe, lcpMake
+    from lcpWriter import LCP_HEADER_SIZE, unpackHeader
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print 'LCP latency per call (ms), best of {0}'.format(repeat)
+        print '{0:>8} {1:>14} {2:>14} {3:>10}'.format('Size', 'lcpmake.exe', 'Native', 'Same')
+
+        for size in sizes:
+            themes = []
+            for theme in ['elevation', 'slope', 'aspect', 'fuel', 'canopy']:
+                filename = os.path.join(tmp_dir, '{0}{1}.tif'.format(theme, size))
+                createTestStratumRaster(filename, size)
+                themes.append(filename)
+
+            exe_landscape = os.path.join(tmp_dir, 'exe{0}'.format(size))
+            native_landscape = os.path.join(tmp_dir, 'native{0}'.format(size))
+            exe_time = timeCall(lambda: lcpMakeExe(exe_landscape, *(themes + [latitude])), repeat)
+            native_time = timeCall(lambda: lcpMake(native_landscape, *(themes + [latitude])), repeat)
+
+            with open(exe_landscape + '.lcp', 'rb') as f:
+                exe_data = f.read()
+            with open(native_landscape + '.lcp', 'rb') as f:
+                native_data = f.read()
+
+            same = exe_data == native_data
+            print '{0:>8} {1:>14.1f} {2:>14.1f} {3:>10}'.format(size, exe_time * 1000.0, native_time * 1000.0, same)
+            if same:
+                continue
+
+            # The theme filenames in the header will differ, as lcpmake.exe is given the ASCII grids
+            exe_header = unpackHeader(exe_data)
+            native_header = unpackHeader(native_data)
+            for i, (exe_val, native_val) in enumerate(zip(exe_header, native_header)):
+                if exe_val <> native_val:
+                    print '    Header field {0}: {1!r} <> {2!r}'.format(i, exe_val, native_val)
+
+            exe_cells = np.frombuffer(exe_data[LCP_HEADER_SIZE:], dtype='<i2')
+            native_cells = np.frombuffer(native_data[LCP_HEADER_SIZE:], dtype='<i2')
+            if exe_cells.shape <> native_cells.shape:
+                print '    Cell data sizes differ: {0} <> {1}'.format(exe_cells.size, native_cells.size)
+            else:
+                print '    {0} cell values differ'.format(np.count_nonzero(exe_cells <> native_cells))
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+# The TSM GeoTIFF settings compared by benchmarkTsm, as (name, creation options, overview levels)
+TSM_BENCHMARK_SETTINGS = [
+    ('Striped, uncompressed', [], []),
+    ('Tiled, uncompressed', ['TILED=YES'], []),
+    ('Tiled, LZW', ['TILED=YES', 'COMPRESS=LZW'], []),
+    ('Tiled, LZW, predictor', ['TILED=YES', 'COMPRESS=LZW', 'PREDICTOR=2'], []),
+    ('Tiled, DEFLATE, predictor', ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=2'], []),
+    ('Tiled 512, DEFLATE, predictor', ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=DEFLATE', 'PREDICTOR=2'], []),
+    ('Tiled, ZSTD, predictor', ['TILED=YES', 'COMPRESS=ZSTD', 'PREDICTOR=2'], []),
+    ('Tiled, DEFLATE, overviews', ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=2'], [2, 4, 8]),
+]
+
+
+def benchmarkTsm(sizes, burned_fraction = 0.05, repeat = 3):
+    '''
+        Compare the TSM GeoTIFF creation settings, at several raster sizes. For each, this reports the time to write a
+        TSM, the time to read it back in full ( a proxy for the SyncroSim import), and its size on disk.
+    '''
+    import numpy as np
+    import gdal
+    from rasterCache import StratumTemplate, createTsmCopy, DEFAULT_TSM_CREATION_OPTIONS, DEFAULT_TSM_OVERVIEW_LEVELS
+
+    gdal.UseExceptions()
+    compressions = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+    settings = TSM_BENCHMARK_SETTINGS + [('Default', DEFAULT_TSM_CREATION_OPTIONS, DEFAULT_TSM_OVERVIEW_LEVELS)]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print 'TSM write and read latency per call (ms), best of {0}, and size on disk (KB)'.format(repeat)
+        print '{0:<32} {1:>8} {2:>10} {3:>10} {4:>10}'.format('Setting', 'Size', 'Write', 'Read', 'Disk')
+
+        for size in sizes:
+            src = os.path.join(tmp_dir, 'stratum{0}.tif'.format(size))
+            createTestStratumRaster(src, size)
+            stratum_template = StratumTemplate(src, os.path.join(tmp_dir, 'template{0}'.format(size)))
+
+            # A typical fire TSM is mostly zero, with a compact burned patch
+            x = stratum_template.makeArray(0)
+            radius = int(size * np.sqrt(burned_fraction / np.pi))
+            rows, cols = np.ogrid[:size, :size]
+            x[((rows - size / 2) ** 2 + (cols - size / 2) ** 2 <= radius ** 2) & (x == 0)] = 1
+
+            tsm_raster = stratum_template.makeRaster(0)
+            tsm_raster.GetRasterBand(1).WriteArray(x)
+
+            for name, creation_options, overview_levels in settings:
+                compress = [option.split('=')[1] for option in creation_options if option.startswith('COMPRESS=')]
+                if compress and compress[0] not in compressions:
+                    print '{0:<32} {1:>8} {2:>10}'.format(name, size, 'Unsupported by this GDAL')
+                    continue
+
+                dest = os.path.join(tmp_dir, 'tsm.tif')
+
+                def write():
+                    if os.path.exists(dest):
+                        os.remove(dest)
+                    dest_raster = createTsmCopy(dest, tsm_raster, creation_options, overview_levels)
+                    dest_raster = None
+
+                def read():
+                    raster = gdal.Open(dest, gdal.GA_ReadOnly)
+                    raster.GetRasterBand(1).ReadAsArray()
+                    raster = None
+
+                write_time = timeCall(write, repeat)
+                read_time = timeCall(read, repeat)
+                disk = os.path.getsize(dest) / 1024.0
+                print '{0:<32} {1:>8} {2:>10.1f} {3:>10.1f} {4:>10.1f}'.format(name, size, write_time * 1000.0,
+                                                                          read_time * 1000.0, disk)
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+# Raster sizes ( rows = cols) used by benchmarkOutputs if none are specified
+DEFAULT_OUTPUT_SIZES = [1000, 4000, 10000]
+
+
+def writeTestFarsiteGrid(prefix, x):
+    '''
+        Write the intensity grid the way Farsite does, as an ASCII grid.
+
+        :return: The time taken to write the grid, in seconds
+    '''
+    import numpy as np
+    from fireResult import FARSITE_ASCII_GRID_EXTENSION
+
+    rows, cols = x.shape
+
+    start = timeit.default_timer()
+    with open(prefix + '_Intensity' + FARSITE_ASCII_GRID_EXTENSION, 'w') as f:
+        f.write('ncols {0}\nnrows {1}\nxllcorner 400000.0\nyllcorner {2}\ncellsize 30.0\nNODATA_value -9999\n'.format(
+            cols, rows, 3600000.0 - rows * 30.0))
+        np.savetxt(f, x, fmt='%.3f')
+    return timeit.default_timer() - start
+
+
+def benchmarkOutputs(sizes, burned_fraction = 0.05, repeat = 1):
+    '''
+        Time writing and then reading the Farsite Fire Intensity ASCII grid, at several raster sizes. The writes are done
+        the way Farsite would, as Farsite itself can't be run here.
+    '''
+    import numpy as np
+    from rasterCache import StratumTemplate
+    from fireResult import readFireIntensity, FARSITE_ASCII_GRID_EXTENSION
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print 'Fire Intensity grid latency (ms), best of {0} reads'.format(repeat)
+        print '{0:>8} {1:>12} {2:>12} {3:>10}'.format('Size', 'Write', 'Read', 'MB')
+
+        for size in sizes:
+            src = os.path.join(tmp_dir, 'stratum{0}.tif'.format(size))
+            createTestStratumRaster(src, size)
+            stratum_template = StratumTemplate(src, os.path.join(tmp_dir, 'template{0}'.format(size)))
+
+            x = np.zeros((size, size), dtype=np.float32)
+            burned = int(size * np.sqrt(burned_fraction))
+            x[:burned, :burned] = np.random.uniform(0, 500, (burned, burned))
+
+            prefix = os.path.join(tmp_dir, 'FARSITE{0}'.format(size))
+            write_time = writeTestFarsiteGrid(prefix, x)
+            x = None
+
+            filename = prefix + '_Intensity' + FARSITE_ASCII_GRID_EXTENSION
+            read_time = timeCall(lambda: readFireIntensity(stratum_template, filename), repeat)
+
+            print '{0:>8} {1:>12.1f} {2:>12.1f} {3:>10.1f}'.format(
+                size, write_time * 1000.0, read_time * 1000.0, os.path.getsize(filename) / 1048576.0)
+
+            os.remove(filename)
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+
+    if sys.argv[1] == 'lookups' and len(sys.argv) >= 9:
+        benchmarkLookups(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]), int(sys.argv[6]), int(sys.argv[7]),
+                         sys.argv[8:])
+    elif sys.argv[1] == 'rasters':
+        benchmarkRasters([int(size) for size in sys.argv[2:]] or DEFAULT_RASTER_SIZES)
+    elif sys.argv[1] == 'lcp':
+        benchmarkLCP([int(size) for size in sys.argv[2:]] or DEFAULT_RASTER_SIZES)
+    elif sys.argv[1] == 'tsm':
+        benchmarkTsm([int(size) for size in sys.argv[2:]] or DEFAULT_RASTER_SIZES)
+    elif sys.argv[1] == 'outputs':
+        benchmarkOutputs([int(size) for size in sys.argv[2:]] or DEFAULT_OUTPUT_SIZES)
+    else:
+        print __doc__
+        sys.exit(1)
@@ -1,14 +1,63 @@
 ﻿import os
 import sys
 import logging
+import json
+import cPickle
 
-from syncrosim import SynrosimDB
+from syncrosim import SynrosimDB, SCOPE_PROJECT, SCOPE_SCENARIO, findDataSheetVal, writeJsonFile, replaceFile
 
 DATASHEET_FARSITE_OPTIONS_NAME = 'Farsite_Options'
 DATASHEET_RUN_CONTROL_NAME = 'STSim_RunControl'
 DATASHEET_OUTPUT_OPTIONS_NAME = 'STSim_OutputOptions'
 DATASHEET_SSIM_PROCESSING = 'SSim_Processing'
 DATASHEET_OUTPUT_SPATIAL_STATE_ATTR = 'STSim_OutputSpatialStateAttribute'
+DATASHEET_INITIAL_CONDITIONS_SPATIAL = 'STSim_InitialConditionsSpatial'
+DATASHEET_STATE_ATTRIBUTE_TYPE = 'STSim_StateAttributeType'
+DATASHEET_TRANSITION_GROUP = 'STSim_TransitionGroup'
+DATASHEET_TRANSITION_MULTIPLIER_TYPE = 'STSim_TransitionMultiplierType'
+DATASHEET_FARSITE_WEATHER_NAME = 'Farsite_Weather'
+DATASHEET_FARSITE_WIND_NAME = 'Farsite_Wind'
+
+# Subdirectory of SSIM_TEMP_DIRECTORY used to cache datasheet exports
+DATASHEET_CACHE_DIR_NAME = 'DatasheetCache'
+
+# Directory, alongside the Scenario temp directories, used to cache the converted terrain rasters for all the library's
+# scenarios. See rasterCache.TerrainCache
+TERRAIN_CACHE_DIR_NAME = 'FarsiteTerrainCache'
+
+# Subdirectory of the Scenario output directory for the Farsite files
+FARSITE_OUTPUT_DIR_NAME = 'STSim_OutputSpatialFarsite'
+
+# Subdirectory of the Scenario output directory used to keep the Primary Stratum template. See rasterCache.StratumTemplate
+STRATUM_TEMPLATE_DIR_NAME = 'FarsiteStratumTemplate'
+
+# The Run Descriptor holds just enough about the run to handle off-frequency timesteps without building a Config.
+# See getFastTimestepAction
+RUN_DESCRIPTOR_FILENAME = 'FarsiteRunDescriptor.json'
+RUN_DESCRIPTOR_VERSION = 1
+
+# The Config Snapshot holds everything loaded by Config, other than the iteration and timestep, so that it only has to
+# be loaded and validated on the first timestep of the run. Bump the version whenever Config's attributes change.
+CONFIG_SNAPSHOT_FILENAME = 'FarsiteConfig.pickle'
+CONFIG_SNAPSHOT_VERSION = 3
+
+# Name of the scenario's weather and wind streams, in SSIM_TEMP_DIRECTORY. See weatherStream
+WEATHER_STREAMS_FILENAME = 'FarsiteWeatherStreams.npz'
+
+# Config Snapshots already loaded by this process, by filename, along with the ( size, mtime) of the file they were
+# loaded from. This only helps a long lived process, ie farsiteWorker, which handles many timesteps
+_snapshots = {}
+
+# What to do for a timestep
+TIMESTEP_ACTION_RUN = 'Run'
+TIMESTEP_ACTION_ZERO = 'Zero'
+TIMESTEP_ACTION_SKIP = 'Skip'
+
+# Cache of the raster headers, in SSIM_TEMP_DIRECTORY. See rasterCache.RasterHeaderCache
+RASTER_HEADER_CACHE_FILENAME = 'FarsiteRasterHeaders.json'
+
+# The Zero Value raster used as the TSM for timesteps without fire
+ZERO_VALUE_RASTER_FILENAME = 'zeroValue.tif'
 
 # Farsite Options
 OPTION_ENABLED = 'Enabled'
@@ -23,6 +72,8 @@ OPTION_SLOPE_RASTER_FILE="SlopeRasterFile"
 OPTION_ASPECT_RASTER_FILE="AspectRasterFile"
 OPTION_NUM_IGNITIONS_PER_TIMESTEP="NumIgnitionsPerTimestep"
 OPTION_DISTRIBUTION_FOR_NUM_IGNITIONS="DistForNumIgnitions"
+# Optional, as libraries created before it was added won't have it
+OPTION_IGNITION_PROBABILITY_RASTER_FILE="IgnitionProbabilityRasterFile"
 OPTION_FIRE_SEASON_START_JULIAN_DAY="FireSeasonStartJulianDay"
 OPTION_FIRE_SEASON_END_JULIAN_DAY="FireSeasonEndJulianDay"
 OPTION_MEAN_FIRE_DURATION_HOURS="MeanFireDurationHours"
@@ -95,9 +146,19 @@ class Config:
 
         # Lets load up the various runtime parameters needed to run
 
-        self.db = SynrosimDB(self.library,self.base_dir)
+        # Cache the datasheet exports in the (Result) Scenario's temp dir, so that most lookups on subsequent timesteps
+        # don't need to go thru SyncroSim.Console. ID and output raster lookups are read directly from the library.
+        self.db = SynrosimDB(self.library,self.base_dir, os.path.join(self.temp_dir, DATASHEET_CACHE_DIR_NAME), self.scenarioId,
+                             direct_read=True)
+
+        # Everything else is constant for the run, so if an earlier timestep has already loaded and validated it, use that
+        if self.__loadSnapshot():
+            return
+
+        # Fetch everything we need in one go, rather than a datasheet at a time
+        context = self.getContext()
 
-        dsFarsiteOptions = self.db.getScenarioDataSheet(DATASHEET_FARSITE_OPTIONS_NAME, self.scenarioId)
+        dsFarsiteOptions = context[DATASHEET_FARSITE_OPTIONS_NAME]
         if dsFarsiteOptions == None:
             # If none returned, then most like no scenario ( or lib...)
             logging.error('Scenario {0} not found.'.format(self.scenarioId))
@@ -141,19 +202,19 @@ class Config:
 
         self.frequency = int(options[OPTION_FREQUENCY])
         self.sa_fuel_model_name = options[OPTION_STATE_ATTR_FUEL_MODEL]
-        self.sa_fuel_model_id = int(self.db.getStateAttributeId(self.projectId, self.sa_fuel_model_name))
+        self.sa_fuel_model_id = int(findDataSheetVal(context[DATASHEET_STATE_ATTRIBUTE_TYPE], 'Name', self.sa_fuel_model_name, 'StateAttributeTypeID'))
 
         self.sa_canopy_cover_name = options[OPTION_STATE_ATTR_CANOPY_COVER]
         if self.sa_canopy_cover_name:
-            self.sa_canopy_cover_id = int(self.db.getStateAttributeId(self.projectId, self.sa_canopy_cover_name))
+            self.sa_canopy_cover_id = int(findDataSheetVal(context[DATASHEET_STATE_ATTRIBUTE_TYPE], 'Name', self.sa_canopy_cover_name, 'StateAttributeTypeID'))
         else:
             self.sa_canopy_cover_id = None
 
         self.transition_group_name = options[OPTION_TRANSITION_GROUP]
-        self.transition_group_id = int(self.db.getTransitionGroupId(self.projectId, self.transition_group_name))
+        self.transition_group_id = int(findDataSheetVal(context[DATASHEET_TRANSITION_GROUP], 'Name', self.transition_group_name, 'TransitionGroupID'))
 
         self.transition_multiplier_type_name = options[OPTION_TRANSITION_MULTIPLIER_TYPE]
-        self.transition_multiper_type_id = int(self.db.getTransitionMultiplierTypeId(self.projectId, self.transition_multiplier_type_name))
+        self.transition_multiper_type_id = int(findDataSheetVal(context[DATASHEET_TRANSITION_MULTIPLIER_TYPE], 'Name', self.transition_multiplier_type_name, 'TransitionMultiplierTypeID'))
 
         inputFSOPath = self.getScenarioDatasheetInputPath(DATASHEET_FARSITE_OPTIONS_NAME)
         self.elevation_raster_file =  os.path.join(inputFSOPath,options[OPTION_ELEVATION_RASTER_FILE])
@@ -162,6 +223,10 @@ class Config:
         self.aspect_raster_file = os.path.join(inputFSOPath,options[OPTION_ASPECT_RASTER_FILE])
         self.num_ignitions_per_timestep = int(options[OPTION_NUM_IGNITIONS_PER_TIMESTEP])
         self.dist_for_num_ignitions= options[OPTION_DISTRIBUTION_FOR_NUM_IGNITIONS]
+        if options.get(OPTION_IGNITION_PROBABILITY_RASTER_FILE):
+            self.ignition_probability_raster_file = os.path.join(inputFSOPath, options[OPTION_IGNITION_PROBABILITY_RASTER_FILE])
+        else:
+            self.ignition_probability_raster_file = None
         self.fire_season_start_julian_day = int(options[OPTION_FIRE_SEASON_START_JULIAN_DAY])
         self.fire_season_end_julian_day = int(options[OPTION_FIRE_SEASON_END_JULIAN_DAY])
         self.mean_fire_duration_hours = float(options[OPTION_MEAN_FIRE_DURATION_HOURS])
@@ -191,7 +256,7 @@ class Config:
 
         # Do some QA
         # Check to see if this is a spatial run
-        dsRunControl = self.db.getScenarioDataSheet(DATASHEET_RUN_CONTROL_NAME, self.scenarioId)
+        dsRunControl = context[DATASHEET_RUN_CONTROL_NAME]
         run_control = dsRunControl[0]
         if run_control['IsSpatial']<>'Yes':
             logging.warning("The current scenario has not been selected to Run model Spatially")
@@ -202,7 +267,7 @@ class Config:
         self.maximum_timestep = int(run_control['MaximumTimestep'])
 
         # Check to see if State Attribute Output is enabled
-        dsOutputOptions= self.db.getScenarioDataSheet(DATASHEET_OUTPUT_OPTIONS_NAME, self.scenarioId)
+        dsOutputOptions= context[DATASHEET_OUTPUT_OPTIONS_NAME]
         if len(dsOutputOptions) == 0:
             logging.error("The Output Options have not been configured for this scenario.")
             sys.exit(1)
@@ -225,7 +290,7 @@ class Config:
 
         # Get the IC Primary Stratum file name. We will use this for our definitive Raster (row,cols, cell_size,
         # extent...)
-        dsICS = self.db.getScenarioDataSheet('STSim_InitialConditionsSpatial',self.scenarioId)
+        dsICS = context[DATASHEET_INITIAL_CONDITIONS_SPATIAL]
         if dsICS == None or len(dsICS) == 0:
             logging.error('Could not find Initial Conditions Spatial for Scenario {0}'.format(self.scenarioId))
             sys.exit(1)
@@ -246,13 +311,125 @@ class Config:
             logging.error('Could not the FARSITE Slope Raster file "{0}"'.format(self.slope_raster_file))
             sys.exit(1)
 
+        if self.ignition_probability_raster_file and not os.path.exists(self.ignition_probability_raster_file):
+            logging.error('Could not find the FARSITE Ignition Probability Raster file "{0}"'.format(
+                self.ignition_probability_raster_file))
+            sys.exit(1)
+
+        # Time-varying weather and wind, if any. Otherwise the constant Farsite Options values are used for every day
+        self.weather_streams_file = None
+        self.has_weather_stream = False
+        self.has_wind_stream = False
+        if context[DATASHEET_FARSITE_WEATHER_NAME] or context[DATASHEET_FARSITE_WIND_NAME]:
+            from weatherStream import saveWeatherStreams
+            self.weather_streams_file = os.path.join(self.temp_dir, WEATHER_STREAMS_FILENAME)
+            streams = saveWeatherStreams(self.weather_streams_file, context[DATASHEET_FARSITE_WEATHER_NAME],
+                                         context[DATASHEET_FARSITE_WIND_NAME])
+            self.has_weather_stream = 'weather' in streams
+            self.has_wind_stream = 'wind' in streams
+
 
         # TODO: Future - Should I test these files for NROW, NCOLS match to Primary Stratum ? YES
 
+        self.__saveSnapshot()
 
         return
 
 
+    def __getSnapshotFilename(self):
+        return os.path.join(self.temp_dir, CONFIG_SNAPSHOT_FILENAME)
+
+
+    def __loadSnapshot(self):
+        '''
+            Load the run constant configuration from the snapshot saved by an earlier timestep.
+
+            :return: True if the snapshot was loaded, False if there is no usable snapshot.
+        '''
+        filename = self.__getSnapshotFilename()
+        try:
+            stat = os.stat(filename)
+            signature = (stat.st_size, stat.st_mtime)
+            if filename in _snapshots and _snapshots[filename][0] == signature:
+                snapshot = _snapshots[filename][1]
+            else:
+                with open(filename, 'rb') as f:
+                    snapshot = cPickle.load(f)
+                _snapshots[filename] = (signature, snapshot)
+        except (OSError, IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            return False
+
+        if snapshot.get('version') <> CONFIG_SNAPSHOT_VERSION or snapshot.get('library') <> self.library or \
+                snapshot.get('scenario_id') <> self.scenarioId:
+            logging.debug('Ignoring Config snapshot from a different run or version.')
+            return False
+
+        self.__dict__.update(snapshot['attributes'])
+        logging.debug('Loaded Config snapshot "{0}"'.format(self.__getSnapshotFilename()))
+        return True
+
+
+    def __saveSnapshot(self):
+        '''
+            Save the run constant configuration, for subsequent timesteps to load.
+        '''
+        attributes = dict((name, val) for name, val in self.__dict__.items() if name not in ('db', 'iteration', 'timestep'))
+        snapshot = {'version': CONFIG_SNAPSHOT_VERSION,
+                    'library': self.library,
+                    'scenario_id': self.scenarioId,
+                    'attributes': attributes}
+
+        # Write to a temp file and then swap it in, as several SyncroSim jobs may be reading the snapshot. The snapshot
+        # is only a cache, so if it can't be saved, subsequent timesteps just rebuild the Config
+        filename = self.__getSnapshotFilename()
+        tmp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+        try:
+            with open(tmp_filename, 'wb') as f:
+                cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError) as ex:
+            logging.warning('Could not save the Config snapshot "{0}" ({1})'.format(filename, ex))
+            return
+
+        replaceFile(tmp_filename, filename)
+
+
+    def getContext(self):
+        '''
+            Fetch all the datasheets needed to configure the run, in a single batch.
+
+            :return: A dict of the datasheet rows ( None if the datasheet couldn't be exported) keyed by datasheet name
+        '''
+        requests = [(name, SCOPE_SCENARIO, self.scenarioId) for name in [DATASHEET_FARSITE_OPTIONS_NAME,
+                                                                         DATASHEET_RUN_CONTROL_NAME,
+                                                                         DATASHEET_OUTPUT_OPTIONS_NAME,
+                                                                         DATASHEET_INITIAL_CONDITIONS_SPATIAL,
+                                                                         DATASHEET_FARSITE_WEATHER_NAME,
+                                                                         DATASHEET_FARSITE_WIND_NAME]]
+        requests += [(name, SCOPE_PROJECT, self.projectId) for name in [DATASHEET_STATE_ATTRIBUTE_TYPE,
+                                                                        DATASHEET_TRANSITION_GROUP,
+                                                                        DATASHEET_TRANSITION_MULTIPLIER_TYPE]]
+
+        sheets = self.db.getDataSheets(requests)
+        return dict((request[0], rows) for request, rows in sheets.items())
+
+
+    def writeRunDescriptor(self):
+        '''
+            Save the run parameters needed by getFastTimestepAction to the Scenario temp directory.
+        '''
+        descriptor = {'version': RUN_DESCRIPTOR_VERSION,
+                      'library': self.library,
+                      'scenario_id': self.scenarioId,
+                      'minimum_timestep': self.minimum_timestep,
+                      'frequency': self.frequency,
+                      'farsite_output_dir': self.getFarsiteOutputPath(),
+                      'transition_group_name': self.transition_group_name,
+                      'transition_multiplier_type_name': self.transition_multiplier_type_name,
+                      'save_intermediate_files': self.save_intermediate_files}
+
+        writeJsonFile(os.path.join(self.temp_dir, RUN_DESCRIPTOR_FILENAME), descriptor)
+
+
     def isOutputTimestep(self,timestep):
         '''
         Determines whether or not the specified timestep is an Output timestep
@@ -279,7 +456,7 @@ class Config:
       return var
 
     def getScenarioInitConditionalSpatialInputPath(self):
-        return os.path.join(self.getScenarioInputPath(), "STSim_InitialConditionsSpatial")
+        return os.path.join(self.getScenarioInputPath(), DATASHEET_INITIAL_CONDITIONS_SPATIAL)
 
     def getScenarioInputPath(self):
         return os.path.join(self.input_dir,"Scenario-{0}".format(self.scenarioId))
@@ -287,6 +464,18 @@ class Config:
     def getScenarioOutputPath(self):
         return os.path.join(self.output_dir,"Scenario-{0}".format(self.scenarioId))
 
+    def getFarsiteOutputPath(self):
+        return os.path.join(self.getScenarioOutputPath(), FARSITE_OUTPUT_DIR_NAME)
+
+    def getStratumTemplatePath(self):
+        return os.path.join(self.getScenarioOutputPath(), STRATUM_TEMPLATE_DIR_NAME)
+
+    def getRasterHeaderCacheFilename(self):
+        return os.path.join(self.temp_dir, RASTER_HEADER_CACHE_FILENAME)
+
+    def getTerrainCachePath(self):
+        return os.path.join(os.path.dirname(os.path.normpath(self.temp_dir)), TERRAIN_CACHE_DIR_NAME)
+
     def getScenarioTempPath(self):
         """
             Get the Scenario Temporary Path
@@ -299,3 +488,45 @@ class Config:
     def getScenarioDatasheetInputPath(self, datasheet_name):
         return os.path.join(self.getScenarioInputPath(), datasheet_name)
 
+
+def getFastTimestepAction():
+    '''
+        Decide what to do with the current timestep, using only the environment and the Run Descriptor written by an
+        earlier timestep of the run. This lets off-frequency timesteps be handled without building a Config, which
+        needs SyncroSim.Console and GDAL.
+
+        :return: A tuple of (action, run descriptor). The action is TIMESTEP_ACTION_SKIP if there is nothing to do,
+            TIMESTEP_ACTION_ZERO if the existing Zero Value raster should be used as the TSM, or TIMESTEP_ACTION_RUN if
+            the timestep needs the full treatment ( including when we can't tell).
+    '''
+
+    try:
+        temp_dir = os.environ["SSIM_TEMP_DIRECTORY"]
+        timestep = int(os.environ["SSIM_STOCHASTIC_TIME_BEFORE_TIMESTEP"])
+        with open(os.path.join(temp_dir, RUN_DESCRIPTOR_FILENAME), 'r') as f:
+            descriptor = json.load(f)
+
+    except (KeyError, ValueError, IOError):
+        return TIMESTEP_ACTION_RUN, None
+
+    # Make sure the descriptor is for this run
+    if descriptor.get('version') <> RUN_DESCRIPTOR_VERSION or \
+            descriptor.get('library') <> os.environ.get("SSIM_LIBRARY_FILEPATH") or \
+            str(descriptor.get('scenario_id')) <> os.environ.get("SSIM_SCENARIO_ID"):
+        return TIMESTEP_ACTION_RUN, None
+
+    start_timestep = descriptor['minimum_timestep'] + 1
+    frequency = descriptor['frequency']
+
+    # Same test as Config.isOutputTimestep
+    if ((timestep - start_timestep) % frequency) == 0:
+        return TIMESTEP_ACTION_RUN, descriptor
+
+    if ((timestep - 1 - start_timestep) % frequency) == 0:
+        # We can only reuse the Zero Value raster if it's still there. If not, it needs GDAL to recreate it.
+        if os.path.exists(os.path.join(descriptor['farsite_output_dir'], ZERO_VALUE_RASTER_FILENAME)):
+            return TIMESTEP_ACTION_ZERO, descriptor
+
+        return TIMESTEP_ACTION_RUN, descriptor
+
+    return TIMESTEP_ACTION_SKIP, descriptor
@@ -0,0 +1,377 @@
+﻿import heapq
+import logging
+import multiprocessing
+import os
+import sys
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from farsiteUtils import createFarsiteBatchCommandFile, createIgnitionPtFile, callFarsite, getFarsiteCommandLine, \
+    getStratumSpatialReference, getFarsiteBudget, getFarsiteOverBudgetAction, OVER_BUDGET_ERROR, OVER_BUDGET_ZERO
+from fireResult import findFarsiteGrid, isFarsiteGridComplete
+
+# The most Farsite processes to run at once, from the FARSITE Environment. Either a whole number, or Auto for a process
+# per CPU. If it's not set, or 1, all the timestep's ignitions are run in a single Farsite process
+ENV_FARSITE_PARALLEL_RUNS = 'SSIM_FARSITE_PARALLEL_RUNS'
+
+# The number of Farsite runs batched into the command file of each Farsite process, from the FARSITE Environment. Each
+# run is a group of ignitions, so this splits the ignitions more finely, without paying to start more processes
+ENV_FARSITE_RUNS_PER_PROCESS = 'SSIM_FARSITE_RUNS_PER_PROCESS'
+
+# The fastest plausible fire spread rate, in map units per minute, from the FARSITE Environment. If it's set, each
+# cluster of ignitions is run on a landscape clipped to how far its fires could spread. See runFarsiteClipped
+ENV_FARSITE_CLIP_SPREAD_RATE = 'SSIM_FARSITE_CLIP_SPREAD_RATE'
+
+# Cells added around each clip window, so that a fire that spreads as far as it could still doesn't reach its edge
+CLIP_MARGIN_CELLS = 2
+
+
+def getFarsiteParallelRuns():
+    '''
+        Get the most Farsite processes to run at once, from the FARSITE Environment if it's been set there.
+    '''
+    return getEnvironmentCount(ENV_FARSITE_PARALLEL_RUNS, multiprocessing.cpu_count())
+
+
+def getFarsiteRunsPerProcess():
+    '''
+        Get the number of Farsite runs to batch into each Farsite process, from the FARSITE Environment if it's been
+        set there.
+    '''
+    return getEnvironmentCount(ENV_FARSITE_RUNS_PER_PROCESS, None)
+
+
+def getFarsiteClipSpreadRate():
+    '''
+        Get the fastest plausible fire spread rate, from the FARSITE Environment if it's been set there.
+
+        :return: The spread rate, in map units per minute, or None if the landscape isn't to be clipped
+    '''
+    value = os.environ.get(ENV_FARSITE_CLIP_SPREAD_RATE, '').strip()
+    if value == '':
+        return None
+
+    try:
+        spread_rate = float(value)
+    except ValueError:
+        spread_rate = 0
+
+    if spread_rate <= 0:
+        logging.error('The FARSITE Environment {0} must be a number greater than 0, not "{1}"'.format(
+            ENV_FARSITE_CLIP_SPREAD_RATE, value))
+        sys.exit(1)
+
+    return spread_rate
+
+
+def getEnvironmentCount(name, auto_value):
+    '''
+        Get a count from the FARSITE Environment
+
+        :param name: The name of the environment variable
+        :param auto_value: The count if it's set to Auto, or None if Auto isn't allowed
+        :return: The count, or 1 if it's not set
+    '''
+    value = os.environ.get(name, '').strip()
+    if value == '':
+        return 1
+
+    if value.upper() == 'AUTO' and auto_value is not None:
+        return auto_value
+
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+
+    if count < 1:
+        logging.error('The FARSITE Environment {0} must be a whole number greater than 0{1}, not "{2}"'.format(
+            name, '' if auto_value is None else ', or Auto', value))
+        sys.exit(1)
+
+    return count
+
+
+def groupIgnitions(ignition_cells, num_groups):
+    '''
+        Split the ignitions into groups of nearby ignitions. The ignitions are ordered by cell, so each group comes from
+        a band of rows of the landscape.
+
+        :param ignition_cells: The flat indexes of the ignition cells
+        :param num_groups: The number of groups. There are never more groups than ignitions
+        :return: A list of the indexes, into ignition_cells, of each group's ignitions
+    '''
+    order = np.argsort(ignition_cells, kind='mergesort')
+    return np.array_split(order, min(num_groups, len(order)))
+
+
+def runFarsiteParallel(stratum_template, lcp_filename, inputs_filename, ignition_cells, x, y, output_dir, file_prefix,
+                       parallel_runs, runs_per_process = 1):
+    '''
+        Run the timestep's ignitions split into groups ( see groupIgnitions), each in its own Farsite run. The runs are
+        batched into the command files of up to parallel_runs Farsite processes, run at the same time.
+
+        Every run shares the landscape and inputs files, so each fire burns the same as it would in a single Farsite
+        run, as long as it doesn't meet a fire from another group. The runs' intensity rasters are merged by
+        convertFireIntensityRaster.
+
+        DEVNOTE: The work is all done by the Farsite processes, so they're started and waited on from a pool of threads,
+        rather than a multiprocessing pool of python processes, which would each have to import numpy and GDAL.
+
+        :param ignition_cells: The flat indexes of the ignition cells. See farsiteUtils.sampleIgnitionPoints
+        :param x: The X coordinates of the ignition points
+        :param y: The Y coordinates of the ignition points
+        :param file_prefix: The prefix of the timestep's files. Each run's files are prefixed by this and its number
+        :param parallel_runs: The most Farsite processes to run at once
+        :param runs_per_process: The number of runs to batch into each process's command file
+        :return: A tuple of the list of the runs' Fire Intensity rasters, and whether the ignitions burned. See
+            collectFarsiteGrids
+    '''
+    srs = getStratumSpatialReference(stratum_template)
+
+    runs = []
+    for i, group in enumerate(groupIgnitions(ignition_cells, parallel_runs * runs_per_process)):
+        group_prefix = '{0}G{1:03d}-'.format(file_prefix, i)
+
+        ignition_filename = os.path.join(output_dir, group_prefix + 'ignitionPtsFile.shp')
+        createIgnitionPtFile(x[group], y[group], srs, ignition_filename)
+
+        runs.append((lcp_filename, inputs_filename, ignition_filename, output_dir, group_prefix + 'FARSITE'))
+
+    logging.info('Running {0} Farsite runs for {1} ignitions...'.format(len(runs), len(ignition_cells)))
+    return runFarsiteRuns(runs, output_dir, file_prefix, parallel_runs)
+
+
+def runFarsiteClipped(stratum_template, make_lcp, inputs_filename, ignition_cells, x, y, fire_duration_mins,
+                      spread_rate, output_dir, file_prefix, parallel_runs):
+    '''
+        Run the timestep's ignitions on landscapes clipped to how far their fires could spread, rather than on the
+        full extent of the Primary Stratum.
+
+        A fire can't spread further than the fastest plausible spread rate for the fire duration, so each ignition only
+        needs the window of the landscape within that distance. Ignitions whose windows overlap are clustered ( see
+        clusterIgnitions), as their fires might meet, and each cluster gets its own landscape, clipped to its window,
+        and its own Farsite run. The runs are batched into up to parallel_runs Farsite processes, as for
+        runFarsiteParallel, and each run's intensity raster is merged back into the full extent by
+        convertFireIntensityRaster.
+
+        As the clusters' fires can't meet, each burns the same as it would in a single Farsite run on the full
+        landscape, as long as it keeps within the spread rate. A fire that reaches the edge of its window is warned of.
+
+        :param make_lcp: Called with the landscape name ( without extension) and the ( row, col, rows, cols) window to
+            make the clipped landscape. See farsiteUtils.lcpMake
+        :param fire_duration_mins: The duration of the fires. See farsiteUtils.makeFarsiteInputFile
+        :param spread_rate: The fastest plausible spread rate, in map units per minute. See getFarsiteClipSpreadRate
+        :return: A tuple of the list of the runs' ( Fire Intensity raster, window), and whether the ignitions burned.
+            See collectFarsiteGrids
+    '''
+    srs = getStratumSpatialReference(stratum_template)
+    distance = spread_rate * fire_duration_mins
+
+    runs = []
+    windows = {}
+    for i, (cluster, window) in enumerate(clusterIgnitions(stratum_template, ignition_cells, distance)):
+        cluster_prefix = '{0}C{1:03d}-'.format(file_prefix, i)
+
+        lcp_name = os.path.join(output_dir, cluster_prefix + 'farsiteSTSIM')
+        make_lcp(lcp_name, window)
+
+        ignition_filename = os.path.join(output_dir, cluster_prefix + 'ignitionPtsFile.shp')
+        createIgnitionPtFile(x[cluster], y[cluster], srs, ignition_filename)
+
+        runs.append((lcp_name + '.lcp', inputs_filename, ignition_filename, output_dir, cluster_prefix + 'FARSITE'))
+        windows[os.path.join(output_dir, cluster_prefix + 'FARSITE')] = window
+
+    clipped_cells = sum(rows * cols for row, col, rows, cols in windows.values())
+    logging.info('Running {0} Farsite runs for {1} ignitions, clipped to {2:.1%} of the landscape...'.format(
+        len(runs), len(ignition_cells), clipped_cells / float(stratum_template.rows * stratum_template.cols)))
+    fire_intensity_filenames, ignitions_burned = runFarsiteRuns(runs, output_dir, file_prefix, parallel_runs)
+
+    # DEVNOTE: Match the rasters back up with their windows by prefix, as collectFarsiteGrids may have dropped some
+    windows = dict((findFarsiteGrid(prefix, 'Intensity'), window) for prefix, window in windows.items())
+    return [(filename, windows[filename]) for filename in fire_intensity_filenames], ignitions_burned
+
+
+def clusterIgnitions(stratum_template, ignition_cells, distance):
+    '''
+        Cluster the ignitions whose clip windows overlap, as their fires might meet.
+
+        A cluster's window is the bounding window of its ignitions' windows, so it can overlap windows that none of its
+        ignitions' did. The overlapping windows are found by a sweep in row order ( see findOverlappingWindows), and
+        their clusters merged, repeating with the merged clusters' windows until none overlap.
+
+        :param ignition_cells: The flat indexes of the ignition cells
+        :param distance: How far ( map units) a fire could spread
+        :return: A list of the ( indexes, into ignition_cells, of the cluster's ignitions, clip window) of each cluster
+    '''
+    clusters = [[i] for i in range(len(ignition_cells))]
+    windows = [getClipWindow(stratum_template, ignition_cells[[i]], distance) for i in range(len(ignition_cells))]
+
+    while True:
+        # Union-find over the clusters, joined by their overlapping windows
+        parent = range(len(clusters))
+
+        def find(i):
+            while parent[i] <> i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for a, b in findOverlappingWindows(windows):
+            parent[find(a)] = find(b)
+
+        merged = {}
+        for i in range(len(clusters)):
+            merged.setdefault(find(i), []).extend(clusters[i])
+        if len(merged) == len(clusters):
+            break
+
+        clusters = sorted(merged.values(), key=min)
+        windows = [getClipWindow(stratum_template, ignition_cells[members], distance) for members in clusters]
+
+    return [(np.array(sorted(members)), window) for members, window in zip(clusters, windows)]
+
+
+def findOverlappingWindows(windows):
+    '''
+        Find the pairs of ( row, col, rows, cols) windows that overlap, by sweeping them in order of their first row.
+        Only the windows whose rows haven't ended before the current window's first row need checking against it.
+
+        :return: A list of the ( index, index) of each overlapping pair
+    '''
+    pairs = []
+    active = []
+    for i in sorted(range(len(windows)), key=lambda i: windows[i][0]):
+        while active and active[0][0] <= windows[i][0]:
+            heapq.heappop(active)
+        for end_row, j in active:
+            if windowsOverlap(windows[i], windows[j]):
+                pairs.append((j, i))
+        heapq.heappush(active, (windows[i][0] + windows[i][2], i))
+
+    return pairs
+
+
+def getClipWindow(stratum_template, cells, distance):
+    '''
+        Get the window of the Primary Stratum within the distance of any of the cells, plus CLIP_MARGIN_CELLS.
+
+        :return: The ( row, col, rows, cols) window
+    '''
+    rows, cols = np.divmod(np.asarray(cells, dtype=np.int64), stratum_template.cols)
+    gt = stratum_template.geotransform
+    margin_rows = int(np.ceil(distance / abs(gt[5]))) + CLIP_MARGIN_CELLS
+    margin_cols = int(np.ceil(distance / abs(gt[1]))) + CLIP_MARGIN_CELLS
+
+    row = max(0, int(rows.min()) - margin_rows)
+    col = max(0, int(cols.min()) - margin_cols)
+    end_row = min(stratum_template.rows, int(rows.max()) + margin_rows + 1)
+    end_col = min(stratum_template.cols, int(cols.max()) + margin_cols + 1)
+    return row, col, end_row - row, end_col - col
+
+
+def windowsOverlap(a, b):
+    '''
+        Check whether two ( row, col, rows, cols) windows overlap.
+    '''
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+def runFarsiteRuns(runs, output_dir, file_prefix, parallel_runs):
+    '''
+        Batch the runs into the command files of up to parallel_runs Farsite processes, run them at the same time, and
+        collect their Fire Intensity rasters.
+
+        :param runs: A list of the ( lcp_filename, inputs_filename, ignitions_filename, output_dir, output_files_prefix)
+            of each run. See farsiteUtils.createFarsiteBatchCommandFile
+        :return: See collectFarsiteGrids
+    '''
+    output_prefixes = [os.path.join(run_output_dir, output_files_prefix) for _, _, _, run_output_dir, output_files_prefix
+                       in runs]
+
+    # Deal the runs out to the processes, so that each has a share of the landscape
+    num_processes = min(parallel_runs, len(runs))
+    processes = []
+    for i in range(num_processes):
+        command_filename = os.path.join(output_dir, '{0}P{1:03d}-command.txt'.format(file_prefix, i))
+        createFarsiteBatchCommandFile(command_filename, runs[i::num_processes])
+        processes.append((command_filename, len(runs[i::num_processes]), output_prefixes[i::num_processes]))
+
+    # DEVNOTE: The settings are read here, as an invalid one exits the script, which hangs pool.map if done in a worker
+    budget = getFarsiteBudget()
+    over_budget_action = getFarsiteOverBudgetAction()
+
+    logging.info('Running {0} Farsite processes, {1} at a time...'.format(len(processes), parallel_runs))
+
+    pool = ThreadPool(num_processes)
+    try:
+        results = pool.map(lambda process: callFarsite(process[0], process[1], budget), processes)
+    finally:
+        pool.close()
+        pool.join()
+
+    logging.info('Farsite runs complete.')
+
+    return collectFarsiteGrids([(command_filename, result, process_output_prefixes) for
+                                (command_filename, _, process_output_prefixes), result in zip(processes, results)],
+                               over_budget_action)
+
+
+def collectFarsiteGrids(processes, over_budget_action = None):
+    '''
+        Check how the Farsite processes ended, and find the Fire Intensity rasters of their runs.
+
+        A process that went over its budget ( see farsiteUtils.callFarsite) is handled as set in the FARSITE
+        Environment ( see farsiteUtils.getFarsiteOverBudgetAction): either the timestep fails, the rasters of the runs
+        that finished are used, or the timestep is treated as having no fire at all. A raster the process was stopped
+        part way thru writing is skipped.
+
+        :param processes: A list of the ( command filename, processSupervisor.ProcessResult, list of the output prefixes
+            of its runs) of each Farsite process
+        :param over_budget_action: (Optional) The over budget action, if it's already been read from the FARSITE
+            Environment
+        :return: A tuple of the list of the Fire Intensity rasters, and whether the ignitions burned
+    '''
+    if over_budget_action is None:
+        over_budget_action = getFarsiteOverBudgetAction()
+
+    over_budget = False
+    for command_filename, result, output_prefixes in processes:
+        if result.over_budget:
+            over_budget = True
+            if over_budget_action == OVER_BUDGET_ERROR:
+                logging.error("Farsite went over its {0} budget:{1}".format(result.over_budget,
+                                                                           getFarsiteCommandLine(command_filename)))
+                sys.exit(1)
+
+        elif result.exit_code <> 0:
+            logging.error("Error calling Farsite:{0}".format(getFarsiteCommandLine(command_filename)))
+            sys.exit(1)
+
+    if over_budget and over_budget_action == OVER_BUDGET_ZERO:
+        logging.warning('Farsite went over its budget, so there is no fire this timestep.')
+        return [], False
+
+    fire_intensity_filenames = []
+    for command_filename, result, output_prefixes in processes:
+        for output_prefix in output_prefixes:
+            fire_intensity_filename = findFarsiteGrid(output_prefix, 'Intensity')
+            if fire_intensity_filename is None:
+                if result.over_budget:
+                    logging.warning('Farsite went over its budget before writing "{0}_Intensity", so only its ignitions '
+                                    'burned.'.format(output_prefix))
+                    continue
+
+                logging.error('The expected Fire Intensity raster file "{0}_Intensity" can not be found.'.format(
+                    output_prefix))
+                sys.exit(1)
+
+            if result.over_budget and not isFarsiteGridComplete(fire_intensity_filename):
+                logging.warning('Farsite went over its budget while writing "{0}", so only its ignitions burned.'.format(
+                    fire_intensity_filename))
+                continue
+
+            fire_intensity_filenames.append(fire_intensity_filename)
+
+    return fire_intensity_filenames, True
@@ -1,13 +1,13 @@
 ﻿import logging
 import os
-import subprocess
 
 import sys
-import tempfile
 
 import datetime
 import gdal
+import hashlib
 import shutil
+from cStringIO import StringIO
 
 import win32api
 from osgeo import ogr
@@ -16,168 +16,276 @@ import numpy as np
 
 from gdalconst import *
 
-import random
 from shapely.geometry import Point, Polygon
 
+from lcpWriter import writeLCP, BandSource
+from fireResult import FireResult, readFireIntensity, FARSITE_OUTPUT_ASCII
+from processSupervisor import runProcess
+from rasterCache import RasterHeaderCache, getDriver
+from syncrosim import replaceFile
+
 # Path to the Farsite EXE relative to the Python Scripts directory
 LCPMAKE_EXE_PATH ="../exe/lcpmake.exe"
 FARSITE_EXE_PATH="../exe/TestFARSITE.exe"
 
+# Name of the Farsite inputs template, in SSIM_TEMP_DIRECTORY, keyed by a hash of the options it was built from. Bump the
+# version whenever buildFarsiteInputsTemplate changes. See getFarsiteInputsTemplate
+INPUTS_TEMPLATE_FILENAME = 'FarsiteInputsTemplate-{0}.txt'
+INPUTS_TEMPLATE_VERSION = 2
+INPUTS_TEMPLATE_OPTIONS = ['time_step_resolution_minutes', 'distance_resolution', 'perimeter_resolution',
+                           'fuel_moisture_1', 'fuel_moisture_10', 'fuel_moisture_100', 'fuel_moisture_live_herb',
+                           'fuel_moisture_live_woody', 'weather_precipitation', 'weather_min_temp_hour',
+                           'weather_max_temp_hour', 'weather_min_temp', 'weather_max_temp', 'weather_max_humidity',
+                           'weather_min_humidity', 'weather_elevation', 'wind_speed', 'wind_direction',
+                           'cloud_cover_percent', 'farsite_acceleration']
+
+# Separates the sections of the inputs template: everything before the weather, the weather, the wind, and everything
+# after the wind. The weather and wind sections are replaced when the scenario has weather streams
+INPUTS_TEMPLATE_SECTION_SEPARATOR = '\x00'
+
+# The scenario's weather streams, by filename. See getWeatherStreams
+_weather_streams = {}
+
+# The wall-clock and CPU budgets (secs) of each Farsite run, from the FARSITE Environment, and what to do with a run
+# that goes over either of them. See callFarsite and farsiteRunner.collectFarsiteGrids
+ENV_FARSITE_WALL_SECONDS = 'SSIM_FARSITE_WALL_SECONDS'
+ENV_FARSITE_CPU_SECONDS = 'SSIM_FARSITE_CPU_SECONDS'
+ENV_FARSITE_OVER_BUDGET = 'SSIM_FARSITE_OVER_BUDGET'
+
+# Over budget actions: fail the timestep, use whatever grids the runs managed to write, or treat the timestep as having
+# no fire
+OVER_BUDGET_ERROR = 'Error'
+OVER_BUDGET_PARTIAL = 'Partial'
+OVER_BUDGET_ZERO = 'Zero'
+
+# OGR drivers, by name. See getOgrDriver, and rasterCache.getDriver for the GDAL drivers
+_ogr_drivers = {}
+
 
 def makeFarsiteInputFile( inputs_filename, ignition_filename, config):
+    '''
+        Make the Farsite inputs file for a fire.
 
+        Only the fire start and end times change from fire to fire, so everything else comes from the inputs template
+        ( see getFarsiteInputsTemplate), built once for the scenario, and the file is written in a single call. If the
+        scenario has weather streams, just the weather and wind records around the fire are written in place of the
+        template's constant weather and wind.
+
+        :return: A tuple of the fire start and end datetimes
+    '''
 
     logging.debug('Making Farsite Input file "{0}"'.format(inputs_filename))
 
+    #
+    # ii- Generate the Farsite input file including:
+    # 1. -Fire start date/time (sampled from a probability distribution)
+
+
+    fire_start_day =  np.random.uniform(config.fire_season_start_julian_day,config.fire_season_end_julian_day)
+    # DEVNOTE: Seems to give us grief if day_start = 1 "Invalid start time Start Date is NOT within usable range of daily weather data", so force to 2 if thats the case
+    fire_start_day = max(2,fire_start_day)
+    # DEVNOTE: Use a constant non-leap year year, as Farsite doesnt care about year, and we dont want to have date variations
+    # due to leap years
+    fire_year = 2015
+    weather_streams = getWeatherStreams(config)
+    if weather_streams:
+        # Unless the weather varies from year to year, in which case use the year whose weather we're using
+        fire_year = weather_streams.chooseYear(config.timestep)
+    fire_start_datetime = datetime.datetime(fire_year,1,1) + datetime.timedelta(days=fire_start_day - 1.0)
+
+    # 2. - Fire end date/time (use a fixed duration for each ignition for now. Can conduct sensitivity analysis)
+    fire_duration_mins  = np.random.poisson(config.mean_fire_duration_hours * 60.0)
+    # DEVNOTE: It seems that Farsite wont process if duration less than 10 minutes.
+    # TODO: Ask Leo what he want to do with this. Might want to restrict in UI to >=10
+    fire_duration_mins = max(fire_duration_mins, 10.0)
+    logging.debug('Fire duration (mins)= {}'.format(fire_duration_mins))
+
+    fire_end_day = fire_start_day + fire_duration_mins/(24.0 * 60.0)
+    # TODO: Ask Leo - I dont think I want to do the following, becuase you'll end up with a clipping of duration.
+    # fire_end_day = min(fire_end_day,config.fire_season_end_julian_day)
+    fire_end_datetime = datetime.datetime(fire_year,1,1) + datetime.timedelta(days= fire_end_day -1.0)
+    # Clip within the year
+    fire_end_datetime = min(datetime.datetime(fire_year,12,31,23,59,59),fire_end_datetime)
+
+    sections = getFarsiteInputsTemplate(config)
+    if config.has_weather_stream:
+        sections[1] = weather_streams.formatWeather(fire_start_datetime, fire_end_datetime)
+    if config.has_wind_stream:
+        sections[2] = weather_streams.formatWind(fire_start_datetime, fire_end_datetime)
+
+    with open(inputs_filename, 'w') as f:
+        f.write('FARSITE INPUTS FILE VERSION 1.0 produced by FARSITE-STSim Python script {0}\n'
+                'FARSITE_START_TIME: {1:%m %d %H%M}\n'
+                'FARSITE_END_TIME: {2:%m %d %H%M}\n'.format(datetime.datetime.now(), fire_start_datetime,
+                                                              fire_end_datetime) +
+                ''.join(sections))
+
+    logging.debug("Making Farsite Input file complete.")
+
+    return fire_start_datetime, fire_end_datetime
+
+
+def getFarsiteInputsTemplate(config):
+    '''
+        Get the static part of the Farsite inputs file, that follows the start and end times.
+
+        This only depends on the scenario's Farsite Options, so is built once, and kept in the temp directory, keyed by
+        the options it was built from.
+
+        :return: The template's sections, as a list of byte strings. See INPUTS_TEMPLATE_SECTION_SEPARATOR
+    '''
+    key = hashlib.sha1(repr([INPUTS_TEMPLATE_VERSION] + [getattr(config, name) for name in INPUTS_TEMPLATE_OPTIONS]))
+    template_filename = os.path.join(config.temp_dir, INPUTS_TEMPLATE_FILENAME.format(key.hexdigest()))
+    if os.path.exists(template_filename):
+        with open(template_filename, 'rb') as f:
+            return f.read().split(INPUTS_TEMPLATE_SECTION_SEPARATOR)
+
+    template = buildFarsiteInputsTemplate(config)
+
+    # The template is only a cache, so if it can't be saved, it's just rebuilt next time
+    tmp_filename = '{0}.tmp{1}'.format(template_filename, os.getpid())
     try:
-        f = open(inputs_filename, 'w')
-
-        f.write('FARSITE INPUTS FILE VERSION 1.0 produced by FARSITE-STSim Python script {0}\n'.format(datetime.datetime.now()))
-
-        #
-        # ii- Generate the Farsite input file including:
-        # 1. -Fire start date/time (sampled from a probability distribution)
-
-
-        fire_start_day =  np.random.uniform(config.fire_season_start_julian_day,config.fire_season_end_julian_day)
-        # DEVNOTE: Seems to give us grief if day_start = 1 "Invalid start time Start Date is NOT within usable range of daily weather data", so force to 2 if thats the case
-        fire_start_day = max(2,fire_start_day)
-        # DEVNOTE: Use a constant non-leap year year, as Farsite doesnt care about year, and we dont want to have date variations
-        # due to leap years
-        fire_start_datetime = datetime.datetime(2015,1,1) + datetime.timedelta(days=fire_start_day - 1.0)
-        f.write('FARSITE_START_TIME: {:%m %d %H%M}\n'.format(fire_start_datetime))
-
-        # 2. - Fire end date/time (use a fixed duration for each ignition for now. Can conduct sensitivity analysis)
-        fire_duration_mins  = np.random.poisson(config.mean_fire_duration_hours * 60.0)
-        # DEVNOTE: It seems that Farsite wont process if duration less than 10 minutes.
-        # TODO: Ask Leo what he want to do with this. Might want to restrict in UI to >=10
-        fire_duration_mins = max(fire_duration_mins, 10.0)
-        logging.debug('Fire duration (mins)= {}'.format(fire_duration_mins))
-
-        fire_end_day = fire_start_day + fire_duration_mins/(24.0 * 60.0)
-        # TODO: Ask Leo - I dont think I want to do the following, becuase you'll end up with a clipping of duration.
-        # fire_end_day = min(fire_end_day,config.fire_season_end_julian_day)
-        fire_end_datetime = datetime.datetime(2015,1,1) + datetime.timedelta(days= fire_end_day -1.0)
-        # Clip within the year
-        fire_end_datetime = min(datetime.datetime(2015,12,31,23,59,59),fire_end_datetime)
-        f.write('FARSITE_END_TIME: {:%m %d %H%M}\n'.format(fire_end_datetime))
-
-        # 3. - Timestep resolution (minutes)
-        #DEVNOTE: In Help file says:
-        # Surface Fire/Timber Timestep = 20 to 120 minutes
-        # Surface / brush, dry grass = 10 to 20 minutes
-        #surface extreme or or torching/crowning/ all fuel = 5 to 10 minutes
-        f.write('FARSITE_TIMESTEP: {0}\n'.format(config.time_step_resolution_minutes))
-
-        # 4. - distance and perimeter resolutions - match ST-Sim
-        # Match cell size of input rasters
-        gdal.UseExceptions()
-        ref_raster = gdal.Open(config.primaryStratumFile, gdal.GA_ReadOnly)
-        if ref_raster is None:
-            logging.error("Cannot open Source Raster file '{0}'".format(config.primaryStratumFile))
-            sys.exit(1)
+        with open(tmp_filename, 'wb') as f:
+            f.write(template)
+    except (IOError, OSError) as ex:
+        logging.warning('Could not save the Farsite inputs template "{0}" ({1})'.format(template_filename, ex))
+    else:
+        replaceFile(tmp_filename, template_filename)
 
+    return template.split(INPUTS_TEMPLATE_SECTION_SEPARATOR)
+
+
+def getWeatherStreams(config):
+    '''
+        Get the scenario's weather streams, loading them the first time they're needed.
+
+        :return: The weatherStream.WeatherStreams, or None if the scenario doesn't have any
+    '''
+    if not config.weather_streams_file:
+        return None
+
+    if config.weather_streams_file not in _weather_streams:
+        from weatherStream import WeatherStreams
+        _weather_streams[config.weather_streams_file] = WeatherStreams(config.weather_streams_file)
+
+    return _weather_streams[config.weather_streams_file]
+
+
+def buildFarsiteInputsTemplate(config):
+    '''
+        Build the static part of the Farsite inputs file. See getFarsiteInputsTemplate
+    '''
+    f = StringIO()
+
+    # 3. - Timestep resolution (minutes)
+    #DEVNOTE: In Help file says:
+    # Surface Fire/Timber Timestep = 20 to 120 minutes
+    # Surface / brush, dry grass = 10 to 20 minutes
+    #surface extreme or or torching/crowning/ all fuel = 5 to 10 minutes
+    f.write('FARSITE_TIMESTEP: {0}\n'.format(config.time_step_resolution_minutes))
+
+    # 4. - distance and perimeter resolutions - match ST-Sim
+    f.write('FARSITE_DISTANCE_RES: {0}\n'.format(config.distance_resolution))
+    f.write('FARSITE_PERIMETER_RES: {0}\n'.format(config.perimeter_resolution))
+
+
+    # 5. - Fuel moisture by fuel model - need input from the user as a percent moisture by fuel model for 1 hour, 10 hour,
+    # 100 hour and live woody and herbaceous fuels.  These numbers are specified as integers and may exceed 100. To begin
+    # use hard coded values for extreme conditions.
+    # Ex:
+    # Fuel mode entry format:
+    # Model  FM1   FM10  FM100   FMLiveHerb   FMLiveWoody
+    # 0      2      2     3         4           5
+
+    # FUEL_MOISTURES_DATA: 1
+    # 0 3 4 8 9 70
+
+    # FUEL_MOISTURE_XXX = 10  # 10% for now
+    f.write('FUEL_MOISTURES_DATA: 1\n')
+    f.write('0 {0} {1} {2} {3} {4}\n'.format(config.fuel_moisture_1,config.fuel_moisture_10,config.fuel_moisture_100,config.fuel_moisture_live_herb,config.fuel_moisture_live_woody))
+
+
+    # 6. - weather stream data (wind, temperature, humidity and precip). To begin use hard coded values for extreme conditions.
+    #  Example files for the Tucson area are available online.
+    # http://fireweather.sc.egov.usda.gov/applications/farsite/farsite_map8.php?usr=lfrid&model=wrf&state=AZ
+    # TODO: Website down "RMC Temporarily Unavailable"
+    f.write(INPUTS_TEMPLATE_SECTION_SEPARATOR)
+    f.write('WEATHER_DATA: 365\n')
+    # Weather Data Format:
+    # Mth  Day  Pcp  mTH  xTH   mT xT   xH mH   Elv   PST  PET
+    # Mth = month,
+    # Day = day,
+    # Per = precip in hundredths of an inch (integer e.g. 10 = 0.1 inches),
+    # mTH = min_temp_hour 0-2400,
+    # xTH = max_temp_hour 0 - 2400,
+    # mT  = min_temp,
+    # xT  = max_temp,
+    # mH  = max_humidity
+    # xH  = min_humidity,
+    # Elv = elevation,
+    # PST = precip_start_time 0-2400 * Optional
+    # PET = precip_end_time   0-2400 * Optional
+    # NOTE: do not leave any blank values
+
+
+    # Weather Data Example:
+    # Mth  Day  Pcp  mTH  xTH   mT xT   xH mH   Elv   PST  PET
+    # 6 16 0 500 1500 38 74 58 14 6903 0 0
+    # DEVNOTE: Weather data seems to need to be contiguous, and to bookend the Start Time/End Time range. Easist thing to do
+    # is just spit out records for complete year
+    for day in range(365):
+        dt = datetime.date(2015, 1, 1) + datetime.timedelta(days=day)
+
+        # DEVNOTE: Precipitation Times are supposed to optional, but seem to be required if a precip value of <> 0 enter, so hack in 0 and 24
+        # Also, if precip = 0, then dont include Start Time/End Time
+        if config.weather_precipitation ==0:
+            precip_time = ''
+        else:
+            precip_time = '0 24'
+
+        f.write('{:%m %d} {} {} {} {} {} {} {} {} {}\n'
+                .format(dt,
+                        int(config.weather_precipitation * 100),
+                        (config.weather_min_temp_hour * 100), (config.weather_max_temp_hour * 100),config.weather_min_temp,config.weather_max_temp,
+                        config.weather_max_humidity, config.weather_min_humidity,
+                        config.weather_elevation,precip_time
+                        )
+                )
+
+    # DEVNOTE: Hardcode units to English, to match the units in the STSim UI boilerplate
+    f.write('WEATHER_DATA_UNITS: English\n\n')
+
+    # Wind data
+    f.write(INPUTS_TEMPLATE_SECTION_SEPARATOR)
+    f.write('WIND_DATA: 365\n')
+    # Mth  Day  Hour   Speed Direction CloudCover
+    for day in range(365):
+        dt = datetime.date(2015, 1, 1) + datetime.timedelta(days=day)
+        f.write('{:%m %d} 0 {} {} {}\n'.format(dt,
+                                                config.wind_speed,config.wind_direction, config.cloud_cover_percent))
+
+    # DEVNOTE: Hardcode units to English, to match the units in the STSim UI boilerplate
+    f.write('WIND_DATA_UNITS: English\n\n')
+    f.write(INPUTS_TEMPLATE_SECTION_SEPARATOR)
+
+    # 7. - Spotting parameters: can probably be ignored or set to non-spotting behaviour defaults as we are not dealing with a forested system.
+    #   a. --Spot probability
+    #   b. --Spot ignition delay
+    #   c. -- Minimum spot distance
+    # DEVNOTE: Ignore for now. But maybe a Future
+    # These are mandatory switches, so can't be ignored. Set Prob = 0.
+    f.write('FARSITE_SPOT_PROBABILITY: 0.0\n')
+    f.write('FARSITE_SPOT_IGNITION_DELAY: 0\n')
+    f.write('FARSITE_MINIMUM_SPOT_DISTANCE: 0\n')
+
+    # 8. Acceleration
+    f.write('FARSITE_ACCELERATION_ON: {}'.format( '1' if config.farsite_acceleration == 'Yes' else '0' ))
+
+    return f.getvalue()
 
-        f.write('FARSITE_DISTANCE_RES: {0}\n'.format(config.distance_resolution))
-        f.write('FARSITE_PERIMETER_RES: {0}\n'.format(config.perimeter_resolution))
-
-
-        # 5. - Fuel moisture by fuel model - need input from the user as a percent moisture by fuel model for 1 hour, 10 hour,
-        # 100 hour and live woody and herbaceous fuels.  These numbers are specified as integers and may exceed 100. To begin
-        # use hard coded values for extreme conditions.
-        # Ex:
-        # Fuel mode entry format:
-        # Model  FM1   FM10  FM100   FMLiveHerb   FMLiveWoody
-        # 0      2      2     3         4           5
-
-        # FUEL_MOISTURES_DATA: 1
-        # 0 3 4 8 9 70
-
-        # FUEL_MOISTURE_XXX = 10  # 10% for now
-        f.write('FUEL_MOISTURES_DATA: 1\n')
-        f.write('0 {0} {1} {2} {3} {4}\n'.format(config.fuel_moisture_1,config.fuel_moisture_10,config.fuel_moisture_100,config.fuel_moisture_live_herb,config.fuel_moisture_live_woody))
-
-
-        # 6. - weather stream data (wind, temperature, humidity and precip). To begin use hard coded values for extreme conditions.
-        #  Example files for the Tucson area are available online.
-        # http://fireweather.sc.egov.usda.gov/applications/farsite/farsite_map8.php?usr=lfrid&model=wrf&state=AZ
-        # TODO: Website down "RMC Temporarily Unavailable"
-        f.write('WEATHER_DATA: 365\n')
-        # Weather Data Format:
-        # Mth  Day  Pcp  mTH  xTH   mT xT   xH mH   Elv   PST  PET
-        # Mth = month,
-        # Day = day,
-        # Per = precip in hundredths of an inch (integer e.g. 10 = 0.1 inches),
-        # mTH = min_temp_hour 0-2400,
-        # xTH = max_temp_hour 0 - 2400,
-        # mT  = min_temp,
-        # xT  = max_temp,
-        # mH  = max_humidity
-        # xH  = min_humidity,
-        # Elv = elevation,
-        # PST = precip_start_time 0-2400 * Optional
-        # PET = precip_end_time   0-2400 * Optional
-        # NOTE: do not leave any blank values
-
-
-        # Weather Data Example:
-        # Mth  Day  Pcp  mTH  xTH   mT xT   xH mH   Elv   PST  PET
-        # 6 16 0 500 1500 38 74 58 14 6903 0 0
-        # DEVNOTE: Weather data seems to need to be contiguous, and to bookend the Start Time/End Time range. Easist thing to do
-        # is just spit out records for complete year
-        for day in range(365):
-            dt = datetime.date(2015, 1, 1) + datetime.timedelta(days=day)
-
-            # DEVNOTE: Precipitation Times are supposed to optional, but seem to be required if a precip value of <> 0 enter, so hack in 0 and 24
-            # Also, if precip = 0, then dont include Start Time/End Time
-            if config.weather_precipitation ==0:
-                precip_time = ''
-            else:
-                precip_time = '0 24'
-
-            f.write('{:%m %d} {} {} {} {} {} {} {} {} {}\n'
-                    .format(dt,
-                            int(config.weather_precipitation * 100),
-                            (config.weather_min_temp_hour * 100), (config.weather_max_temp_hour * 100),config.weather_min_temp,config.weather_max_temp,
-                            config.weather_max_humidity, config.weather_min_humidity,
-                            config.weather_elevation,precip_time
-                            )
-                    )
-
-        # DEVNOTE: Hardcode units to English, to match the units in the STSim UI boilerplate
-        f.write('WEATHER_DATA_UNITS: English\n\n')
-
-        # Wind data
-        f.write('WIND_DATA: 365\n')
-        # Mth  Day  Hour   Speed Direction CloudCover
-        for day in range(365):
-            dt = datetime.date(2015, 1, 1) + datetime.timedelta(days=day)
-            f.write('{:%m %d} 0 {} {} {}\n'.format(dt,
-                                                    config.wind_speed,config.wind_direction, config.cloud_cover_percent))
-
-        # DEVNOTE: Hardcode units to English, to match the units in the STSim UI boilerplate
-        f.write('WIND_DATA_UNITS: English\n\n')
-
-        # 7. - Spotting parameters: can probably be ignored or set to non-spotting behaviour defaults as we are not dealing with a forested system.
-        #   a. --Spot probability
-        #   b. --Spot ignition delay
-        #   c. -- Minimum spot distance
-        # DEVNOTE: Ignore for now. But maybe a Future
-        # These are mandatory switches, so can't be ignored. Set Prob = 0.
-        f.write('FARSITE_SPOT_PROBABILITY: 0.0\n')
-        f.write('FARSITE_SPOT_IGNITION_DELAY: 0\n')
-        f.write('FARSITE_MINIMUM_SPOT_DISTANCE: 0\n')
-
-        # 8. Acceleration
-        f.write('FARSITE_ACCELERATION_ON: {}'.format( '1' if config.farsite_acceleration == 'Yes' else '0' ))
-
-        logging.debug("Making Farsite Input file complete.")
-
-    finally:
-        f.close()
 
 def createFarsiteCommandFile(command_filename, lcp_filename, inputs_filename, ignitions_filename, output_dir,
-                             output_files_prefix, output_type=1, barrier_filename=0):
+                             output_files_prefix, output_type=None, barrier_filename=0):
     '''
         Create a TestFarsite command file
 
@@ -196,21 +304,40 @@ def createFarsiteCommandFile(command_filename, lcp_filename, inputs_filename, ig
                 [outputDirPath] is the path to the output files base name (no extension)
                 [outputsType] is the file type for outputs (0 = both, 1 = ASCII grid, 2 = FlamMap binary grid
                 :param output_files_prefix:
+                :param output_type: (Optional) The outputsType. Defaults to ASCII grids, the only outputs read back. See
+                    fireResult.FARSITE_OUTPUT_ASCII
     '''
 
-    logging.debug('Making Farsite Command file "{0}"'.format(command_filename))
+    createFarsiteBatchCommandFile(command_filename,
+                                  [(lcp_filename, inputs_filename, ignitions_filename, output_dir, output_files_prefix)],
+                                  output_type, barrier_filename)
+
+
+def createFarsiteBatchCommandFile(command_filename, runs, output_type=None, barrier_filename=0):
+    '''
+        Create a TestFarsite command file for several Farsite runs, one per line, all executed by the one TestFARSITE
+        process. See createFarsiteCommandFile
+
+        :param runs: A list of the (lcp_filename, inputs_filename, ignitions_filename, output_dir, output_files_prefix)
+            of each run
+    '''
+
+    if output_type is None:
+        output_type = FARSITE_OUTPUT_ASCII
+
+    logging.debug('Making Farsite Command file "{0}" for {1} runs'.format(command_filename, len(runs)))
 
     f = open(command_filename, 'w')
 
     # DEVNOTE: We assume we're running on a Windows machine, as Farsite is only PC/Windows based (?)
     # DEVNOTE: It appears that Farsite command file does NOT support spaces in file paths, or wrapping with quotes, so convert to Windows short name
-    f.write('{0} {1} {2} {3} {4} {5}'.format(
+    f.write('\n'.join('{0} {1} {2} {3} {4} {5}'.format(
         getShortName(lcp_filename),
         getShortName(inputs_filename),
         getShortName(ignitions_filename),
         0 if barrier_filename ==0 else getShortName(barrier_filename),
         getShortName(output_dir) + "\\" + output_files_prefix,
-        output_type))
+        output_type) for lcp_filename, inputs_filename, ignitions_filename, output_dir, output_files_prefix in runs))
     f.close()
 
 
@@ -241,20 +368,134 @@ def runFarsite(command_filename):
     # iii - Invoke Farsite and wait for it to complete the run
     # TestFARSITE SampleCommand.txt
 
-    logging.info('Running Farsite...')
+    # DEVNOTE: Errors are left to the caller, as a run that went over its budget isn't necessarily one. See
+    # farsiteRunner.collectFarsiteGrids
 
-    cmdLine  = '"{0}" "{1}" '.format(FARSITE_EXE_PATH,getShortName(command_filename))
-    logging.debug(cmdLine)
-    proc = subprocess.call(cmdLine)
-    if proc <> 0:
-        logging.error("Error calling Farsite:{0}".format(cmdLine))
-        sys.exit(1)
+    logging.info('Running Farsite...')
 
+    result = callFarsite(command_filename)
 
     logging.info('Farsite run complete.')
+    return result
+
+
+def getFarsiteCommandLine(command_filename):
+    return '"{0}" "{1}" '.format(FARSITE_EXE_PATH,getShortName(command_filename))
+
+
+def callFarsite(command_filename, num_runs = 1, budget = None):
+    '''
+        Invoke Farsite on the command file, and wait for it to complete, or to go over its budget. Farsite's output is
+        logged as it runs, and it can be called from a worker thread. See farsiteRunner
+
+        :param num_runs: The number of runs in the command file. The budgets are per run.
+        :param budget: (Optional) The ( wall-clock, CPU) budgets of a run. See getFarsiteBudget. Worker threads must be
+            given it, as a bad budget setting exits the script, which would leave the thread pool waiting for them.
+        :return: The processSupervisor.ProcessResult
+    '''
+    wall_seconds, cpu_seconds = budget if budget is not None else getFarsiteBudget()
+    return runProcess(getFarsiteCommandLine(command_filename), 'Farsite',
+                      wall_seconds and wall_seconds * num_runs, cpu_seconds and cpu_seconds * num_runs)
+
+
+def getFarsiteBudget():
+    '''
+        Get the budget for a Farsite run, from the FARSITE Environment.
+
+        :return: A tuple of the wall-clock and CPU budgets (secs), either of which is None if it's not set
+    '''
+    budget = []
+    for name in [ENV_FARSITE_WALL_SECONDS, ENV_FARSITE_CPU_SECONDS]:
+        value = os.environ.get(name, '').strip()
+        if value == '':
+            budget.append(None)
+            continue
+
+        try:
+            seconds = float(value)
+        except ValueError:
+            seconds = 0
+
+        if seconds <= 0:
+            logging.error('The FARSITE Environment {0} must be a number of seconds greater than 0, not "{1}"'.format(
+                name, value))
+            sys.exit(1)
+
+        budget.append(seconds)
+
+    return tuple(budget)
+
+
+def getFarsiteOverBudgetAction():
+    '''
+        Get what to do with a Farsite run that goes over its budget, from the FARSITE Environment.
+
+        :return: OVER_BUDGET_ERROR ( the default), OVER_BUDGET_PARTIAL or OVER_BUDGET_ZERO
+    '''
+    value = os.environ.get(ENV_FARSITE_OVER_BUDGET, OVER_BUDGET_ERROR).strip()
+    for action in [OVER_BUDGET_ERROR, OVER_BUDGET_PARTIAL, OVER_BUDGET_ZERO]:
+        if value.upper() == action.upper():
+            return action
+
+    logging.error('The FARSITE Environment {0} must be one of {1}, {2} or {3}, not "{4}"'.format(
+        ENV_FARSITE_OVER_BUDGET, OVER_BUDGET_ERROR, OVER_BUDGET_PARTIAL, OVER_BUDGET_ZERO, value))
+    sys.exit(1)
+
+
+def lcpMake(landscape, elevation_filename, slope_filename, aspect_filename, fuel_filename, canopy_filename, latitude,
+            terrain_cache = None, window = None):
+    """
+    Make the landscape file for Farsite from the spatial attribute files exported by ST-Sim and the static spatial files
+    above. The LCP file is written directly from the rasters (see lcpWriter), rather than converting them to ASCII grids
+    for lcpmake.exe to parse back. See lcpMakeExe for the lcpmake.exe version.
+
+    :param landscape: The name of the Landscape file (LCP), without extension
+    :param elevation_filename: The full absolute name of the Elevation raster file
+    :param slope_filename: The full absolute name of the Slope raster file
+    :param aspect_filename: The full absolute name of the Aspect raster file
+    :param fuel_filename: The full absolute name of the Fuel raster file
+    :param canopy_filename: The full absolute name of the Canopy raster file
+    :param latitude: The latitude of the landscape
+    :param terrain_cache: (Optional) A TerrainCache to keep the encoded Elevation, Slope and Aspect bands in, as these
+        don't change between timesteps.
+    :param window: (Optional) The ( row, col, rows, cols) window of the rasters to make the landscape for, rather than
+        their full extent. See farsiteRunner.runFarsiteClipped
+    :return: Nothing
+
+    """
+
+    logging.info('Running LCPMake')
+
+    terrain = [elevation_filename, slope_filename, aspect_filename]
+    if terrain_cache:
+        terrain = [getCachedTerrainBand(terrain_cache, filename) for filename in terrain]
+
+    writeLCP(landscape + '.lcp', terrain + [fuel_filename, canopy_filename], latitude, elevation_filename,
+             [elevation_filename, slope_filename, aspect_filename, fuel_filename, canopy_filename], window=window)
+
+    logging.info('LCPMake run complete.')
+
+
+def getCachedTerrainBand(terrain_cache, src_filename):
+    '''
+        Get the LCP encoded values of the specified terrain raster from the terrain cache, encoding them if they're not
+        already there.
+
+        :return: The encoded values, as a read-only memory mapped array
+    '''
+    filename = terrain_cache.get(src_filename, 'lcp-int16-v2', '.npy', encodeTerrainBand, getGridMetadata)
+    return np.load(filename, mmap_mode='r')
+
+
+def encodeTerrainBand(src_filename, dest_filename):
+    '''
+        Encode the raster's values as LCP int16 values, and save them as a .npy file
+    '''
+    band = BandSource(src_filename)
+    np.save(dest_filename, band.readRows(0, band.rows))
 
 
-def lcpMake(landscape, elevation_filename, slope_filename, aspect_filename, fuel_filename, canopy_filename, latitude):
+def lcpMakeExe(landscape, elevation_filename, slope_filename, aspect_filename, fuel_filename, canopy_filename, latitude):
     """
     Call the compiled lcpmake.exe c++ code to make the landscape file for Farsite from the spatial attribute files exported
     by ST-Sim and the static spatial files above.
@@ -267,12 +508,14 @@ def lcpMake(landscape, elevation_filename, slope_filename, aspect_filename, fuel
             -fuel "D:/FARSITE 4/Ashley/ash_fuel.asc"
             -cover "D:/FARSITE 4/Ashley/ash_canopy.asc"
 
+    DEVNOTE: No longer used by the script, but kept as the reference for lcpMake. See benchmark.py
+
     :param landscape: The name of the Landscape file (LCP), without extension
-    :param elevation_filename: The full absolute name of the Elevation ASCII Grid raster file
-    :param slope_filename: The full absolute name of the Slope ASCII Grid raster file
-    :param aspect_filename: The full absolute name of the Aspect ASCII Grid raster file
-    :param fuel_filename: The full absolute name of the Fuel ASCII Grid raster file
-    :param canopy_filename: The full absolute name of the Canopy ASCII Grid raster file
+    :param elevation_filename: The full absolute name of the Elevation raster file
+    :param slope_filename: The full absolute name of the Slope raster file
+    :param aspect_filename: The full absolute name of the Aspect raster file
+    :param fuel_filename: The full absolute name of the Fuel raster file
+    :param canopy_filename: The full absolute name of the Canopy raster file
     :return: Nothing
 
     """
@@ -301,30 +544,21 @@ def lcpMake(landscape, elevation_filename, slope_filename, aspect_filename, fuel
                                     canopy_filename_asc,
                                     latitude)
 
-    logging.debug(cmdLine)
-    proc = subprocess.call(cmdLine)
-    if proc <> 0:
+    if runProcess(cmdLine, 'LCPMake').exit_code <> 0:
         logging.error("Error calling Syncrosim.Console:{0}".format(cmdLine))
         sys.exit(1)
 
     # Now remove the ASC files as we dont need them anymore
-    os.remove(elevation_filename_asc)
-    os.remove(elevation_filename_asc + '.aux.xml')
-    os.remove(slope_filename_asc)
-    os.remove(slope_filename_asc + '.aux.xml')
-    os.remove(aspect_filename_asc)
-    os.remove(aspect_filename_asc + '.aux.xml')
-    os.remove(fuel_filename_asc)
-    os.remove(fuel_filename_asc + '.aux.xml')
-    os.remove(canopy_filename_asc)
-    os.remove(canopy_filename_asc + '.aux.xml')
+    for filename_asc in [elevation_filename_asc, slope_filename_asc, aspect_filename_asc, fuel_filename_asc,
+                         canopy_filename_asc]:
+        removeRasterFile(filename_asc)
 
     logging.info('LCPMake run complete.')
 
 
-def createZeroValRaster(dest_filename, source_filename):
+def createZeroValRaster(dest_filename, stratum_template):
     '''
-        Create a zero value raster, using the same characteristics as the source file ( num_rows, num_cols,...)
+        Create a zero value raster, using the same characteristics as the Primary Stratum ( num_rows, num_cols,...)
 
         DEVNOTE: To generate a zero value raster using gdal_translate
         gdal_translate sclass_100x100.tif squashed.tif -scale 1 1 0 0
@@ -332,261 +566,240 @@ def createZeroValRaster(dest_filename, source_filename):
         gdal_translate sourcefile.tif dest_file.tif -scale 1 1 final_squash_value final_squash_value
         The above command doesnt honor NODATA values
 
+        :param dest_filename: The filename of the raster to create
+        :param stratum_template: The StratumTemplate of the Primary Stratum
     '''
 
-    tmp_dir = tempfile.mkdtemp()
+    logging.debug("dest_filename:{0}, source_filename:{1}".format(dest_filename, stratum_template.stratum_filename))
+    shutil.copyfile(stratum_template.getZeroTsmFilename(), dest_filename)
 
-    try:
 
-        logging.debug("dest_filename:{0}, source_filename:{1}".format(dest_filename,source_filename))
+def createOneValRaster(dest_filename, stratum_template):
+    '''
+        Create a One value raster, using the same characteristics as the Primary Stratum ( num_rows, num_cols,...)
 
-        # Delete the file it is exists
-        if os.path.exists(dest_filename):
-            os.remove(dest_filename)
+        :param dest_filename: The filename of the raster to create
+        :param stratum_template: The StratumTemplate of the Primary Stratum
+    '''
+    stratum_template.createRaster(dest_filename, 1)
 
-        # Convert the source_filename raster into a Int32 datatype, so we can support NoDataValue of -9999
-        tmp_raster = os.path.join(tmp_dir, "zv_raster.tif")
-        convertToInt32(source_filename,tmp_raster)
+def convertFireIntensityRaster(stratum_template, src_intensity_filename, ignition_cells, converted_filename):
+    '''
+        Convert the Fire Intensity Raster generated by Farsite into a Transition Spatial Multiplier (TSM)
+        raster suitable for import into Syncrosim. The ignition cells are set in the TSM as well as the burned cells.
 
-        gdal.UseExceptions()
-        srcData = gdal.Open(tmp_raster, gdal.GA_ReadOnly)
-        if srcData is None:
-            logging.error("Cannot open Source Raster file '{0}'".format(tmp_raster))
-            sys.exit(1)
+        The burned cells are held sparsely ( see fireResult.FireResult), so only the window of the TSM around them is
+        written.
 
-        # TODO: srcData.ReadAsArray() is causing Python to crash. It's probably a gdal/python binding mismatch issue. See if
-        # any hints at https: // trac.osgeo.org / gdal / wiki / PythonGotchas
+        If the ignitions were split between several Farsite runs ( see farsiteRunner), the runs' intensity rasters are
+        max-merged. As a cell burned if its intensity is >= 1, this is the union of the cells burned in each run.
 
-        x = np.array(srcData.ReadAsArray())
-        # Just in case NoDataValue is 0, change to -9999.
-        if srcData.GetRasterBand(1).GetNoDataValue() == 0.0:
-            np.putmask(x, x == 0, -9999)
+        :param stratum_template: The StratumTemplate of the Primary Stratum, which the TSM must match
+        :param src_intensity_filename: The Fire Intensity raster generated by Farsite, or a list of them ( which may be
+            empty). A raster for a window of the Primary Stratum is given as a tuple of ( filename, window). See
+            farsiteRunner.runFarsiteClipped
+        :param ignition_cells: The flat indexes of the ignition cells, or None. See generateIgnitionPoints
+        :param converted_filename: The filename of the TSM raster to create
+        :return: The FireResult
+    '''
 
-            np.putmask(x, x > 0, 0)
+    # DEVNOTE: FUTURE:
+    # Then convert different fire intensities to different fire transition types (will need a crosswalk between continuous
+    # fire intensity and fire transition type - i.e., low, mid high severity).
+    # i. - Generate a spatial multiplier for each fire transition type according to the fire intensity of each cell.
+    # DEVNOTE: END OF FUTURE
 
+    if isinstance(src_intensity_filename, basestring):
+        src_intensity_filename = [src_intensity_filename]
 
-        # we already have the raster with exact parameters that we need
-        # so we use CreateCopy() method instead of Create() to save our time
-        rasterFormat = "GTiff"
-        driver = gdal.GetDriverByName(rasterFormat)
-        destData = driver.CreateCopy(dest_filename, srcData, 0)
-        band = destData.GetRasterBand(1)
-        # Change NoDataValue  to -9999.
-        band.SetNoDataValue(-9999)
-        band.WriteArray(x)
-        logging.debug('Created new Zero Value Raster "{0}"'.format(dest_filename))
-        destData = None
-        srcData = None
+    fire_result = FireResult(stratum_template, ignition_cells)
+    for filename in src_intensity_filename:
+        window = None
+        if isinstance(filename, tuple):
+            filename, window = filename
+        fire_result = fire_result.merge(readFireIntensity(stratum_template, filename, window=window))
+    fire_result = fire_result.mask()
+    fire_result.writeTsm(converted_filename)
 
-    finally:
-        # Clean up the temp files
-        shutil.rmtree(tmp_dir)
-        pass
+    logging.debug('Created new Farsite TSM Raster "{0}", with {1} burned cells'.format(converted_filename,
+                                                                                   fire_result.getNumBurned()))
+    return fire_result
 
 
-def createOneValRaster(dest_filename, source_filename):
+def getOgrDriver(name):
     '''
-        Create a One value raster, using the same characteristics as the source file ( num_rows, num_cols,...)
+        Get the OGR vector driver with the specified name. Drivers are looked up once, and reused for the rest of the run.
     '''
+    driver = _ogr_drivers.get(name)
+    if driver is None:
+        driver = ogr.GetDriverByName(name)
+        if driver is None:
+            logging.error("OGR driver '{0}' is not available".format(name))
+            sys.exit(1)
+        _ogr_drivers[name] = driver
 
-    # Delete the file it is exists
-    if os.path.exists(dest_filename):
-        os.remove(dest_filename)
+    return driver
 
-    gdal.UseExceptions()
-    srcData = gdal.Open(source_filename, gdal.GA_ReadOnly)
-    if srcData is None:
-        logging.error("Cannot open Source Raster file '{0}'".format(source_filename))
-        sys.exit(1)
 
-    # TODO: srcData.ReadAsArray() is causing Python to crash. It's probably a gdal/python binding mismatch issue. See if
-    # any hints at https: // trac.osgeo.org / gdal / wiki / PythonGotchas
+def copyRaster(src_raster, dest_filename, data_type, raster_format = "GTiff"):
+    '''
+        Copy the raster to a new raster of the specified data type. The in-process equivalent of
+        gdal_translate -ot <data_type> -of <raster_format>
+
+        :param src_raster: The open GDAL dataset to copy
+        :param dest_filename: The filename of the new raster ( '' for the MEM format)
+        :param data_type: The GDAL data type of the new raster. ie GDT_Int32
+        :param raster_format: The GDAL driver name for the new raster
+        :return: The new GDAL dataset
+    '''
+
+    driver = getDriver(raster_format)
+    dest_raster = driver.Create(dest_filename, src_raster.RasterXSize, src_raster.RasterYSize, src_raster.RasterCount,
+                                data_type)
+    dest_raster.SetGeoTransform(src_raster.GetGeoTransform())
+    dest_raster.SetProjection(src_raster.GetProjectionRef())
+
+    for i in range(1, src_raster.RasterCount + 1):
+        src_band = src_raster.GetRasterBand(i)
+        dest_band = dest_raster.GetRasterBand(i)
+        no_data_value = src_band.GetNoDataValue()
+        if no_data_value is not None:
+            dest_band.SetNoDataValue(no_data_value)
+        dest_band.WriteArray(src_band.ReadAsArray())
 
-    x = np.array(srcData.ReadAsArray())
-    np.putmask(x, x > 0, 1)
+    return dest_raster
 
-    # we already have the raster with exact parameters that we need
-    # so we use CreateCopy() method instead of Create() to save our time
-    rasterFormat = "GTiff"
-    driver = gdal.GetDriverByName(rasterFormat)
-    destData = driver.CreateCopy(dest_filename, srcData, 0)
-    destData.GetRasterBand(1).WriteArray(x)
-    logging.debug('Created new One-value Raster "{0}"'.format(dest_filename))
-    destData = None
-    srcData = None
 
-def convertFireIntensityRaster(reference_raster_filename, src_intensity_filename, src_ignitions_filename, converted_filename):
+def removeRasterFile(filename):
     '''
-        Convert the Fire Intensity Raster generated by Farsite into a Transition Spatial Multiplier (TSM)
-        raster suitable for import into Syncrosim. Use the Fire ignitions raster to mask the intensity.
+        Remove the raster file, along with the .aux.xml file GDAL may have written alongside it.
     '''
+    for fn in [filename, filename + '.aux.xml']:
+        if os.path.exists(fn):
+            os.remove(fn)
 
-    # DEVNOTE: FUTURE:
-    # Then convert different fire intensities to different fire transition types (will need a crosswalk between continuous
-    # fire intensity and fire transition type - i.e., low, mid high severity).
-    # i. - Generate a spatial multiplier for each fire transition type according to the fire intensity of each cell.
-    # DEVNOTE: END OF FUTURE
 
-    reference_raster = gdal.Open(reference_raster_filename, gdal.GA_ReadOnly)
-    if reference_raster is None:
-        logging.error("Cannot open Farsite Reference Raster file '{0}'".format(reference_raster_filename))
-        sys.exit(1)
+def convertToAAIGrid(src_filename, filename_asc = None):
+    # We need to convert tif -> ASC before we can use them in LCPMake
+    if filename_asc is None:
+        filename_asc = src_filename.replace('.tif', '.asc')
+    logging.debug('Converting "{0}" to AAIGrid "{1}"'.format(src_filename, filename_asc))
 
-    cols = reference_raster.RasterXSize
-    rows = reference_raster.RasterYSize
-    # reference_raster = None
+    gdal.UseExceptions()
+    src_raster = gdal.Open(src_filename, gdal.GA_ReadOnly)
+    if src_raster is None:
+        logging.error("Cannot open Source Raster file '{0}'".format(src_filename))
+        sys.exit(1)
 
-    intensity_raster = gdal.Open(src_intensity_filename, gdal.GA_ReadOnly)
-    if intensity_raster is None:
-        logging.error("Cannot open Farsite Fire Intensity Raster file '{0}'".format(src_intensity_filename))
+    dest_raster = getDriver("AAIGrid").CreateCopy(filename_asc, src_raster, 0)
+    if dest_raster is None:
+        logging.error("Error converting '{0}' to AAIGrid".format(src_filename))
         sys.exit(1)
 
-    raster_intensity = intensity_raster.ReadAsArray()
-    x = np.array(raster_intensity)
-    if (rows ,cols) != x.shape :
-        xrows, xcols = x.shape
-        logging.warning(
-            "The Fire Intensity raster was not of the expected size ({},{}) vs ({},{}).".format(
-                xrows, xcols, rows, cols))
-        if cols > xcols:
-            logging.warning("Resizing Fire Intensity raster by adding columns.")
-            x = np.hstack((x, np.zeros((x.shape[0], cols - xcols), dtype=x.dtype)))
-        else:
-            logging.error("Unable to process existing Fire Intensity raster")
-            sys.exit(1)
+    dest_raster = None
+    src_raster = None
 
-    # Convert cell value > 0 to 1. Any other value, including NO_DATA_VALUE,  = 0
-    np.putmask(x, x > 1, 1)
-    np.putmask(x, x < 0, 0)
+    return filename_asc
 
-    # Mask the Intensity raster with the Ignitions raster
-    ignition_raster = gdal.Open(src_ignitions_filename, gdal.GA_ReadOnly)
-    if ignition_raster is None:
-        logging.error("Cannot open Farsite Fire Ignitions Raster file '{0}'".format(src_ignitions_filename))
+def getGridMetadata(filename):
+    '''
+        Get the grid metadata of the specified raster, reading only its header.
+
+        :return: A list of [cols, rows, geotransform]
+    '''
+    gdal.UseExceptions()
+    raster = gdal.Open(filename, gdal.GA_ReadOnly)
+    if raster is None:
+        logging.error("Cannot open Source Raster file '{0}'".format(filename))
         sys.exit(1)
-    raster_ignitions = ignition_raster.ReadAsArray()
-    y = np.array(raster_ignitions)
-
-    if (rows ,cols) != y.shape :
-        yrows, ycols = y.shape
-        logging.warning(
-            "The Fire Ignitions raster was not of the expected size ({},{}) vs ({},{}).".format(
-                yrows, ycols, rows, cols))
-        if cols > ycols:
-            logging.warning("Resizing Fire Ignitions raster by adding columns.")
-            y = np.hstack((y, np.zeros((y.shape[0], cols - ycols), dtype=y.dtype)))
-        else:
-            logging.error("Unable to process existing Fire Ignitions raster")
-            sys.exit(1)
 
+    return [raster.RasterXSize, raster.RasterYSize, list(raster.GetGeoTransform())]
 
-    # Test that the Ignition  and Intensity raster as the same size - we've seen cases where Farsite produces slightly mismatched
-    # raster size, resulting in putmask cratering
-    if x.size <> y.size:
-        logging.warning("The Fire Intensity and Ignition rasters are different sizes.")
-        sys.exit(1)
 
-    # Set any ignitions pts in the massaged intensity raster
-    np.putmask(x, y>=1 ,1)
+def convertToInt32(src_filename, dest_filename):
 
-    # we already have the raster with exact parameters that we need, in the reference raster. Cant use createCopy becuase of the change
-    # band size different
-    # Refer to array2raster(rasterfn,newRasterfn,array) in https://pcjericks.github.io/py-gdalogr-cookbook/raster_layers.html
-    geotransform = reference_raster.GetGeoTransform()
-    originX = geotransform[0]
-    originY = geotransform[3]
-    pixelWidth = geotransform[1]
-    pixelHeight = geotransform[5]
+    logging.debug('Converting "{0}" to Int32 "{1}"'.format(src_filename, dest_filename))
 
-    rasterFormat = "GTiff"
-    driver = gdal.GetDriverByName(rasterFormat)
-    outRaster = driver.Create(converted_filename, cols, rows, 1, GDT_Int32)
-    outRaster.SetGeoTransform((originX, pixelWidth, 0, originY, 0, pixelHeight))
-    outband = outRaster.GetRasterBand(1)
-    outband.WriteArray(x)
-    outband.SetNoDataValue(-9999)
-    outRasterSRS = osr.SpatialReference()
-    outRasterSRS.ImportFromWkt(reference_raster.GetProjectionRef())
-    outRaster.SetProjection(outRasterSRS.ExportToWkt())
-    outband.FlushCache()
+    gdal.UseExceptions()
+    src_raster = gdal.Open(src_filename, gdal.GA_ReadOnly)
+    if src_raster is None:
+        logging.error("Cannot open Source Raster file '{0}'".format(src_filename))
+        sys.exit(1)
 
-    logging.debug('Created new Farsite TSM Raster "{0}"'.format(converted_filename))
+    dest_raster = copyRaster(src_raster, dest_filename, GDT_Int32)
+    dest_raster.FlushCache()
+    dest_raster = None
+    src_raster = None
 
+    return dest_filename
 
-def convertToAAIGrid(src_filename):
-    # We need to convert tif -> ASC before we can use them in LCPMake
-    filename_asc = src_filename.replace('.tif', '.asc')
-    cmdLine = 'gdal_translate -of "AAIGrid" "{0}" "{1}"'.format(src_filename,filename_asc)
-    logging.debug(cmdLine)
-    proc = subprocess.call(cmdLine)
-    if proc <> 0:
-        logging.error("Error calling gdal_translate:{0}".format(cmdLine))
-        sys.exit(1)
 
-    return filename_asc
+def generateIgnitionPoints(stratum_template, ignition_pts_shapefile, num_ignitions, ignition_distribution = None):
+    """
+        Create a new Point shapefile containing randomly placed Ignition points, within the valid (non NoData) cells of
+        the Primary Stratum. See sampleIgnitionPoints
+
+    @param stratum_template: The StratumTemplate of the Primary Stratum
+    @param ignition_pts_shapefile: The filename of the output file containing the ignition points.
+    @param num_ignitions: The number of ignition points to create
+    @param ignition_distribution: (Optional) The IgnitionDistribution to weight the ignitions by
+    @return: The flat indexes of the ignition cells
+    """
 
-def convertToInt32(src_filename, dest_filename):
+    ignition_cells, x, y = sampleIgnitionPoints(stratum_template, num_ignitions, ignition_distribution)
 
-    filename_asc = src_filename.replace('.tif', '.asc')
-    cmdLine = 'gdal_translate -ot "Int32" "{0}" "{1}"'.format(src_filename,dest_filename)
-    logging.debug(cmdLine)
-    proc = subprocess.call(cmdLine)
-    if proc <> 0:
-        logging.error("Error calling gdal_translate:{0}".format(cmdLine))
-        sys.exit(1)
+    createIgnitionPtFile(x, y, getStratumSpatialReference(stratum_template), ignition_pts_shapefile)
+    logging.info('Created Ignition Point file "{0}" with {1} points'.format(ignition_pts_shapefile,num_ignitions))
 
-    return dest_filename
+    return ignition_cells
 
 
-def generateIgnitionPoints(barrier_raster_file, ignition_pts_shapefile, num_ignitions ):
+def sampleIgnitionPoints(stratum_template, num_ignitions, ignition_distribution = None):
+    """
+        Randomly place Ignition points within the valid (non NoData) cells of the Primary Stratum.
 
-    # Generate a boundary file from the specified raster
+        The ignition cells are drawn all at once, either uniformly from the stratum template's index of valid cells, or
+        from the ignition distribution if there is one, and each point is placed randomly within its cell. As only valid
+        cells can be drawn, there's no need to polygonize the stratum and reject the points that fall outside it.
 
-    tmp_dir = tempfile.mkdtemp()
+    @param stratum_template: The StratumTemplate of the Primary Stratum
+    @param num_ignitions: The number of ignition points to create
+    @param ignition_distribution: (Optional) The IgnitionDistribution to weight the ignitions by
+    @return: A tuple of the flat indexes of the ignition cells, and the X and Y coordinates of the points
+    """
 
-    try:
-        # 1st create a zero value raster with the same characteristics as the specified raster
-        zv_raster = os.path.join(tmp_dir, "zv_raster.tif")
-        createZeroValRaster( zv_raster,barrier_raster_file)
-
-        # gdal_polygonize
-        boundary_file = os.path.join(tmp_dir, "boundary.shp")
-
-        cmdLine = 'gdal_polygonize.bat "{0}" "{1}" -f "ESRI Shapefile"'.format(zv_raster, boundary_file)
-        logging.debug(cmdLine)
-        proc = subprocess.call(cmdLine)
-        if proc <> 0:
-            logging.error("Error calling gdal_polygonize:{0}".format(cmdLine))
+    if ignition_distribution:
+        ignition_cells = ignition_distribution.sample(num_ignitions)
+    else:
+        cells = stratum_template.getValidCells()
+        if len(cells) == 0:
+            logging.error('Cannot place Ignition points, as the Primary Stratum has no valid cells')
             sys.exit(1)
 
-        # OK, we've got our boundary file, so lets generate some random points
-        createIgnitionPtFile(boundary_file,ignition_pts_shapefile,num_ignitions)
-        logging.info('Created Ignition Point file "{0}" with {1} points'.format(ignition_pts_shapefile,num_ignitions))
+        ignition_cells = cells[np.random.choice(len(cells), num_ignitions)]
+    x, y = stratum_template.getCellPoints(ignition_cells, jitter=True)
 
-    finally:
-        # Clean up the temp files
-        shutil.rmtree(tmp_dir)
-        pass
+    return ignition_cells, x, y
 
-def createIgnitionPtFile(boundary_fn, ignition_points_fn, num_ignition_points):
+
+def getStratumSpatialReference(stratum_template):
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(stratum_template.projection)
+    return srs
+
+
+def createIgnitionPtFile(x, y, srs, ignition_points_fn):
     """
-        Create a new Point Layer containing Randomly placed Ignition points, within the constraints of the Boundary file
+        Create a new Point shapefile containing the specified Ignition points
 
-    @param boundary_fn: The file name of the Boundary shapefile
+    @param x: The X coordinates of the points
+    @param y: The Y coordinates of the points
+    @param srs: The spatial reference of the points
     @param ignition_points_fn: The filename of the output file containing the ignition points.
     @return:
     """
 
-    inputDs = ogr.Open(boundary_fn)
-    if not inputDs:
-        logging.error(("Unable to open input boundary file '{0}'".format(boundary_fn)))
-        sys.exit(1)
-
-    inputLyr = inputDs.GetLayer()
-    inpSRS = inputLyr.GetSpatialRef()
-    (minx, maxx, miny, maxy) = inputLyr.GetExtent()
-
-    shpdriver = ogr.GetDriverByName('ESRI Shapefile')
+    shpdriver = getOgrDriver('ESRI Shapefile')
     if os.path.exists(ignition_points_fn):
         shpdriver.DeleteDataSource(ignition_points_fn)
 
@@ -598,115 +811,86 @@ def createIgnitionPtFile(boundary_fn, ignition_points_fn, num_ignition_points):
         logging.error('Creation of Ignition Points file "{}" failed'.format(ignition_points_fn))
         sys.exit(1)
 
-    pts_lyr = output_ds.CreateLayer('Ignition Points', geom_type=ogr.wkbPoint, srs=inpSRS)
+    pts_lyr = output_ds.CreateLayer('Ignition Points', geom_type=ogr.wkbPoint, srs=srs)
     if pts_lyr is None:
         logging.error("Layer creation failed.")
         sys.exit(1)
 
     featureDefn = pts_lyr.GetLayerDefn()
-    num_created_pts = 0
-    while num_created_pts < num_ignition_points:
+    for pt_x, pt_y in zip(x, y):
         ign_pt = ogr.Geometry(ogr.wkbPoint)
-        ign_pt.SetPoint_2D(0,random.uniform(minx, maxx), random.uniform(miny, maxy))
-
-        # Make sure the new proposed point falls within valid area of Boundary shapefile
-        inputLyr.SetSpatialFilter(ign_pt)
-        if inputLyr.GetFeatureCount()==0:
-            logging.debug('Skipped creating a Ignition point because outside of Boundary layer')
-            continue
+        ign_pt.SetPoint_2D(0, float(pt_x), float(pt_y))
 
-        num_created_pts +=1
         outFeature = ogr.Feature(featureDefn)
         outFeature.SetGeometry(ign_pt)
         pts_lyr.CreateFeature(outFeature)
 
         outFeature.Destroy()
 
-    # TODO: Create a PRJ file for this shapefile
-    # pu.createPrjFile(ignition_points_fn,inpSRS)
-
-    inputLyr = None
-    inputDs = None
-
     pts_lyr = None
     output_ds = None
 
 
-def compareRasterRowsCols(reference_raster_filename, comparison_raster_filename):
+def compareRasterRowsCols(reference_raster_filename, comparison_raster_filename, header_cache = None):
     """
         Verify that the raster file specified has the same number of rows and columns as the reference raster.
 
     @param reference_raster_filename: The filename of the raster we're using as reference
     @:param comparison_raster_filename: The filename of the raster we're comparing the reference to
+    @:param header_cache: (Optional) The RasterHeaderCache to read the reference raster's header thru
     @return: True is rows and cols the same
     """
 
-    gdal.UseExceptions()
-    raster = gdal.Open(reference_raster_filename, gdal.GA_ReadOnly)
-    if raster is None:
-        logging.error("Cannot open Reference Raster file '{0}'".format(reference_raster_filename))
-        sys.exit(1)
-
-    num_rows = raster.RasterYSize
-    num_cols = raster.RasterXSize
-    raster = None
-
-    raster = gdal.Open(comparison_raster_filename, gdal.GA_ReadOnly)
-    if raster is None:
-        errMsg = "Cannot open Comparison Raster file '{0}'".format(comparison_raster_filename)
-        logging.error(errMsg)
-        sys.exit(errMsg)
+    if header_cache is None:
+        header_cache = RasterHeaderCache(None)
 
-    if num_rows != raster.RasterYSize :
-        return False
+    reference = header_cache.get(reference_raster_filename)
+    comparison = header_cache.get(comparison_raster_filename, remember=False)
 
-    if num_cols != raster.RasterXSize:
-        return False
+    return reference['rows'] == comparison['rows'] and reference['cols'] == comparison['cols']
 
-    return True
 
-def verifyRasterMetadata(config):
+def verifyRasterMetadata(config, header_cache = None, files = None):
     """
         Verify that the raster file specified in the config object have sufficiently matching metadata. If not, do a sys.exit()
 
+        The headers of the Primary Stratum and terrain rasters are read thru the header cache, so after the first
+        timestep of a run they're verified without opening them. Any other files are read, but not cached.
+
     @param config: The configuration object, containing the file names for all the input files
+    @param header_cache: (Optional) The RasterHeaderCache to read the raster headers thru
+    @param files: (Optional) The rasters to verify against the Primary Stratum. Defaults to the terrain rasters.
     @return:
     """
 
     logging.info("Verifying Raster Metadata...")
 
-    gdal.UseExceptions()
-    raster = gdal.Open(config.primaryStratumFile, gdal.GA_ReadOnly)
-    if raster is None:
-        logging.error("Cannot open Source Raster file '{0}'".format(config.primaryStratumFile))
-        sys.exit(1)
+    if header_cache is None:
+        header_cache = RasterHeaderCache(None)
+
+    terrain_files = [config.aspect_raster_file, config.elevation_raster_file, config.slope_raster_file]
+    if files is None:
+        files = terrain_files
 
-    num_rows = raster.RasterYSize
-    num_cols = raster.RasterXSize
-    geotransform = raster.GetGeoTransform()
+    reference = header_cache.get(config.primaryStratumFile)
+    num_rows = reference['rows']
+    num_cols = reference['cols']
+    geotransform = reference['geotransform']
     originX = geotransform[0]
     originY = geotransform[3]
     pixelWidth = geotransform[1]
     pixelHeight = geotransform[5]
 
-    raster = None
-
-    files = [config.aspect_raster_file, config.elevation_raster_file, config.slope_raster_file]
     for file in files:
-        raster = gdal.Open(file, gdal.GA_ReadOnly)
-        if raster is None:
-            errMsg = "Cannot open Source Raster file '{0}'".format(config.primaryStratumFile)
-            logging.error(errMsg)
-            sys.exit(errMsg)
+        header = header_cache.get(file, remember=file in terrain_files)
+        geotransform = header['geotransform']
 
-        geotransform = raster.GetGeoTransform()
-
-        if num_rows != raster.RasterYSize:
+        if num_rows != header['rows']:
             errMsg = "The raster '{0}' does not match the Number of Rows of the Primary Stratum raster specified in Initial Conditions Spatial.".format(file)
             logging.error(errMsg)
             sys.exit(errMsg)
 
-        if num_cols != raster.RasterXSize:
+        if num_cols != header['cols']:
             errMsg ="The raster '{0} does not match the Number of Columns of the Primary Stratum raster specified in Initial Conditions Spatial.".format(file)
             logging.error(errMsg)
             sys.exit(errMsg)
@@ -740,14 +924,14 @@ def verifyRasterMetadata(config):
             logging.error(errMsg)
             sys.exit(errMsg)
 
+    header_cache.save()
+
 def cleanRuntimeFiles(farsite_output_dir):
     shutil.rmtree(farsite_output_dir)
 
 if __name__ == '__main__':
     pass
     # Test
-    # createIgnitionPtFile('D:/ApexRMS/A165/FarsiteSTSim/Test Data/STSim/Small Testing Library/FarsiteTesting.ssim.input/Scenario-1/STSim_InitialConditionsSpatial/sqaushed2.shp',
-    #                      'd:/temp/test1.shp',1000)
 
     # convertFireIntensityRaster("D:\ApexRMS\Syncrosim Data File\BuffleTest\Buffelgrass.ssim.input\Scenario-1190\STSim_InitialConditionsSpatial\RMD_Strata_QuarterHa_Filt100.tif",
     # "D:\ApexRMS\Syncrosim Data File\BuffleTest\Buffelgrass.ssim.output\Scenario-1186\Spatial\Farsite\It0001-Ts2015-FARSITE_Intensity.asc",
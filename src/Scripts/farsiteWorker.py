@@ -0,0 +1,313 @@
+﻿# coding=utf-8
+import binascii
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+from syncrosim import writeJsonFile
+
+# Set to Yes in the FARSITE Environment to run the timesteps in a warm worker process
+ENV_FARSITE_WORKER = 'SSIM_FARSITE_WORKER'
+
+# How long (secs) the worker waits for another timestep before shutting down. Set in the FARSITE Environment to override
+ENV_FARSITE_WORKER_IDLE_SECONDS = 'SSIM_FARSITE_WORKER_IDLE_SECONDS'
+DEFAULT_WORKER_IDLE_SECONDS = 300
+
+# Name of the file, in SSIM_TEMP_DIRECTORY, holding the address and key of the scenario's worker
+WORKER_FILENAME = 'FarsiteWorker.json'
+
+# Log of the worker's console output, in the Scripts directory
+WORKER_LOG_FILENAME = 'farsiteWorker.log'
+
+# How long (secs) to wait for a newly started worker to start listening, and for a worker to accept a connection
+WORKER_START_TIMEOUT = 120
+WORKER_ACCEPT_TIMEOUT = 10
+
+# Windows process creation flags, so that the worker outlives the timestep that started it
+DETACHED_PROCESS = 0x00000008
+CREATE_NEW_PROCESS_GROUP = 0x00000200
+
+
+def isWorkerEnabled():
+    return os.environ.get(ENV_FARSITE_WORKER, '').upper() == 'YES'
+
+
+def getWorkerFilename(temp_dir):
+    return os.path.join(temp_dir, WORKER_FILENAME)
+
+
+def getIdleSeconds():
+    try:
+        return float(os.environ.get(ENV_FARSITE_WORKER_IDLE_SECONDS, DEFAULT_WORKER_IDLE_SECONDS))
+    except ValueError:
+        logging.warning('Ignoring the invalid FARSITE Environment {0} "{1}"'.format(
+            ENV_FARSITE_WORKER_IDLE_SECONDS, os.environ[ENV_FARSITE_WORKER_IDLE_SECONDS]))
+        return DEFAULT_WORKER_IDLE_SECONDS
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Client, run by farsite.py for each timestep. This only needs the standard library, so it's cheap to start.
+
+def runInWorker(argv):
+    '''
+        Run the current timestep in the scenario's worker process, starting the worker if it isn't already running.
+        The worker's log of the timestep is echoed to the console, so it ends up in the run log as usual.
+
+        :return: The exit code of the timestep, or None if the worker couldn't be reached, in which case the timestep
+            should be run in this process instead
+    '''
+    temp_dir = os.environ['SSIM_TEMP_DIRECTORY']
+
+    conn = connectWorker(temp_dir)
+    if conn is None:
+        logging.info('Starting the Farsite worker...')
+        conn = waitForWorker(temp_dir, startWorker(temp_dir))
+        if conn is None:
+            logging.warning('Could not start the Farsite worker, so running the timestep in this process.')
+            return None
+
+    try:
+        conn.send({'request': 'run',
+                   'argv': argv,
+                   'environ': dict((name, val) for name, val in os.environ.items() if name.startswith('SSIM_')),
+                   'cwd': os.getcwd()})
+        reply = conn.recv()
+    except (EOFError, IOError) as ex:
+        logging.error('Lost the connection to the Farsite worker: {0}. See "{1}"'.format(ex, WORKER_LOG_FILENAME))
+        return 1
+    finally:
+        conn.close()
+
+    for line in reply['log']:
+        sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+    return reply['exit_code']
+
+
+def connectWorker(temp_dir):
+    '''
+        Connect to the scenario's worker, and wait for it to accept the connection.
+
+        :return: The connection, or None if there is no worker listening. Any stale worker file is removed.
+    '''
+    worker_filename = getWorkerFilename(temp_dir)
+    try:
+        with open(worker_filename, 'r') as f:
+            worker = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    try:
+        conn = Client(str(worker['address']), authkey=str(worker['authkey']))
+    except (IOError, OSError, EOFError, AuthenticationError, KeyError):
+        logging.debug('Removing the stale Farsite worker file "{0}"'.format(worker_filename))
+        removeWorkerFile(worker_filename, worker.get('pid'))
+        return None
+
+    # The worker acknowledges the connection once it's committed to handling it, so it won't shut down under us
+    try:
+        if conn.poll(WORKER_ACCEPT_TIMEOUT) and conn.recv().get('status') == 'ready':
+            return conn
+    except (IOError, EOFError):
+        pass
+
+    conn.close()
+    return None
+
+
+def startWorker(temp_dir):
+    '''
+        Start a worker for the scenario, detached from the current timestep.
+
+        :return: The Popen of the worker
+    '''
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    log = open(os.path.join(scripts_dir, WORKER_LOG_FILENAME), 'a')
+    try:
+        if sys.platform == 'win32':
+            # DEVNOTE: Handles can't be redirected with close_fds on Windows. Nothing the worker inherits stops
+            # StartProcess from returning once the timestep's python.exe exits.
+            return subprocess.Popen([sys.executable, os.path.abspath(__file__), temp_dir], cwd=scripts_dir,
+                                    stdin=open(os.devnull, 'r'), stdout=log, stderr=subprocess.STDOUT,
+                                    creationflags=DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP)
+
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), temp_dir], cwd=scripts_dir,
+                                stdin=open(os.devnull, 'r'), stdout=log, stderr=subprocess.STDOUT, close_fds=True)
+    finally:
+        log.close()
+
+
+def waitForWorker(temp_dir, proc, timeout = WORKER_START_TIMEOUT):
+    '''
+        Wait for a newly started worker to start listening, and connect to it.
+
+        :return: The connection, or None if the worker exited or didn't start listening in time
+    '''
+    give_up = time.time() + timeout
+    while time.time() < give_up:
+        conn = connectWorker(temp_dir)
+        if conn is not None:
+            return conn
+
+        if proc.poll() is not None:
+            logging.warning('The Farsite worker exited with {0}. See "{1}"'.format(proc.returncode, WORKER_LOG_FILENAME))
+            return None
+
+        time.sleep(0.25)
+
+    return None
+
+
+def removeWorkerFile(worker_filename, pid):
+    '''
+        Remove the worker file, if it's still for the specified worker
+    '''
+    try:
+        with open(worker_filename, 'r') as f:
+            if json.load(f).get('pid') == pid:
+                os.remove(worker_filename)
+    except (IOError, OSError, ValueError):
+        pass
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Worker
+
+class LogRecorder(logging.Handler):
+    '''
+        Records the log of a timestep, to send back to the client.
+    '''
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        self.lines = []
+
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+class Worker:
+    '''
+        A long lived process that runs the timesteps of a scenario, so that numpy and GDAL are only imported, and the
+        Config snapshot and the other per-process caches only loaded, once rather than for every timestep.
+
+        The worker listens on a local named pipe ( a Unix domain socket elsewhere), whose address and key are kept in
+        the scenario's temp directory for the clients to find. It handles a timestep at a time, and shuts down once it's
+        been idle for a while, or when the temp directory is removed at the end of the run.
+    '''
+
+    def __init__(self, temp_dir, idle_seconds):
+        self.temp_dir = temp_dir
+        self.idle_seconds = idle_seconds
+        self.worker_filename = getWorkerFilename(temp_dir)
+        self.busy = False
+        self.last_active = time.time()
+        self.lock = threading.Lock()
+
+
+    def serve(self):
+        import farsite
+        farsite.setupLogging()
+
+        # Warm up the expensive imports before the first timestep arrives
+        import numpy, gdal, farsiteUtils, farsiteRunner, fireResult, rasterCache
+
+        authkey = binascii.hexlify(os.urandom(16))
+        listener = Listener(authkey=authkey)
+        writeJsonFile(self.worker_filename, {'pid': os.getpid(), 'address': listener.address, 'authkey': authkey})
+        logging.info('Farsite worker {0} listening on "{1}" for "{2}"'.format(os.getpid(), listener.address,
+                                                                            self.temp_dir))
+
+        watchdog = threading.Thread(target=self.watch)
+        watchdog.daemon = True
+        watchdog.start()
+
+        while True:
+            try:
+                conn = listener.accept()
+            except (IOError, EOFError, AuthenticationError) as ex:
+                logging.warning('Farsite worker rejected a connection: {0}'.format(ex))
+                continue
+
+            with self.lock:
+                self.busy = True
+            try:
+                conn.send({'status': 'ready'})
+                conn.send(self.run(farsite, conn.recv()))
+            except (IOError, EOFError) as ex:
+                logging.warning('Farsite worker lost the connection to its client: {0}'.format(ex))
+            finally:
+                conn.close()
+                with self.lock:
+                    self.busy = False
+                    self.last_active = time.time()
+
+
+    def run(self, farsite, request):
+        '''
+            Run a timestep, in the client's environment.
+
+            :return: The reply to the client
+        '''
+        for name in [name for name in os.environ if name.startswith('SSIM_')]:
+            del os.environ[name]
+        os.environ.update(request['environ'])
+        os.chdir(request['cwd'])
+
+        recorder = LogRecorder()
+        logging.getLogger('').addHandler(recorder)
+        try:
+            farsite.runTimestep(request['argv'])
+            logging.info('Successful completion of script.')
+            exit_code = 0
+        except SystemExit as ex:
+            exit_code = ex.code if isinstance(ex.code, int) else (0 if ex.code is None else 1)
+        except Exception:
+            # The same as running the timestep in the client, which logs the exception and carries on
+            logging.exception("message")
+            exit_code = 0
+        finally:
+            logging.getLogger('').removeHandler(recorder)
+
+        return {'exit_code': exit_code, 'log': recorder.lines}
+
+
+    def watch(self):
+        '''
+            Shut the worker down once it's idle, or the run has ended.
+        '''
+        while True:
+            time.sleep(min(self.idle_seconds, 5))
+            with self.lock:
+                if self.busy:
+                    continue
+
+                if not os.path.exists(self.temp_dir):
+                    logging.info('Farsite worker shutting down, as the run has ended.')
+                    self.shutdown()
+
+                if time.time() - self.last_active > self.idle_seconds:
+                    logging.info('Farsite worker shutting down, after {0} secs idle.'.format(self.idle_seconds))
+                    self.shutdown()
+
+
+    def shutdown(self):
+        removeWorkerFile(self.worker_filename, os.getpid())
+        logging.shutdown()
+
+        # DEVNOTE: Exit without waiting on the listener thread, which is blocked in accept
+        os._exit(0)
+
+
+if __name__ == '__main__':
+
+    Worker(sys.argv[1], getIdleSeconds()).serve()
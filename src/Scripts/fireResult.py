@@ -0,0 +1,246 @@
+﻿import logging
+import os
+import shutil
+import sys
+
+import gdal
+import numpy as np
+
+from lcpWriter import ROW_BLOCK_SIZE
+from rasterCache import TSM_DTYPE, TSM_NO_DATA_VALUE, buildTsmOverviews
+
+# The Farsite outputsType for ASCII grids. See farsiteUtils.createFarsiteCommandFile
+# DEVNOTE: Farsite can also write FlamMap binary grids ( outputsType 2), but their layout isn't verified against a grid
+# written by TestFARSITE, so only ASCII grids are requested and read
+FARSITE_OUTPUT_ASCII = 1
+
+# Extension of the ASCII grids written by Farsite
+FARSITE_ASCII_GRID_EXTENSION = '.asc'
+
+
+class FireResult:
+    '''
+        The cells burned by a Farsite run, held sparsely as the sorted flat ( row * cols + col) indexes of the burned
+        cells of the Primary Stratum grid.
+
+        A fire usually burns only a small part of the landscape, so masking, merging and the statistics all work on the
+        burned cells, and the result is only made dense when it's written out as a TSM. Even then, only the row blocks
+        with burned cells are written, into a copy of the stratum's pre-initialized zero value TSM.
+    '''
+
+    def __init__(self, stratum_template, cells = None):
+        '''
+            :param stratum_template: The StratumTemplate of the Primary Stratum
+            :param cells: (Optional) The flat indexes of the burned cells, in any order, and possibly repeated
+        '''
+        self.stratum_template = stratum_template
+        if cells is None:
+            self.cells = np.empty(0, dtype=np.int64)
+        else:
+            self.cells = np.unique(np.asarray(cells, dtype=np.int64))
+
+
+    def getNumBurned(self):
+        return len(self.cells)
+
+
+    def getBurnedArea(self):
+        '''
+            :return: The burned area, in the square map units of the Primary Stratum
+        '''
+        gt = self.stratum_template.geotransform
+        return len(self.cells) * abs(gt[1] * gt[5] - gt[2] * gt[4])
+
+
+    def merge(self, other):
+        '''
+            :return: A new FireResult with the cells burned in either this or the other fire
+        '''
+        return FireResult(self.stratum_template, np.union1d(self.cells, other.cells))
+
+
+    def mask(self):
+        '''
+            :return: A new FireResult with only the burned cells that are valid ( not NoData) in the Primary Stratum
+        '''
+        return FireResult(self.stratum_template, self.cells[self.stratum_template.isValid(self.cells)])
+
+
+    def writeTsm(self, dest_filename, block_rows = ROW_BLOCK_SIZE):
+        '''
+            Write the fire as a TSM, with 1 in the burned cells, 0 in the other valid cells and NoData elsewhere.
+
+            Only the blocks of rows with burned cells are written, each across the columns burned in it. Fires far apart
+            don't make the write span the landscape between them, and the memory used is at most a few blocks.
+
+            :param block_rows: The number of rows in each block
+        '''
+        shutil.copyfile(self.stratum_template.getZeroTsmFilename(), dest_filename)
+
+        if len(self.cells) == 0:
+            return
+
+        gdal.UseExceptions()
+        raster = gdal.Open(dest_filename, gdal.GA_Update)
+        if raster is None:
+            logging.error('Cannot open TSM raster file "{0}" for update'.format(dest_filename))
+            sys.exit(1)
+
+        band = raster.GetRasterBand(1)
+        cols = self.stratum_template.cols
+        for block in np.unique(self.cells // (block_rows * cols)):
+            row = int(block) * block_rows
+            num_rows = min(block_rows, self.stratum_template.rows - row)
+
+            # The cells are sorted, so the block's burned cells are a slice of them
+            first, last = np.searchsorted(self.cells, [row * cols, (row + num_rows) * cols])
+            burned_rows, burned_cols = np.divmod(self.cells[first:last], cols)
+            col = int(burned_cols.min())
+            num_cols = int(burned_cols.max()) - col + 1
+
+            x = np.full((num_rows, num_cols), TSM_NO_DATA_VALUE, dtype=TSM_DTYPE)
+            x[self.stratum_template.getValidWindow(row, col, num_rows, num_cols)] = 0
+            x[burned_rows - row, burned_cols - col] = 1
+            band.WriteArray(x, col, row)
+
+        band = None
+
+        # DEVNOTE: Any overviews copied with the zero value TSM are now stale
+        buildTsmOverviews(raster)
+        raster = None
+
+
+class GdalGrid:
+    '''
+        Reader for the ASCII grids written by Farsite ( outputsType 1), thru GDAL
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        gdal.UseExceptions()
+        self.raster = gdal.Open(filename, gdal.GA_ReadOnly)
+        if self.raster is None:
+            logging.error("Cannot open Farsite Raster file '{0}'".format(filename))
+            sys.exit(1)
+
+        self.cols = self.raster.RasterXSize
+        self.rows = self.raster.RasterYSize
+        self.band = self.raster.GetRasterBand(1)
+
+
+    def readRows(self, row, num_rows):
+        return self.band.ReadAsArray(0, row, self.cols, num_rows)
+
+
+    def close(self):
+        self.band = None
+        self.raster = None
+
+
+def findFarsiteGrid(output_files_prefix, name):
+    '''
+        Find an ASCII grid output by Farsite.
+
+        :param output_files_prefix: The Farsite output path and files prefix, as given in the command file
+        :param name: The name of the grid. ie 'Intensity'
+        :return: The grid filename, or None if Farsite didn't write it
+    '''
+    filename = '{0}_{1}{2}'.format(output_files_prefix, name, FARSITE_ASCII_GRID_EXTENSION)
+    if os.path.exists(filename):
+        return filename
+
+    return None
+
+
+def isFarsiteGridComplete(filename):
+    '''
+        Check that a grid output by Farsite can be read in full, ie that Farsite wasn't stopped part way thru writing it.
+
+        DEVNOTE: This means GDAL reading its last row, and so parsing the whole grid. It's only needed for the grids of
+        a Farsite process that went over its budget. See farsiteRunner.collectFarsiteGrids
+    '''
+    gdal.UseExceptions()
+    try:
+        raster = gdal.Open(filename, gdal.GA_ReadOnly)
+        if raster is None:
+            return False
+        raster.GetRasterBand(1).ReadAsArray(0, raster.RasterYSize - 1, raster.RasterXSize, 1)
+    except RuntimeError:
+        return False
+    finally:
+        raster = None
+
+    return True
+
+
+def openFarsiteGrid(filename):
+    '''
+        Open a grid output by Farsite, to be read a block of rows at a time.
+    '''
+    return GdalGrid(filename)
+
+
+def readFireIntensity(stratum_template, intensity_filename, ignition_cells = None, block_rows = ROW_BLOCK_SIZE,
+                      window = None):
+    '''
+        Read the burned cells from the Fire Intensity Raster generated by Farsite. A cell burned if its intensity is >= 1.
+        The raster is read a block of rows at a time.
+
+        :param stratum_template: The StratumTemplate of the Primary Stratum, which the intensity raster must match
+        :param intensity_filename: The Fire Intensity raster generated by Farsite. See findFarsiteGrid
+        :param ignition_cells: (Optional) The flat indexes of the ignition cells, which are counted as burned
+        :param block_rows: The number of rows to read at a time
+        :param window: (Optional) The ( row, col, rows, cols) window of the Primary Stratum that the intensity raster
+            covers, if it's not the full extent
+        :return: The FireResult
+    '''
+    if window is None:
+        window = (0, 0, stratum_template.rows, stratum_template.cols)
+    row_offset, col_offset, rows, cols = window
+
+    intensity_grid = openFarsiteGrid(intensity_filename)
+
+    # We've seen cases where Farsite produces a slightly narrower raster, so any missing columns are treated as unburned
+    xcols = intensity_grid.cols
+    xrows = intensity_grid.rows
+    if (rows, cols) != (xrows, xcols):
+        logging.warning(
+            "The Fire Intensity raster was not of the expected size ({},{}) vs ({},{}).".format(
+                xrows, xcols, rows, cols))
+        if cols > xcols and rows == xrows:
+            logging.warning("Resizing Fire Intensity raster by adding columns.")
+        else:
+            logging.error("Unable to process existing Fire Intensity raster")
+            sys.exit(1)
+
+    burned = []
+    clipped = False
+    if ignition_cells is not None:
+        burned.append(np.asarray(ignition_cells, dtype=np.int64))
+
+    for row in range(0, rows, block_rows):
+        num_rows = min(block_rows, rows - row)
+
+        # Any other value, including NO_DATA_VALUE, didn't burn
+        burned_rows, burned_cols = np.nonzero(intensity_grid.readRows(row, num_rows) >= 1)
+        if len(burned_rows):
+            burned.append((burned_rows.astype(np.int64) + row + row_offset) * stratum_template.cols + burned_cols +
+                          col_offset)
+
+            # A fire that reached the edge of a window may have been cut short by it
+            if (row_offset > 0 and row == 0 and burned_rows.min() == 0) or \
+                    (row_offset + rows < stratum_template.rows and burned_rows.max() + row == rows - 1) or \
+                    (col_offset > 0 and burned_cols.min() == 0) or \
+                    (col_offset + cols < stratum_template.cols and burned_cols.max() == cols - 1):
+                clipped = True
+
+    intensity_grid.close()
+
+    if clipped:
+        logging.warning('The fire in "{0}" reached the edge of its clip window, so may have been cut short'.format(
+            intensity_filename))
+
+    if burned:
+        return FireResult(stratum_template, np.concatenate(burned))
+    return FireResult(stratum_template)
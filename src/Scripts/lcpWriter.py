@@ -0,0 +1,270 @@
+﻿"""
+    Native writer for the FARSITE landscape (.LCP) file, replacing the round trip thru ASCII grids and lcpmake.exe.
+
+    An LCP file is a 7316 byte header, followed by the cell values as little-endian int16, row by row from the north,
+    with the themes for each cell interleaved ( elevation, slope, aspect, fuel, cover). The header layout follows the
+    headdata structure in lcpmake.c, written without padding.
+"""
+import logging
+import math
+import struct
+import sys
+
+import gdal
+import numpy as np
+
+LCP_HEADER_SIZE = 7316
+LCP_NO_DATA_VALUE = -9999
+
+# The values lcpmake.exe substitutes for negative ( including NoData) elevation, slope, aspect, fuel and cover values
+LCP_NEGATIVE_VALUES = [LCP_NO_DATA_VALUE, LCP_NO_DATA_VALUE, LCP_NO_DATA_VALUE, 99, 0]
+
+# The size of the header's list of distinct values for each theme. lcpmake.exe lists them after a leading 0 if there are
+# fewer than LCP_MAX_CLASSES - 1 of them. Otherwise the count is -1
+LCP_MAX_CLASSES = 100
+
+# CrownFuels/GroundFuels flag values. We never have the optional crown or ground fuel themes
+LCP_THEMES_ABSENT = 20
+
+# Units, as lcpmake.exe documents them: Elevation (m), Slope (deg), Aspect (azimuth deg), Cover (%)
+LCP_UNITS = [0, 0, 2, 0, 1, 0, 0, 0, 0, 0]
+
+# The number of rows converted and written at a time, so memory use doesn't depend on the landscape size
+ROW_BLOCK_SIZE = 256
+
+_HEADER_FORMAT = '<3i4d' + '3i100i' * 10 + '2i4di2d10h' + '256s' * 10 + '512s'
+
+
+def encodeBand(x, no_data_value, negative_value = LCP_NO_DATA_VALUE):
+    '''
+        Encode raster values as LCP int16 values. Negative and NoData cells are set to negative_value.
+
+        DEVNOTE: Values are truncated toward zero, as the (short) cast in lcpmake.exe does.
+
+        :param x: The raster values
+        :param no_data_value: The raster's NoData value ( None if it doesn't have one)
+        :param negative_value: The value for negative and NoData cells. See LCP_NEGATIVE_VALUES
+    '''
+    x = np.asarray(x)
+    negative = x < 0
+    if no_data_value is not None:
+        negative |= x == no_data_value
+    if x.dtype.kind == 'f':
+        negative |= ~np.isfinite(x)
+
+    y = np.where(negative, 0, x).astype(np.int16)
+    y[negative] = negative_value
+
+    return y
+
+
+class BandSource:
+    '''
+        Reads row blocks of encoded int16 values, either from a GDAL raster or from an already encoded array ( ie a
+        cached terrain band). The blocks can be limited to a window of the source. See setWindow
+    '''
+
+    def __init__(self, source, negative_value = LCP_NO_DATA_VALUE):
+        self.filename = None
+        self.negative_value = negative_value
+        self.array = None
+        self.band = None
+        self.raster = None
+        self.row_offset = 0
+        self.col_offset = 0
+
+        if isinstance(source, np.ndarray):
+            self.array = source
+            self.rows, self.cols = source.shape
+        else:
+            gdal.UseExceptions()
+            self.filename = source
+            self.raster = gdal.Open(source, gdal.GA_ReadOnly)
+            if self.raster is None:
+                logging.error("Cannot open Source Raster file '{0}'".format(source))
+                sys.exit(1)
+            self.band = self.raster.GetRasterBand(1)
+            self.no_data_value = self.band.GetNoDataValue()
+            self.rows, self.cols = self.raster.RasterYSize, self.raster.RasterXSize
+
+
+    def setWindow(self, row, col, rows, cols):
+        '''
+            Limit the source to the window, so that rows and cols are its size, and readRows is relative to it.
+        '''
+        self.row_offset, self.col_offset = row, col
+        self.rows, self.cols = rows, cols
+
+
+    def readRows(self, row, num_rows):
+        row += self.row_offset
+        if self.array is not None:
+            return np.asarray(self.array[row:row + num_rows, self.col_offset:self.col_offset + self.cols],
+                              dtype=np.int16)
+
+        return encodeBand(self.band.ReadAsArray(self.col_offset, row, self.cols, num_rows), self.no_data_value,
+                          self.negative_value)
+
+
+class ThemeStats:
+    '''
+        The low/high values, and the list of distinct values, of a theme, as lcpmake.exe works them out. Built up a row
+        block at a time.
+
+        DEVNOTE: lcpmake.exe keeps the distinct values in the order found, until there are LCP_MAX_CLASSES - 1 of them.
+        The last slot of the list is overwritten by every cell, so it ends up with the last cell's value. The high value
+        includes NoData, and the low value doesn't.
+    '''
+
+    def __init__(self):
+        self.lo = None
+        self.hi = None
+        self.values = []
+        self.last = 0
+
+
+    def add(self, x):
+        x = x.ravel()
+        if x.size == 0:
+            return
+
+        hi = int(x.max())
+        self.hi = hi if self.hi is None else max(self.hi, hi)
+        self.last = int(x[-1])
+
+        valid = x[x >= 0]
+        if valid.size:
+            lo = int(valid.min())
+            self.lo = lo if self.lo is None else min(self.lo, lo)
+
+        if len(self.values) < LCP_MAX_CLASSES - 1:
+            known = set(self.values)
+            distinct, first = np.unique(x, return_index=True)
+            found = sorted((i, int(val)) for val, i in zip(distinct, first) if int(val) not in known)
+            self.values += [val for i, val in found[:LCP_MAX_CLASSES - 1 - len(self.values)]]
+
+
+    def pack(self):
+        '''
+            :return: The header values for the theme: [lo, hi, num, values x 100]
+        '''
+        if len(self.values) < LCP_MAX_CLASSES - 1:
+            num = len(self.values)
+            values = [0] + sorted(self.values)
+            lo = max(0, values[1]) if num else 0
+        else:
+            num = -1
+            values = self.values + [self.last]
+            lo = self.lo or 0
+        return [lo, self.hi or 0, num] + values + [0] * (LCP_MAX_CLASSES - len(values))
+
+
+def lcpOrigin(x):
+    '''
+        The coordinate relative to the km below it ( toward zero), as lcpmake.exe records the extent at the start of the
+        header.
+    '''
+    return x - math.modf(x / 1000.0)[1] * 1000.0
+
+
+def packHeader(latitude, stats, cols, rows, west, south, cellsize, theme_filenames, description = ''):
+    '''
+        Pack the LCP header
+
+        :param stats: The ThemeStats for the elevation, slope, aspect, fuel and cover themes
+        :param theme_filenames: The source filenames of the themes, recorded in the header
+    '''
+    east = west + cols * cellsize
+    north = south + rows * cellsize
+    lo_east = lcpOrigin(west)
+    lo_north = lcpOrigin(south)
+
+    values = [LCP_THEMES_ABSENT, LCP_THEMES_ABSENT, int(latitude), lo_east, cols * cellsize + lo_east, lo_north,
+              rows * cellsize + lo_north]
+    for theme in stats:
+        values += theme.pack()
+
+    # lcpmake.exe counts the 0 it fills the absent crown and ground fuel themes with
+    for i in range(10 - len(stats)):
+        values += [0, 0, 1] + [0] * LCP_MAX_CLASSES
+
+    values += [cols, rows, east, west, north, south, 0, cellsize, cellsize]
+    values += LCP_UNITS
+    filenames = list(theme_filenames) + [''] * (10 - len(theme_filenames))
+    values += [str(fn)[:255] for fn in filenames]
+    values.append(str(description)[:511])
+
+    return struct.pack(_HEADER_FORMAT, *values)
+
+
+def unpackHeader(data):
+    '''
+        Unpack an LCP header into a list of its field values, in _HEADER_FORMAT order. Handy for comparing LCP files.
+    '''
+    return list(struct.unpack(_HEADER_FORMAT, data[:LCP_HEADER_SIZE]))
+
+
+def writeLCP(landscape_filename, sources, latitude, reference_filename, theme_filenames = None,
+             block_rows = ROW_BLOCK_SIZE, window = None):
+    '''
+        Write a FARSITE landscape file.
+
+        :param landscape_filename: The name of the LCP file to write, including extension
+        :param sources: The elevation, slope, aspect, fuel and cover themes. Each can be a raster filename, or an array
+            of already encoded int16 values (see encodeBand)
+        :param latitude: The latitude of the landscape
+        :param reference_filename: The raster to take the grid extent and cell size from
+        :param theme_filenames: (Optional) The theme filenames to record in the header. Defaults to the source filenames.
+        :param block_rows: The number of rows to process at a time
+        :param window: (Optional) The ( row, col, rows, cols) window of the reference grid to write, rather than all of
+            it
+    '''
+
+    gdal.UseExceptions()
+    reference = gdal.Open(reference_filename, gdal.GA_ReadOnly)
+    if reference is None:
+        logging.error("Cannot open Reference Raster file '{0}'".format(reference_filename))
+        sys.exit(1)
+
+    cols, rows = reference.RasterXSize, reference.RasterYSize
+    geotransform = reference.GetGeoTransform()
+    reference = None
+
+    cellsize = geotransform[1]
+    west = geotransform[0]
+    south = geotransform[3] + rows * geotransform[5]
+
+    bands = [BandSource(source, negative_value) for source, negative_value in zip(sources, LCP_NEGATIVE_VALUES)]
+    for band in bands:
+        if (band.rows, band.cols) != (rows, cols):
+            logging.error("The '{0}' theme is not the same size as the landscape".format(band.filename or 'cached'))
+            sys.exit(1)
+
+    if window is not None:
+        row, col, rows, cols = window
+        west += col * cellsize
+        south = geotransform[3] + (row + rows) * geotransform[5]
+        for band in bands:
+            band.setWindow(row, col, rows, cols)
+
+    if theme_filenames is None:
+        theme_filenames = [band.filename or '' for band in bands]
+
+    # 1st pass for the header stats, 2nd to write the cells
+    stats = [ThemeStats() for band in bands]
+    for row in range(0, rows, block_rows):
+        num_rows = min(block_rows, rows - row)
+        for band, theme in zip(bands, stats):
+            theme.add(band.readRows(row, num_rows))
+
+    with open(landscape_filename, 'wb') as f:
+        f.write(packHeader(latitude, stats, cols, rows, west, south, cellsize, theme_filenames))
+
+        block = np.empty((block_rows, cols, len(bands)), dtype='<i2')
+        for row in range(0, rows, block_rows):
+            num_rows = min(block_rows, rows - row)
+            for i, band in enumerate(bands):
+                block[:num_rows, :, i] = band.readRows(row, num_rows)
+            f.write(block[:num_rows].tostring())
+
+    logging.debug('Created Landscape file "{0}"'.format(landscape_filename))
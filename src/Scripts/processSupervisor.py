@@ -0,0 +1,230 @@
+﻿import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+if sys.platform == 'win32':
+    import ctypes
+    import pywintypes
+    import win32api
+    import win32con
+    import win32job
+
+# Reasons a process can go over its budget. See ProcessResult.over_budget
+OVER_BUDGET_WALL = 'wall-clock'
+OVER_BUDGET_CPU = 'CPU'
+
+# How often (secs) to check the budget of a process. Starts short, and backs off to the max
+POLL_INTERVAL_MIN = 0.05
+POLL_INTERVAL_MAX = 1.0
+
+# How long (secs) to wait for the rest of a process's output once it's ended. A process it started that wasn't killed
+# with it can hold on to the output, so this isn't waited on indefinitely.
+READER_JOIN_TIMEOUT = 5.0
+
+# Windows process creation flag, to start the process with its main thread suspended
+CREATE_SUSPENDED = 0x00000004
+
+
+class ProcessResult:
+    '''
+        How a supervised process ended, and the resources it used.
+    '''
+
+    def __init__(self, exit_code, over_budget, wall_seconds, cpu_seconds, peak_memory):
+        '''
+            :param exit_code: The exit code of the process
+            :param over_budget: OVER_BUDGET_WALL or OVER_BUDGET_CPU if the process was killed for going over its
+                budget, otherwise None
+            :param wall_seconds: The elapsed time
+            :param cpu_seconds: The CPU time used by the process ( and, on Windows, its children), or None if unknown
+            :param peak_memory: The peak memory used (bytes), or None if unknown
+        '''
+        self.exit_code = exit_code
+        self.over_budget = over_budget
+        self.wall_seconds = wall_seconds
+        self.cpu_seconds = cpu_seconds
+        self.peak_memory = peak_memory
+
+
+class SupervisedProcess:
+    '''
+        A child process run with optional wall-clock and CPU time budgets. Its console output is logged, a line at a
+        time, as it's written rather than being dropped. If it goes over a budget, it's killed along with any processes
+        it started.
+
+        Several processes can be started, and then waited on, so that they run side by side.
+
+        DEVNOTE: On Windows the process is put in a Job Object, which gives the CPU time and peak memory of the whole
+        process tree, and kills the tree in one call. The process is started suspended, and only resumed once it's in
+        the job, so that anything it starts is in the job too. If the process can't be assigned to a job ( ie nested
+        jobs before Windows 8), the tree is killed with taskkill instead, and only the wall-clock budget is enforced.
+        Elsewhere the process leads its own process group, and its CPU time is read from /proc.
+    '''
+
+    def __init__(self, cmdLine, name, wall_seconds = None, cpu_seconds = None):
+        '''
+            :param cmdLine: The command line to run
+            :param name: The name of the process, for the log
+            :param wall_seconds: (Optional) The wall-clock budget (secs)
+            :param cpu_seconds: (Optional) The CPU time budget (secs)
+        '''
+        self.cmdLine = cmdLine
+        self.name = name
+        self.wall_seconds = wall_seconds
+        self.cpu_seconds = cpu_seconds
+        self.proc = None
+        self.job = None
+        self.__cpu_seconds = None
+
+
+    def start(self):
+        logging.debug(self.cmdLine)
+
+        if sys.platform == 'win32':
+            self.proc = subprocess.Popen(self.cmdLine, stdin=open(os.devnull, 'r'), stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT, creationflags=CREATE_SUSPENDED)
+            self.job = self.__createJob()
+            self.__resume()
+        else:
+            self.proc = subprocess.Popen(self.cmdLine, stdin=open(os.devnull, 'r'), stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid)
+
+        self.start_time = time.time()
+
+        self.reader = threading.Thread(target=self.__readOutput)
+        self.reader.daemon = True
+        self.reader.start()
+        return self
+
+
+    def __createJob(self):
+        try:
+            job = win32job.CreateJobObject(None, '')
+            handle = win32api.OpenProcess(win32con.PROCESS_TERMINATE | win32con.PROCESS_SET_QUOTA, False,
+                                          self.proc.pid)
+            win32job.AssignProcessToJobObject(job, handle)
+            return job
+        except pywintypes.error as ex:
+            logging.debug('Could not put {0} in a Job Object: {1}'.format(self.name, ex))
+            return None
+
+
+    def __resume(self):
+        '''
+            Resume the suspended process.
+
+            DEVNOTE: Popen closes the handle of the process's main thread, so the whole process is resumed instead, with
+            NtResumeProcess.
+        '''
+        status = ctypes.windll.ntdll.NtResumeProcess(int(self.proc._handle))
+        if status != 0:
+            self.kill()
+            logging.error('Could not resume {0} (NTSTATUS 0x{1:08X})'.format(self.name, status & 0xFFFFFFFF))
+            sys.exit(1)
+
+
+    def __readOutput(self):
+        for line in iter(self.proc.stdout.readline, ''):
+            line = line.rstrip()
+            if line:
+                logging.debug('{0}: {1}'.format(self.name, line))
+        self.proc.stdout.close()
+
+
+    def getCpuSeconds(self):
+        '''
+            :return: The CPU time used so far, or None if it's not known
+        '''
+        if self.job is not None:
+            info = win32job.QueryInformationJobObject(self.job, win32job.JobObjectBasicAccountingInformation)
+            return (info['TotalUserTime'] + info['TotalKernelTime']) / 1e7
+
+        try:
+            with open('/proc/{0}/stat'.format(self.proc.pid), 'r') as f:
+                # The fields after the command name, which is in brackets, and may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+            self.__cpu_seconds = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+        except (IOError, IndexError, ValueError, AttributeError):
+            # The process has gone, or there is no /proc, so use the last we knew
+            pass
+
+        return self.__cpu_seconds
+
+
+    def getPeakMemory(self):
+        if self.job is not None:
+            info = win32job.QueryInformationJobObject(self.job, win32job.JobObjectExtendedLimitInformation)
+            return info['PeakJobMemoryUsed']
+
+        return None
+
+
+    def kill(self):
+        '''
+            Kill the process, and any processes it started.
+        '''
+        if self.job is not None:
+            win32job.TerminateJobObject(self.job, 1)
+        elif sys.platform == 'win32':
+            subprocess.call('taskkill /F /T /PID {0}'.format(self.proc.pid))
+        else:
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+    def wait(self):
+        '''
+            Wait for the process to end, killing it if it goes over its budget.
+
+            :return: The ProcessResult
+        '''
+        over_budget = None
+        poll_interval = POLL_INTERVAL_MIN
+        while self.proc.poll() is None:
+            cpu_seconds = self.getCpuSeconds()
+            if self.wall_seconds and time.time() - self.start_time > self.wall_seconds:
+                over_budget = OVER_BUDGET_WALL
+            elif self.cpu_seconds and cpu_seconds is not None and cpu_seconds > self.cpu_seconds:
+                over_budget = OVER_BUDGET_CPU
+
+            if over_budget:
+                logging.warning('Killing {0}, as it went over its {1} budget of {2} secs'.format(
+                    self.name, over_budget, self.wall_seconds if over_budget == OVER_BUDGET_WALL else self.cpu_seconds))
+                self.kill()
+                break
+
+            # The output ends when the process does ( unless it's left children holding on to it), so this returns as
+            # soon as the process ends
+            self.reader.join(poll_interval)
+            poll_interval = min(poll_interval * 2, POLL_INTERVAL_MAX)
+
+        result = ProcessResult(self.proc.wait(), over_budget, time.time() - self.start_time, self.getCpuSeconds(),
+                               self.getPeakMemory())
+        self.reader.join(READER_JOIN_TIMEOUT)
+        if self.reader.is_alive():
+            logging.debug('Stopped waiting for the output of {0}, which is still held open'.format(self.name))
+
+        if self.job is not None:
+            self.job.Close()
+            self.job = None
+
+        logging.debug('{0} exited with {1} after {2:.1f} secs, using {3} secs CPU and {4} bytes peak memory'.format(
+            self.name, result.exit_code, result.wall_seconds,
+            'unknown' if result.cpu_seconds is None else '{0:.1f}'.format(result.cpu_seconds),
+            'unknown' if result.peak_memory is None else result.peak_memory))
+        return result
+
+
+def runProcess(cmdLine, name, wall_seconds = None, cpu_seconds = None):
+    '''
+        Run a process under supervision, and wait for it to end. See SupervisedProcess
+
+        :return: The ProcessResult
+    '''
+    return SupervisedProcess(cmdLine, name, wall_seconds, cpu_seconds).start().wait()
@@ -0,0 +1,835 @@
+﻿import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+import gdal
+from osgeo import gdal_array
+import numpy as np
+from gdalconst import *
+
+from syncrosim import writeJsonFile, replaceFile, removeFile
+
+# Default cap on the total size of the converted terrain files kept by TerrainCache
+TERRAIN_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Name of the file, in the cache directory, holding the cache index
+CACHE_INDEX_FILENAME = 'index.json'
+
+# Prefix of the files that TerrainCache converts into, before swapping them in, and how old ( secs) one must be before
+# it's taken to have been left behind by a job that died
+TERRAIN_CACHE_TMP_PREFIX = 'tmp'
+TERRAIN_CACHE_TMP_MAX_AGE = 24 * 60 * 60
+
+# Names of the files, in the stratum template directory, holding the template metadata, the bit-packed valid-cell mask
+# and the flat index of the valid cells
+STRATUM_TEMPLATE_FILENAME = 'template.json'
+STRATUM_MASK_FILENAME = 'mask.npy'
+STRATUM_CELLS_FILENAME = 'cells.npy'
+
+# Names of the files, in the stratum template directory, holding the ignition distribution metadata, the cells that can
+# be ignited, and their cumulative ignition probabilities
+IGNITION_DISTRIBUTION_FILENAME = 'ignition.json'
+IGNITION_CELLS_FILENAME = 'ignitionCells.npy'
+IGNITION_CDF_FILENAME = 'ignitionCdf.npy'
+
+# Prefix of the pre-initialized zero value TSM, in the stratum template directory. See StratumTemplate.getZeroTsmFilename
+ZERO_TSM_PREFIX = 'zeroTsm-'
+
+# Compact representation of the Transition Spatial Multipliers (TSMs) and the other rasters made from a StratumTemplate.
+# These only ever hold 0, 1 or NoData, so are written as Byte, with a NoData of 255, rather than Int32 with a NoData of
+# -9999. This makes the files, and the arrays, 4x smaller.
+TSM_DATA_TYPE = GDT_Byte
+TSM_DTYPE = np.uint8
+TSM_NO_DATA_VALUE = 255
+
+# GeoTIFF creation options and overview levels for the TSMs. The TSMs are mostly zero, so compress very well. These can
+# be overridden by setting SSIM_FARSITE_TSM_CREATION_OPTIONS ( ie "TILED=YES,COMPRESS=ZSTD,PREDICTOR=2") and
+# SSIM_FARSITE_TSM_OVERVIEWS ( ie "2,4,8") in the FARSITE Environment. See benchmark.py for the trade-offs.
+DEFAULT_TSM_CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'COMPRESS=DEFLATE', 'PREDICTOR=2']
+DEFAULT_TSM_OVERVIEW_LEVELS = []
+ENV_TSM_CREATION_OPTIONS = 'SSIM_FARSITE_TSM_CREATION_OPTIONS'
+ENV_TSM_OVERVIEWS = 'SSIM_FARSITE_TSM_OVERVIEWS'
+
+# GDAL drivers, by name. See getDriver
+_drivers = {}
+
+
+def getDriver(name):
+    '''
+        Get the GDAL raster driver with the specified name. Drivers are looked up once, and reused for the rest of the run.
+    '''
+    driver = _drivers.get(name)
+    if driver is None:
+        driver = gdal.GetDriverByName(name)
+        if driver is None:
+            logging.error("GDAL driver '{0}' is not available".format(name))
+            sys.exit(1)
+        _drivers[name] = driver
+
+    return driver
+
+
+def getFileSignature(filename):
+    '''
+        Get a cheap signature for the file, that changes whenever the file is rewritten.
+
+        :return: A list of (size, mtime)
+    '''
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime]
+
+
+def hashFile(filename, block_size = 1024 * 1024):
+    '''
+        Get the SHA1 hash of the file's contents
+    '''
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def getTsmCreationOptions():
+    '''
+        Get the GeoTIFF creation options for the TSMs, from the FARSITE Environment if they've been set there.
+
+        :return: A list of the creation options. ie ['TILED=YES', 'COMPRESS=DEFLATE']
+    '''
+    value = os.environ.get(ENV_TSM_CREATION_OPTIONS)
+    if value is None:
+        return list(DEFAULT_TSM_CREATION_OPTIONS)
+
+    return [option.strip() for option in value.split(',') if option.strip()]
+
+
+def getTsmOverviewLevels():
+    '''
+        Get the overview levels to build for the TSMs, from the FARSITE Environment if they've been set there.
+
+        :return: A list of the overview levels. ie [2, 4, 8]. Empty if no overviews are wanted.
+    '''
+    value = os.environ.get(ENV_TSM_OVERVIEWS)
+    if value is None:
+        return list(DEFAULT_TSM_OVERVIEW_LEVELS)
+
+    try:
+        return [int(level) for level in value.split(',') if level.strip()]
+    except ValueError:
+        logging.error('Invalid {0} "{1}". Expected a comma separated list of levels, ie "2,4,8"'.format(
+            ENV_TSM_OVERVIEWS, value))
+        sys.exit(1)
+
+
+def createTsmCopy(dest_filename, src_raster, creation_options = None, overview_levels = None):
+    '''
+        Copy an in-memory raster to a TSM GeoTIFF.
+
+        DEVNOTE: Any overviews are built on the source raster, and copied with COPY_SRC_OVERVIEWS, so they're stored
+        ahead of the full resolution data, as Cloud Optimized GeoTIFF readers expect.
+
+        :param dest_filename: The filename of the GeoTIFF to create
+        :param src_raster: The source GDAL dataset
+        :param creation_options: (Optional) The GeoTIFF creation options. Defaults to getTsmCreationOptions()
+        :param overview_levels: (Optional) The overview levels. Defaults to getTsmOverviewLevels()
+        :return: The new GDAL dataset
+    '''
+    if creation_options is None:
+        creation_options = getTsmCreationOptions()
+    if overview_levels is None:
+        overview_levels = getTsmOverviewLevels()
+
+    if overview_levels:
+        src_raster.BuildOverviews('NEAREST', overview_levels)
+        creation_options = creation_options + ['COPY_SRC_OVERVIEWS=YES']
+
+    dest_raster = getDriver('GTiff').CreateCopy(dest_filename, src_raster, 0, creation_options)
+    if dest_raster is None:
+        logging.error('Cannot create raster file "{0}"'.format(dest_filename))
+        sys.exit(1)
+
+    return dest_raster
+
+
+def buildTsmOverviews(raster, overview_levels = None):
+    '''
+        Build the internal overviews of a TSM GeoTIFF that was written directly, rather than with createTsmCopy.
+    '''
+    if overview_levels is None:
+        overview_levels = getTsmOverviewLevels()
+
+    if overview_levels:
+        raster.BuildOverviews('NEAREST', overview_levels)
+
+
+class RasterHeaderCache:
+    '''
+        A cache of raster headers ( rows, cols, geotransform), so that rasters that don't change during a run, such as
+        the Primary Stratum and the terrain rasters, are only opened with GDAL once.
+
+        Each header is kept against the raster's (size, mtime, inode) signature, and re-read if that changes.
+    '''
+
+    def __init__(self, cache_filename):
+        '''
+            :param cache_filename: The JSON file to keep the headers in, or None to only keep them in memory
+        '''
+        self.cache_filename = cache_filename
+        self.__headers = {}
+        self.__dirty = False
+
+        if self.cache_filename and os.path.exists(self.cache_filename):
+            try:
+                with open(self.cache_filename, 'r') as f:
+                    self.__headers = json.load(f)
+            except ValueError:
+                logging.warning('Ignoring unreadable raster header cache "{0}"'.format(self.cache_filename))
+
+
+    def get(self, filename, remember = True):
+        '''
+            Get the header of the specified raster.
+
+            :param filename: The raster filename
+            :param remember: If False, the header is read, but not added to the cache. Use this for rasters that are only
+                verified once, so they don't bloat the cache.
+            :return: A dict of the raster's 'rows', 'cols' and 'geotransform'
+        '''
+        path = os.path.abspath(filename)
+        st = os.stat(filename)
+        signature = [st.st_size, st.st_mtime, st.st_ino]
+
+        entry = self.__headers.get(path)
+        if entry and entry['signature'] == signature:
+            return entry['header']
+
+        gdal.UseExceptions()
+        raster = gdal.Open(filename, gdal.GA_ReadOnly)
+        if raster is None:
+            errMsg = "Cannot open Raster file '{0}'".format(filename)
+            logging.error(errMsg)
+            sys.exit(errMsg)
+
+        header = {'rows': raster.RasterYSize, 'cols': raster.RasterXSize, 'geotransform': list(raster.GetGeoTransform())}
+        raster = None
+
+        if remember:
+            self.__headers[path] = {'signature': signature, 'header': header}
+            self.__dirty = True
+
+        return header
+
+
+    def save(self):
+        if self.__dirty and self.cache_filename:
+            writeJsonFile(self.cache_filename, self.__headers)
+            self.__dirty = False
+
+
+class TerrainCache:
+    '''
+        A content-addressed cache of converted static terrain rasters ( elevation, slope, aspect).
+
+        The terrain rasters don't change during a run, and are typically shared by all the scenarios in a library, so
+        rather than converting them on every Farsite timestep, the converted files are kept in a directory shared by the
+        library, keyed by the hash of the source file plus its grid metadata. The cache is capped in size, with the least
+        recently used entries evicted first.
+
+        The directory is shared by all the library's SyncroSim jobs, so the entries aren't tracked in an index, which
+        the jobs would have to keep rewriting. Instead, the entries are simply the files in the directory, named by
+        their key, and the mtime of an entry's file is touched whenever it's used, to order the eviction.
+
+        DEVNOTE: Hashing a large raster isn't free, so the hash of each source file is remembered against its
+        (size, mtime) signature, along with its grid metadata, and both are only recomputed when that changes. A cache
+        hit is then just a stat of the source file, without opening it with GDAL. These hashes are the only thing kept
+        in the index, which is only rewritten ( merged with the other jobs' hashes) when a hash has been computed.
+    '''
+
+    def __init__(self, cache_dir, max_bytes = TERRAIN_CACHE_MAX_BYTES):
+        '''
+            :param cache_dir: The directory to keep the converted files in
+            :param max_bytes: The maximum total size of the converted files
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        self.__hashes = self.__loadHashes()
+
+
+    def __getIndexFilename(self):
+        return os.path.join(self.cache_dir, CACHE_INDEX_FILENAME)
+
+
+    def __loadHashes(self):
+        index_filename = self.__getIndexFilename()
+        if os.path.exists(index_filename):
+            try:
+                with open(index_filename, 'r') as f:
+                    index = json.load(f)
+                if 'hashes' in index:
+                    return index['hashes']
+            except (IOError, ValueError):
+                pass
+
+            logging.warning('Ignoring unreadable terrain cache index "{0}"'.format(index_filename))
+
+        return {}
+
+
+    def __saveHash(self, path, signature, file_hash, grid_metadata):
+        '''
+            Add a source file's hash and grid metadata to the index, merged with those that other jobs have added since
+            we loaded it.
+        '''
+        self.__hashes = self.__loadHashes()
+        self.__hashes[path] = [signature, file_hash, grid_metadata]
+        writeJsonFile(self.__getIndexFilename(), {'hashes': self.__hashes})
+
+
+    def getKey(self, src_filename, kind, read_grid_metadata = None):
+        '''
+            Get the cache key for the specified source file.
+
+            :param src_filename: The source raster filename
+            :param kind: The kind of conversion. ie 'lcp-int16'
+            :param read_grid_metadata: (Optional) The function to read the grid metadata that affects the conversion
+                (rows, cols, geotransform...), called as read_grid_metadata(src_filename). It's only called when the
+                source file has changed since its metadata was stored in the index.
+        '''
+        path = os.path.abspath(src_filename)
+        signature = getFileSignature(src_filename)
+        known = self.__hashes.get(path)
+        if known and len(known) == 3 and known[0] == signature:
+            file_hash, grid_metadata = known[1], known[2]
+        else:
+            file_hash = hashFile(src_filename)
+            grid_metadata = read_grid_metadata(src_filename) if read_grid_metadata else None
+            self.__saveHash(path, signature, file_hash, grid_metadata)
+
+        key = hashlib.sha1('{0}|{1}|{2}'.format(file_hash, kind, json.dumps(grid_metadata))).hexdigest()
+        return key
+
+
+    def get(self, src_filename, kind, extension, convert, read_grid_metadata = None):
+        '''
+            Get the converted version of the specified source file, converting it if it isn't already in the cache.
+
+            :param src_filename: The source raster filename
+            :param kind: The kind of conversion. ie 'lcp-int16'
+            :param extension: The extension of the converted file. ie '.npy'
+            :param convert: The function to convert the file, called as convert(src_filename, dest_filename)
+            :param read_grid_metadata: (Optional) The function to read the grid metadata that affects the conversion. See
+                getKey
+            :return: The filename of the converted file in the cache. This must not be modified or deleted by the caller.
+        '''
+
+        key = self.getKey(src_filename, kind, read_grid_metadata)
+        filename = os.path.join(self.cache_dir, key + extension)
+
+        if os.path.exists(filename):
+            logging.debug('Using cached terrain file "{0}" for "{1}"'.format(filename, src_filename))
+            self.__touch(filename)
+            return filename
+
+        # Convert to a temporary name and then swap it in, as other SyncroSim jobs may share the cache
+        logging.debug('Adding terrain file "{0}" to cache for "{1}"'.format(filename, src_filename))
+        tmp_key = TERRAIN_CACHE_TMP_PREFIX + '{0}-{1}'.format(os.getpid(), key)
+        tmp_filename = os.path.join(self.cache_dir, tmp_key + extension)
+        convert(src_filename, tmp_filename)
+
+        for tmp_file in self.__getEntryFiles(tmp_key):
+            replaceFile(tmp_file, os.path.join(self.cache_dir, key + os.path.basename(tmp_file)[len(tmp_key):]))
+
+        # DEVNOTE: The files are content-addressed, so if another job beat us to swapping them in, theirs will do
+        if not os.path.exists(filename):
+            logging.error('Could not add "{0}" to the terrain cache'.format(filename))
+            sys.exit(1)
+
+        self.__touch(filename)
+        self.__evict(key)
+        return filename
+
+
+    def __touch(self, filename):
+        '''
+            Mark the entry as just used, for the eviction order.
+        '''
+        try:
+            os.utime(filename, None)
+        except OSError as ex:
+            logging.debug('Could not touch terrain cache file "{0}" ({1})'.format(filename, ex))
+
+
+    def __getEntryFiles(self, key):
+        # Conversions can leave sidecar files (.prj, .aux.xml) alongside the converted file, all sharing the key.
+        return [os.path.join(self.cache_dir, fn) for fn in os.listdir(self.cache_dir) if fn.startswith(key + '.')]
+
+
+    def __evict(self, keep_key):
+        '''
+            Evict the least recently used entries, until the cache is within its size cap. Temporary files left behind by
+            jobs that died while converting are removed as well.
+
+            An entry whose files can't be removed ( ie on Windows, as another job has it memory mapped) is left for a
+            later eviction.
+
+            :param keep_key: The key of an entry that mustn't be evicted, as it's about to be used
+        '''
+        now = time.time()
+        entries = {}
+        for fn in os.listdir(self.cache_dir):
+            filename = os.path.join(self.cache_dir, fn)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                # Evicted by another job
+                continue
+
+            if fn.startswith(TERRAIN_CACHE_TMP_PREFIX):
+                if now - st.st_mtime > TERRAIN_CACHE_TMP_MAX_AGE:
+                    removeFile(filename)
+                continue
+
+            if fn == CACHE_INDEX_FILENAME or fn.endswith('.tmp'):
+                continue
+
+            size, used = entries.get(fn.split('.', 1)[0], (0, 0))
+            entries[fn.split('.', 1)[0]] = (size + st.st_size, max(used, st.st_mtime))
+
+        total = sum(size for size, used in entries.values())
+        for key in sorted(entries.keys(), key=lambda k: entries[k][1]):
+            if total <= self.max_bytes:
+                break
+            if key == keep_key:
+                continue
+
+            logging.debug('Evicting terrain cache entry {0}'.format(key))
+            removed = [removeFile(fn) for fn in self.__getEntryFiles(key)]
+            if all(removed):
+                total -= entries[key][0]
+
+
+class StratumTemplate:
+    '''
+        The grid ( shape, geotransform, projection) and valid-cell mask of the Primary Stratum raster, used to make the
+        zero and one value rasters needed during the run.
+
+        These used to be made by re-reading and converting the stratum raster each time one was needed. Instead, the
+        template is computed once, and kept in a directory next to the scenario output, so that subsequent timesteps
+        just load it. The template is rebuilt whenever the hash of the stratum file changes.
+
+        A cell is valid if it isn't the stratum raster's NoData value. The mask is stored bit-packed, along with the
+        flat ( row * cols + col) indexes of the valid cells, for sampling.
+    '''
+
+    def __init__(self, stratum_filename, template_dir):
+        '''
+            :param stratum_filename: The Primary Stratum raster filename
+            :param template_dir: The directory to keep the template in
+        '''
+        self.stratum_filename = stratum_filename
+        self.template_dir = template_dir
+        self.__mask = None
+        self.__packed_mask = None
+        self.__cells = None
+
+        if not os.path.exists(self.template_dir):
+            os.makedirs(self.template_dir)
+
+        self.__template = self.__loadTemplate()
+        if self.__template is None:
+            self.__template = self.__buildTemplate()
+
+        self.cols = self.__template['cols']
+        self.rows = self.__template['rows']
+        self.geotransform = tuple(self.__template['geotransform'])
+        self.projection = self.__template['projection']
+        self.hash = self.__template['hash']
+
+
+    def __getTemplateFilename(self):
+        return os.path.join(self.template_dir, STRATUM_TEMPLATE_FILENAME)
+
+
+    def __getMaskFilename(self):
+        return os.path.join(self.template_dir, STRATUM_MASK_FILENAME)
+
+
+    def __getCellsFilename(self):
+        return os.path.join(self.template_dir, STRATUM_CELLS_FILENAME)
+
+
+    def __loadTemplate(self):
+        '''
+            Load the stored template, if it's for the current version of the stratum file.
+
+            :return: The template metadata, or None if it needs to be (re)built
+        '''
+        template_filename = self.__getTemplateFilename()
+        for filename in [template_filename, self.__getMaskFilename(), self.__getCellsFilename()]:
+            if not os.path.exists(filename):
+                return None
+
+        try:
+            with open(template_filename, 'r') as f:
+                template = json.load(f)
+        except ValueError:
+            logging.warning('Ignoring unreadable stratum template "{0}"'.format(template_filename))
+            return None
+
+        if template.get('source') <> os.path.abspath(self.stratum_filename):
+            return None
+
+        # DEVNOTE: Only hash the stratum file if it has been rewritten since the template was built
+        signature = getFileSignature(self.stratum_filename)
+        if template.get('signature') == signature:
+            return template
+
+        if template.get('hash') <> hashFile(self.stratum_filename):
+            logging.info('Primary Stratum file has changed, so rebuilding the stratum template')
+            return None
+
+        template['signature'] = signature
+        writeJsonFile(template_filename, template)
+        return template
+
+
+    def __buildTemplate(self):
+        logging.debug('Building stratum template for "{0}"'.format(self.stratum_filename))
+
+        gdal.UseExceptions()
+        stratum = gdal.Open(self.stratum_filename, gdal.GA_ReadOnly)
+        if stratum is None:
+            logging.error("Cannot open Primary Stratum Raster file '{0}'".format(self.stratum_filename))
+            sys.exit(1)
+
+        band = stratum.GetRasterBand(1)
+        no_data_value = band.GetNoDataValue()
+        if no_data_value is None:
+            mask = np.ones((stratum.RasterYSize, stratum.RasterXSize), dtype=bool)
+        else:
+            mask = band.ReadAsArray() <> no_data_value
+
+        template = {'source': os.path.abspath(self.stratum_filename),
+                    'signature': getFileSignature(self.stratum_filename),
+                    'hash': hashFile(self.stratum_filename),
+                    'cols': stratum.RasterXSize,
+                    'rows': stratum.RasterYSize,
+                    'geotransform': list(stratum.GetGeoTransform()),
+                    'projection': stratum.GetProjectionRef(),
+                    'num_valid': int(np.count_nonzero(mask))}
+        stratum = None
+
+        cells = np.flatnonzero(mask)
+        if template['rows'] * template['cols'] <= np.iinfo(np.int32).max:
+            cells = cells.astype(np.int32)
+
+        # Other SyncroSim jobs may be sharing the template, so swap the new files in. If that fails, the template is
+        # only kept in memory, and rebuilt next time
+        packed_mask = np.packbits(mask.ravel())
+        saved = True
+        for filename, x in [(STRATUM_MASK_FILENAME, packed_mask), (STRATUM_CELLS_FILENAME, cells)]:
+            tmp_filename = os.path.join(self.template_dir, 'tmp{0}-{1}'.format(os.getpid(), filename))
+            np.save(tmp_filename, x)
+            saved = replaceFile(tmp_filename, os.path.join(self.template_dir, filename)) and saved
+        if saved:
+            writeJsonFile(self.__getTemplateFilename(), template)
+
+        self.__mask = mask
+        self.__packed_mask = packed_mask
+        self.__cells = cells
+        return template
+
+
+    def getNumValidCells(self):
+        return self.__template['num_valid']
+
+
+    def getValidMask(self):
+        '''
+            Get the valid-cell mask.
+
+            :return: A (rows, cols) boolean array, True for the valid cells. This must not be modified by the caller.
+        '''
+        if self.__mask is None:
+            packed = self.getPackedMask()
+            self.__mask = np.unpackbits(packed)[:self.rows * self.cols].reshape(self.rows, self.cols).astype(bool)
+
+        return self.__mask
+
+
+    def getPackedMask(self):
+        '''
+            Get the bit-packed valid-cell mask, as np.packbits makes it. The cell with flat index i is valid if bit
+            7 - (i & 7) of byte i >> 3 is set.
+
+            :return: A read-only memory mapped uint8 array
+        '''
+        if self.__packed_mask is None:
+            self.__packed_mask = np.load(self.__getMaskFilename(), mmap_mode='r')
+
+        return self.__packed_mask
+
+
+    def getValidWindow(self, row, col, rows, cols):
+        '''
+            Get the valid-cell mask of a window, unpacking only the bytes of the bit-packed mask that cover its rows.
+
+            :return: A (rows, cols) boolean array, True for the valid cells
+        '''
+        start = row * self.cols
+        end = (row + rows) * self.cols
+        bits = np.unpackbits(self.getPackedMask()[start >> 3:(end + 7) >> 3])
+        offset = start & 7
+        return bits[offset:offset + end - start].reshape(rows, self.cols)[:, col:col + cols].astype(bool)
+
+
+    def isValid(self, cells):
+        '''
+            Test whether cells are valid, from the bit-packed mask, so that the full mask isn't unpacked.
+
+            :param cells: An array of flat cell indexes, of any shape
+            :return: A boolean array of the same shape, True for the valid cells
+        '''
+        packed = self.getPackedMask()
+        cells = np.asarray(cells, dtype=np.int64)
+        return ((packed[cells >> 3] >> (7 - (cells & 7))) & 1).astype(bool)
+
+
+    def getValidCells(self):
+        '''
+            Get the flat indexes of the valid cells, in row major order.
+
+            :return: A read-only memory mapped array of the indexes
+        '''
+        if self.__cells is None:
+            self.__cells = np.load(self.__getCellsFilename(), mmap_mode='r')
+
+        return self.__cells
+
+
+    def getCellPoints(self, cells, jitter = False):
+        '''
+            Get the map coordinates of the specified cells.
+
+            :param cells: An array of flat cell indexes
+            :param jitter: If True, return a uniformly random point within each cell, rather than its center
+            :return: A tuple of the (x, y) coordinate arrays
+        '''
+        rows, cols = np.divmod(np.asarray(cells, dtype=np.int64), self.cols)
+        if jitter:
+            u = np.random.random_sample(len(cols))
+            v = np.random.random_sample(len(rows))
+        else:
+            u = v = 0.5
+
+        gt = self.geotransform
+        x = gt[0] + (cols + u) * gt[1] + (rows + v) * gt[2]
+        y = gt[3] + (cols + u) * gt[4] + (rows + v) * gt[5]
+        return x, y
+
+
+    def getZeroTsmFilename(self):
+        '''
+            Get the zero value TSM for the stratum, creating it if need be. The TSM is kept with the template, for the
+            current TSM creation options, so it only has to be created once, and can then be copied.
+
+            :return: The filename of the zero value TSM. This must not be modified or deleted by the caller.
+        '''
+        creation_options = getTsmCreationOptions()
+        overview_levels = getTsmOverviewLevels()
+        key = hashlib.sha1(json.dumps([self.hash, creation_options, overview_levels])).hexdigest()[:16]
+        filename = os.path.join(self.template_dir, ZERO_TSM_PREFIX + key + '.tif')
+        if os.path.exists(filename):
+            return filename
+
+        # Remove those for an earlier stratum or other creation options, unless another job is still using them
+        for fn in os.listdir(self.template_dir):
+            if fn.startswith(ZERO_TSM_PREFIX):
+                removeFile(os.path.join(self.template_dir, fn))
+
+        tmp_filename = os.path.join(self.template_dir, 'tmp{0}-{1}{2}.tif'.format(os.getpid(), ZERO_TSM_PREFIX, key))
+        self.createRaster(tmp_filename, 0)
+
+        # DEVNOTE: The TSM is keyed by its content, so if another job beat us to swapping it in, theirs will do
+        if not replaceFile(tmp_filename, filename) and not os.path.exists(filename):
+            logging.error('Could not create the zero value TSM "{0}"'.format(filename))
+            sys.exit(1)
+
+        return filename
+
+
+    def makeArray(self, value, dtype = TSM_DTYPE, no_data_value = TSM_NO_DATA_VALUE):
+        '''
+            Make an array with the specified value in the valid cells, and no_data_value elsewhere.
+        '''
+        x = np.empty((self.rows, self.cols), dtype=dtype)
+        x.fill(no_data_value)
+        x[self.getValidMask()] = value
+        return x
+
+
+    def makeRaster(self, value, data_type = TSM_DATA_TYPE, no_data_value = TSM_NO_DATA_VALUE):
+        '''
+            Make an in-memory raster on the stratum grid, with the specified value in the valid cells, and no_data_value
+            elsewhere.
+
+            :return: The MEM GDAL dataset
+        '''
+        raster = getDriver('MEM').Create('', self.cols, self.rows, 1, data_type)
+        raster.SetGeoTransform(self.geotransform)
+        raster.SetProjection(self.projection)
+        band = raster.GetRasterBand(1)
+        band.SetNoDataValue(no_data_value)
+        band.WriteArray(self.makeArray(value, gdal_array.GDALTypeCodeToNumericTypeCode(data_type), no_data_value))
+        return raster
+
+
+    def createRaster(self, dest_filename, value, data_type = TSM_DATA_TYPE, no_data_value = TSM_NO_DATA_VALUE):
+        '''
+            Create a GeoTIFF on the stratum grid, with the specified value in the valid cells, and no_data_value
+            elsewhere. The GeoTIFF is created with the TSM creation options. See createTsmCopy
+        '''
+        if os.path.exists(dest_filename):
+            os.remove(dest_filename)
+
+        src_raster = self.makeRaster(value, data_type, no_data_value)
+        dest_raster = createTsmCopy(dest_filename, src_raster)
+        logging.debug('Created new {0} value raster "{1}"'.format(value, dest_filename))
+        dest_raster = None
+        src_raster = None
+
+
+class IgnitionDistribution:
+    '''
+        The distribution of ignitions over the Primary Stratum's valid cells, weighted by an ignition probability raster.
+
+        The cumulative distribution of the probabilities is computed once, and kept alongside the stratum template, so
+        each timestep only has to load it. Ignitions are then drawn with a vectorized binary search of it, so the cost
+        of a draw is O(log n) in the number of cells. The distribution is rebuilt whenever the hash of the probability
+        raster, or of the stratum, changes.
+
+        Cells where the probability raster is NoData, zero or negative are never ignited.
+    '''
+
+    def __init__(self, stratum_template, probability_filename):
+        '''
+            :param stratum_template: The StratumTemplate of the Primary Stratum
+            :param probability_filename: The ignition probability raster filename. This must have the same number of
+                rows and columns as the Primary Stratum. The probabilities are relative, so needn't sum to 1.
+        '''
+        self.stratum_template = stratum_template
+        self.probability_filename = probability_filename
+        self.__cells = None
+        self.__cdf = None
+
+        if not self.__isCurrent():
+            self.__build()
+
+
+    def __getFilename(self, filename):
+        return os.path.join(self.stratum_template.template_dir, filename)
+
+
+    def __isCurrent(self):
+        for filename in [IGNITION_DISTRIBUTION_FILENAME, IGNITION_CELLS_FILENAME, IGNITION_CDF_FILENAME]:
+            if not os.path.exists(self.__getFilename(filename)):
+                return False
+
+        distribution_filename = self.__getFilename(IGNITION_DISTRIBUTION_FILENAME)
+        try:
+            with open(distribution_filename, 'r') as f:
+                distribution = json.load(f)
+        except ValueError:
+            logging.warning('Ignoring unreadable ignition distribution "{0}"'.format(distribution_filename))
+            return False
+
+        if distribution.get('source') <> os.path.abspath(self.probability_filename) or \
+                distribution.get('stratum_hash') <> self.stratum_template.hash:
+            return False
+
+        # DEVNOTE: Only hash the probability raster if it has been rewritten since the distribution was built
+        signature = getFileSignature(self.probability_filename)
+        if distribution.get('signature') == signature:
+            return True
+
+        if distribution.get('hash') <> hashFile(self.probability_filename):
+            logging.info('Ignition Probability raster has changed, so rebuilding the ignition distribution')
+            return False
+
+        distribution['signature'] = signature
+        writeJsonFile(distribution_filename, distribution)
+        return True
+
+
+    def __build(self):
+        logging.debug('Building ignition distribution for "{0}"'.format(self.probability_filename))
+
+        gdal.UseExceptions()
+        raster = gdal.Open(self.probability_filename, gdal.GA_ReadOnly)
+        if raster is None:
+            logging.error("Cannot open Ignition Probability Raster file '{0}'".format(self.probability_filename))
+            sys.exit(1)
+
+        if raster.RasterXSize <> self.stratum_template.cols or raster.RasterYSize <> self.stratum_template.rows:
+            logging.error('The Ignition Probability raster "{0}" does not have the same number of rows and columns as the '
+                          'Primary Stratum raster'.format(self.probability_filename))
+            sys.exit(1)
+
+        band = raster.GetRasterBand(1)
+        no_data_value = band.GetNoDataValue()
+        stratum_cells = self.stratum_template.getValidCells()
+        p = band.ReadAsArray().ravel()[stratum_cells].astype(np.float64)
+        raster = None
+
+        valid = np.isfinite(p) & (p > 0)
+        if no_data_value is not None:
+            valid &= p <> no_data_value
+
+        cells = stratum_cells[valid]
+        if len(cells) == 0:
+            logging.error('The Ignition Probability raster "{0}" has no cells with a probability greater than 0'.format(
+                self.probability_filename))
+            sys.exit(1)
+
+        cdf = np.cumsum(p[valid])
+
+        # Other SyncroSim jobs may be sharing the distribution, so swap the new files in. If that fails, the distribution
+        # is only kept in memory, and rebuilt next time
+        saved = True
+        for filename, x in [(IGNITION_CELLS_FILENAME, cells), (IGNITION_CDF_FILENAME, cdf)]:
+            tmp_filename = self.__getFilename('tmp{0}-{1}'.format(os.getpid(), filename))
+            np.save(tmp_filename, x)
+            saved = replaceFile(tmp_filename, self.__getFilename(filename)) and saved
+
+        if saved:
+            writeJsonFile(self.__getFilename(IGNITION_DISTRIBUTION_FILENAME),
+                          {'source': os.path.abspath(self.probability_filename),
+                           'signature': getFileSignature(self.probability_filename),
+                           'hash': hashFile(self.probability_filename),
+                           'stratum_hash': self.stratum_template.hash})
+
+        self.__cells = cells
+        self.__cdf = cdf
+
+
+    def sample(self, num_cells):
+        '''
+            Draw cells at random, with replacement, in proportion to their ignition probability.
+
+            :param num_cells: The number of cells to draw
+            :return: An array of the flat indexes of the drawn cells
+        '''
+        if self.__cdf is None:
+            self.__cells = np.load(self.__getFilename(IGNITION_CELLS_FILENAME), mmap_mode='r')
+            self.__cdf = np.load(self.__getFilename(IGNITION_CDF_FILENAME), mmap_mode='r')
+
+        u = np.random.random_sample(num_cells) * self.__cdf[-1]
+        return self.__cells[np.searchsorted(self.__cdf, u, side='right')]
@@ -4,9 +4,36 @@ import subprocess
 import tempfile
 import csv
 import shutil
+import json
+import re
+import sqlite3
+import sys
 
 from subprocess import call
 
+if sys.platform == 'win32':
+    import pywintypes
+    import win32api
+    import win32con
+
+    # The errors raised by a failed replaceFile
+    REPLACE_FILE_ERRORS = (OSError, pywintypes.error)
+else:
+    REPLACE_FILE_ERRORS = (OSError,)
+
+from processSupervisor import SupervisedProcess, runProcess
+
+# Name of the file, in the datasheet cache directory, that records what the cached exports are valid for
+CACHE_INDEX_FILENAME = 'index.json'
+
+# Datasheet scopes, for getDataSheets requests
+SCOPE_LIBRARY = 'Library'
+SCOPE_PROJECT = 'Project'
+SCOPE_SCENARIO = 'Scenario'
+
+# Datasheet and column names are used as SQL identifiers, so they can't be passed as query parameters
+SQL_IDENTIFIER_PATTERN = re.compile(r'^\w+$')
+
 class SynrosimDB:
 
     lib_filename = ''
@@ -15,14 +42,35 @@ class SynrosimDB:
     # isValidVersion = False
     __folders = []
     syncrosim_console_path = ''
+    cache_dir = None
+    run_id = None
+    direct_db = None
 
 
-    def __init__(self,ssimFilename,console_root):
+    def __init__(self,ssimFilename,console_root, cache_dir = None, run_id = None, direct_read = False):
+        '''
+            :param ssimFilename: The full path of the SyncroSim library
+            :param console_root: The directory containing SyncroSim.Console.exe
+            :param cache_dir: (Optional) Directory in which to cache datasheet exports between invocations. If not
+                specified, every datasheet request results in a SyncroSim.Console export.
+            :param run_id: (Optional) Identifies the current run. A change in run ID invalidates the whole cache.
+            :param direct_read: (Optional) If True, answer ID and output raster lookups by reading the library directly
+                (see SynrosimSQLiteDB), falling back to SyncroSim.Console if that fails.
+        '''
         self.lib_filename = ssimFilename
 
+        if direct_read:
+            self.direct_db = SynrosimSQLiteDB(ssimFilename)
+
         # Gotta do this before anything else, as this points to Console exe, which most/all other functions rely on.
         self.syncrosim_console_path = os.path.join(console_root,'SyncroSim.Console.exe')
 
+        self.cache_dir = cache_dir
+        self.run_id = run_id
+        self.__output_indexes = {}
+        if self.cache_dir:
+            self.__validateCache()
+
         fld = self.getFolders()
         if fld:
             self.__folders = fld[0]
@@ -261,21 +309,150 @@ class SynrosimDB:
             :param pkName: The name of the PK value column ( ie 'StateAttributeTypeID")
         '''
 
-        rows = self.getScenarioDataSheet(dsName, scenarioId)
-        if rows == None or len(rows) == 0:
-            logging.error('Could not find entries for Datasheet {1} for Scenario {0}'.format(
-                scenarioId,dsName))
+        rasters = self.getOutputSpatialRasters(scenarioId, dsName, iteration, timestep, [id], pkName)
+        if rasters is None:
             return None
 
-        #     Now we need to loop thru the datasheet contents looking for appropriate iteration, timesteps, id
-        for row in rows:
-            print row
-            if row['Iteration'] == str(iteration) and row['Timestep']== str(timestep) and row[pkName]== str(id):
-                return row['Filename']
+        return rasters[id]
 
-        else:
+
+    def getOutputSpatialRasters(self, scenarioId, dsName, iteration, timestep, ids, pkName):
+        '''
+            Get the raster names for several ID values from the specified Output Spatial datasheet, in a single pass.
+
+            The datasheet grows by (state attributes x timesteps x iterations) rows over the run, so rather than
+            rescanning the whole export on each call, we keep an index of the rows that we've already seen (see
+            __updateOutputSpatialIndex), and only parse the rows appended since the last call.
+
+            :param scenarioId: The scenario of interest
+            :param dsName : The name of the datasheet we're extracting the rasters from
+            :param iteration: The iteration of interest
+            :param timestep: The timestep of interest
+            :param ids: The ID values of interest. Can typically be the lookup values.
+            :param pkName: The name of the PK value column ( ie 'StateAttributeTypeID")
+            :return: A dict of raster name by ID value ( None if no raster found), or None if the datasheet couldn't
+                be read
+        '''
+
+        if self.direct_db:
+            try:
+                return self.direct_db.getOutputSpatialRasters(scenarioId, dsName, iteration, timestep, ids, pkName)
+            except sqlite3.Error as ex:
+                logging.warning('Direct read of Datasheet {0} failed ({1}). Using SyncroSim.Console instead.'.format(dsName, ex))
+
+        index = self.__getOutputSpatialIndex(scenarioId, dsName, iteration, pkName)
+        keys = dict((id, '{0}|{1}|{2}'.format(iteration, timestep, id)) for id in ids)
+
+        # Only go to SyncroSim.Console if we haven't already seen all the rows we're after
+        if not all(key in index['entries'] for key in keys.values()):
+            if not self.__updateOutputSpatialIndex(index, scenarioId, dsName, pkName):
+                return None
+
+            self.__saveOutputSpatialIndex(index, scenarioId, dsName)
+
+        return dict((id, index['entries'].get(key)) for id, key in keys.items())
+
+
+    def __getOutputSpatialIndexFilename(self, scenarioId, dsName):
+        if not self.cache_dir:
             return None
 
+        return os.path.join(self.cache_dir, 'Index-{0}-{1}.json'.format(scenarioId, dsName))
+
+
+    def __getOutputSpatialIndex(self, scenarioId, dsName, iteration, pkName):
+        '''
+            Get the index of the Output Spatial datasheet rows already seen.
+
+            The index contains the number of rows seen, the last row seen and the byte offsets of its start and end in
+            the export (to skip straight to the new rows, and detect the datasheet being rewritten), and the raster
+            filenames by iteration, timestep and ID. Entries for iterations before the specified one are
+            dropped, as iterations only move forward during a run.
+        '''
+
+        key = (scenarioId, dsName)
+        index = self.__output_indexes.get(key)
+        if index is None:
+            filename = self.__getOutputSpatialIndexFilename(scenarioId, dsName)
+            if filename and os.path.exists(filename):
+                try:
+                    with open(filename, 'r') as f:
+                        index = json.load(f)
+                except ValueError:
+                    logging.warning('Ignoring unreadable Output Spatial index "{0}"'.format(filename))
+
+        # DEVNOTE: Indexes saved before the offsets were recorded are rebuilt
+        if index is None or index['pk'] <> pkName or index['iteration'] > iteration or 'offset' not in index:
+            index = {'pk': pkName, 'iteration': iteration, 'rows': 0, 'last': None, 'last_offset': 0, 'offset': 0,
+                     'entries': {}}
+
+        elif index['iteration'] < iteration:
+            index['entries'] = dict((k, v) for k, v in index['entries'].items() if int(k.split('|', 1)[0]) >= iteration)
+            index['iteration'] = iteration
+
+        self.__output_indexes[key] = index
+        return index
+
+
+    def __updateOutputSpatialIndex(self, index, scenarioId, dsName, pkName):
+        '''
+            Export the Output Spatial datasheet, and add any rows not already in the index. Rows are filtered on
+            iteration as they are parsed, so only those for the current (or a later) iteration are kept.
+
+            :return: True if successful
+        '''
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            export_filename = os.path.join(tmp_dir, "export.csv")
+            if not self.__exportDataSheet(dsName, SCOPE_SCENARIO, scenarioId, export_filename):
+                return False
+
+            with open(export_filename, 'rb') as f:
+                header = next(readCsvRecords(f), None)
+                if header is None:
+                    return True
+
+                header, header_offset = header
+                try:
+                    col_iteration, col_timestep, col_id, col_filename = \
+                        [header.index(col) for col in ('Iteration', 'Timestep', pkName, 'Filename')]
+                except ValueError:
+                    logging.error('Datasheet {0} is missing expected columns ({1})'.format(dsName, ','.join(header)))
+                    return False
+
+                if index['rows'] > 0:
+                    # Skip straight to the rows we haven't seen, but make sure that the last row we saw is still where
+                    # we left it. If not, the datasheet has been rewritten, so start over.
+                    f.seek(index['last_offset'])
+                    last = next(readCsvRecords(f), None)
+                    if last is None or last[0] <> index['last'] or last[1] <> index['offset']:
+                        logging.debug('Datasheet {0} has changed. Rebuilding Output Spatial index.'.format(dsName))
+                        index.update({'rows': 0, 'last': None, 'last_offset': 0, 'offset': header_offset,
+                                      'entries': {}})
+                else:
+                    index['offset'] = header_offset
+
+                f.seek(index['offset'])
+                entries = index['entries']
+                for row, offset in readCsvRecords(f):
+                    index['rows'] += 1
+                    index['last'] = row
+                    index['last_offset'], index['offset'] = index['offset'], offset
+                    if int(row[col_iteration]) >= index['iteration']:
+                        entries['{0}|{1}|{2}'.format(row[col_iteration], row[col_timestep], row[col_id])] = row[col_filename]
+
+            return True
+
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def __saveOutputSpatialIndex(self, index, scenarioId, dsName):
+        filename = self.__getOutputSpatialIndexFilename(scenarioId, dsName)
+        if filename:
+            writeJsonFile(filename, index)
+
 
     def getTransitionAttributes(self, projectId):
         '''
@@ -317,44 +494,195 @@ class SynrosimDB:
 
     def __getDataSheet(self, data_sheet_name, project_id = None,scenario_id = None):
 
-        # Ex:SyncroSim.Console.exe" --lib="libname.ssim" --export --sheet=ST_StateAttributeTypeID --file=temp.csv --pid=256
+        if scenario_id <> None:
+            request = (data_sheet_name, SCOPE_SCENARIO, scenario_id)
+        elif project_id <> None:
+            request = (data_sheet_name, SCOPE_PROJECT, project_id)
+        else:
+            request = (data_sheet_name, SCOPE_LIBRARY, None)
+
+        return self.getDataSheets([request])[request]
+
+
+    def getDataSheets(self, requests):
+        '''
+            Get several datasheets at once. Datasheets that aren't already cached are all exported together, so the
+            SyncroSim.Console startup and library open costs are paid concurrently rather than one after the other.
+
+            DEVNOTE: SyncroSim.Console only exports a single sheet per invocation, so we can't do this in a single
+            console session. Launching the exports side by side gets us most of the way there.
+
+            :param requests: A list of (datasheet name, scope, ID) tuples, where scope is one of SCOPE_LIBRARY,
+                SCOPE_PROJECT or SCOPE_SCENARIO, and ID is the Project/Scenario ID ( None for Library).
+            :return: A dict of the datasheet rows ( None if the export failed), keyed by request tuple
+        '''
+
+        sheets = {}
+        pending = []
+        for request in requests:
+            if request in sheets or request in pending:
+                continue
+
+            cache_filename = self.__getCacheFilename(*request)
+            if cache_filename and os.path.exists(cache_filename):
+                logging.debug('Using cached export of Datasheet {0} "{1}"'.format(request[0], cache_filename))
+                sheets[request] = readCsvFile(cache_filename)
+            else:
+                pending.append(request)
+
+        if not pending:
+            return sheets
+
         tmp_dir = tempfile.mkdtemp()
-        export_filename = os.path.join(tmp_dir, "export.csv")
+        try:
+            exports = []
+            for i, request in enumerate(pending):
+                export_filename = os.path.join(tmp_dir, "export{0}.csv".format(i))
+                cmdLine = self.__getExportCmdLine(request, export_filename)
+                exports.append((request, export_filename, cmdLine,
+                                SupervisedProcess(cmdLine, 'SyncroSim.Console').start()))
 
+            for request, export_filename, cmdLine, proc in exports:
+                if proc.wait().exit_code <> 0:
+                    logging.error("Problems exporting. cmd:{0}".format(cmdLine))
+                    sheets[request] = None
+                    continue
 
+                sheets[request] = readCsvFile(export_filename)
+
+                # Keep the export for subsequent requests for the same sheet
+                cache_filename = self.__getCacheFilename(*request)
+                if cache_filename:
+                    shutil.move(export_filename, cache_filename)
+
+        finally:
+            # Clean up the temp files
+            shutil.rmtree(tmp_dir)
+
+        return sheets
+
+
+    def __getExportCmdLine(self, request, export_filename):
+
+        data_sheet_name, scope, id = request
+
+        # Ex:SyncroSim.Console.exe" --lib="libname.ssim" --export --sheet=ST_StateAttributeTypeID --file=temp.csv --pid=256
         cmdLine = '"{0}" --lib="{1}" --export --sheet="{2}" --file="{3}" - --includepk'.format(self.syncrosim_console_path,
                                                                                        self.lib_filename,
                                                                                        data_sheet_name,
                                                                                        export_filename)
-        if project_id <> None:
-            cmdLine += ' --pid={0}'.format(project_id)
+        if scope == SCOPE_PROJECT:
+            cmdLine += ' --pid={0}'.format(id)
 
-        if scenario_id <> None:
-            cmdLine += ' --sid={0}'.format(scenario_id)
+        if scope == SCOPE_SCENARIO:
+            cmdLine += ' --sid={0}'.format(id)
 
-        proc = subprocess.call(cmdLine)
+        return cmdLine
+
+
+    def __exportDataSheet(self, data_sheet_name, scope, id, export_filename):
+        '''
+            Export the specified datasheet to a CSV file thru SyncroSim.Console
+
+            :return: True if successful
+        '''
+
+        cmdLine = self.__getExportCmdLine((data_sheet_name, scope, id), export_filename)
+        proc = runProcess(cmdLine, 'SyncroSim.Console').exit_code
         if proc<> 0:
             logging.error("Problems exporting. cmd:{0}".format(cmdLine))
+            return False
+
+        return True
+
+
+    def __getCacheFilename(self, data_sheet_name, scope, id):
+        '''
+            Get the name of the cache file for the specified datasheet export, keyed by sheet name, scope and ID.
+
+            :return: The cache filename, or None if caching is not enabled.
+        '''
+        if not self.cache_dir:
             return None
 
-        with open(export_filename, 'rb') as f:
-            reader = csv.DictReader(f)
-            lst = list(reader)
+        if scope == SCOPE_LIBRARY:
+            key = '{0}-{1}'.format(scope, data_sheet_name)
+        else:
+            key = '{0}-{1}-{2}'.format(scope, id, data_sheet_name)
 
-        # Clean up the temp file
-        shutil.rmtree(tmp_dir)
-        return lst
+        return os.path.join(self.cache_dir, key + '.csv')
 
 
-    def getDataSheetVal(self, project_id, data_sheet_name, key_name, key_val, val_name):
+    def __getLibrarySignature(self):
+        st = os.stat(self.lib_filename)
+        return [st.st_mtime, st.st_size]
 
-        rows = self.__getDataSheet(data_sheet_name, project_id)
-        for row in rows:
-            if row[key_name] == key_val:
-                return row[val_name]
 
+    def __validateCache(self):
+        '''
+            Drop any cached datasheet exports that are no longer valid.
+
+            Library and Project scoped datasheets can't change while a scenario is running, so they are kept for the
+            whole run, and only dropped at a run boundary (different library or run ID). Scenario scoped datasheets
+            include the outputs that SyncroSim writes as the run progresses, so they are dropped whenever the library
+            file's modification time or size changes.
+        '''
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        index_filename = os.path.join(self.cache_dir, CACHE_INDEX_FILENAME)
+        index = {}
+        if os.path.exists(index_filename):
+            try:
+                with open(index_filename, 'r') as f:
+                    index = json.load(f)
+            except ValueError:
+                logging.warning('Ignoring unreadable datasheet cache index "{0}"'.format(index_filename))
+
+        signature = self.__getLibrarySignature()
+        if index.get('library') <> self.lib_filename or index.get('run') <> self.run_id:
+            logging.debug('Clearing datasheet cache "{0}" at run boundary'.format(self.cache_dir))
+            stale_prefix = ''
+        elif index.get('signature') <> signature:
+            logging.debug('Library has changed. Clearing Scenario datasheets from cache "{0}"'.format(self.cache_dir))
+            stale_prefix = SCOPE_SCENARIO + '-'
         else:
-            return None
+            return
+
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.csv') and filename.startswith(stale_prefix):
+                os.remove(os.path.join(self.cache_dir, filename))
+            elif filename.startswith('Index-') and stale_prefix == '':
+                # The Output Spatial indexes validate themselves as the datasheet grows, so only drop at a run boundary
+                os.remove(os.path.join(self.cache_dir, filename))
+
+        writeJsonFile(index_filename, {'library': self.lib_filename, 'run': self.run_id, 'signature': signature})
+
+
+    def invalidateCache(self):
+        '''
+            Remove all cached datasheet exports. Call at a run boundary if the cache directory is shared between runs.
+        '''
+        if not self.cache_dir or not os.path.exists(self.cache_dir):
+            return
+
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.csv') or filename.startswith('Index-'):
+                os.remove(os.path.join(self.cache_dir, filename))
+
+        self.__output_indexes = {}
+
+
+    def getDataSheetVal(self, project_id, data_sheet_name, key_name, key_val, val_name):
+
+        if self.direct_db:
+            try:
+                return self.direct_db.getDataSheetVal(project_id, data_sheet_name, key_name, key_val, val_name)
+            except sqlite3.Error as ex:
+                logging.warning('Direct read of Datasheet {0} failed ({1}). Using SyncroSim.Console instead.'.format(data_sheet_name, ex))
+
+        rows = self.__getDataSheet(data_sheet_name, project_id)
+        return findDataSheetVal(rows, key_name, key_val, val_name)
 
 
     def putDataSheet(self, data_sheet_name, scenario_id):
@@ -472,31 +800,293 @@ class SynrosimDB:
     def putTransitionSpatialMult(self, export_dir, scenarioId, iteration, timestep, transitionGroupId, transitionMultiplierType,
                                  multiplierFileName):
 
-        # ' Create a CSV file   with following header columms:
-        # Iteration
-        # Timestep
-        # TransitionGroupID
-        # TransitionMultiplierTypeID
-        # MultiplierFileName
-        sheet = 'STSim_TransitionSpatialMultiplier'
-        export_filename = os.path.join(export_dir,sheet + '.csv')
-        # TODO: See of lineterminator and/or open with 'w' vs 'wb' will give us grief in Linux
-        with open(export_filename, 'w') as csvfile:
-            fieldnames = ['Iteration','Timestep','TransitionGroupID','TransitionMultiplierTypeID','MultiplierFileName']
-            writer = csv.DictWriter(csvfile,lineterminator='\n', fieldnames=fieldnames)
-
-            writer.writeheader()
-            writer.writerow({'Iteration': iteration,
-                             'Timestep': timestep,
-                             'TransitionGroupID':transitionGroupId,
-                             'TransitionMultiplierTypeID':transitionMultiplierType,
-                             'MultiplierFileName':multiplierFileName})
-
-
-            csvfile.flush()
-            os.fsync(csvfile.fileno())
-
-        logging.debug('Created new Transition Spatial Multiplier Import File "{0}".'.format(export_filename))
+        writeTransitionSpatialMultFile(export_dir, iteration, timestep, transitionGroupId, transitionMultiplierType,
+                                       multiplierFileName)
+
+
+
+
+class SynrosimSQLiteDB:
+    '''
+        Read-only access to a SyncroSim library, reading the datasheet tables directly from the .ssim SQLite database
+        rather than exporting them thru SyncroSim.Console.
+
+        DEVNOTE: Rows are returned as dicts of strings, the same as the SynrosimDB CSV exports, but contain the values
+        as stored in the library. Lookup columns contain the IDs rather than the Names, and Boolean columns contain the
+        stored integer rather than 'Yes'/'No'. getDataSheetVal and getOutputSpatialRaster return the same values as the
+        SynrosimDB versions, so those are safe to use interchangeably.
+    '''
+
+    lib_filename = ''
+
+    def __init__(self, ssimFilename, timeout = 30.0):
+        '''
+            :param ssimFilename: The full path of the SyncroSim library
+            :param timeout: How long (secs) to wait for SyncroSim to release a lock on the library
+        '''
+        self.lib_filename = ssimFilename
+        self.timeout = timeout
+        self.__conn = None
+
+
+    def __getConnection(self):
+        if self.__conn is None:
+            if not os.path.exists(self.lib_filename):
+                raise sqlite3.OperationalError('Library "{0}" not found'.format(self.lib_filename))
+
+            # DEVNOTE: Python 2.7 sqlite3 doesn't support URI filenames ( ie ?mode=ro), so use query_only to make sure
+            # we never write to the library SyncroSim is running against.
+            self.__conn = sqlite3.connect(self.lib_filename, timeout=self.timeout)
+            self.__conn.execute('PRAGMA query_only = ON')
+            # Return TEXT as byte strings, the same as the csv module does for the exports
+            self.__conn.text_factory = str
+
+        return self.__conn
+
+
+    def close(self):
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
+
+
+    def __query(self, sql, params = ()):
+        cursor = self.__getConnection().execute(sql, params)
+        columns = [col[0] for col in cursor.description]
+        return [dict(zip(columns, ['' if val is None else str(val) for val in row])) for row in cursor]
+
+
+    def __getDataSheet(self, data_sheet_name, id_column = None, id_value = None):
+
+        sql = 'SELECT * FROM {0}'.format(quoteIdentifier(data_sheet_name))
+        if id_column is None:
+            return self.__query(sql)
+
+        return self.__query(sql + ' WHERE {0} = ?'.format(quoteIdentifier(id_column)), (id_value,))
+
+
+    def getLibDataSheet(self, data_sheet_name):
+
+        return self.__getDataSheet(data_sheet_name)
+
+
+    def getProjectDataSheet(self, data_sheet_name, project_id):
+
+        return self.__getDataSheet(data_sheet_name, 'ProjectID', int(project_id))
+
+
+    def getScenarioDataSheet(self, data_sheet_name, scenario_id):
+
+        return self.__getDataSheet(data_sheet_name, 'ScenarioID', int(scenario_id))
+
+
+    def getDataSheetVal(self, project_id, data_sheet_name, key_name, key_val, val_name):
+
+        sql = 'SELECT {0} FROM {1} WHERE ProjectID = ? AND {2} = ? LIMIT 1'.format(quoteIdentifier(val_name),
+                                                                               quoteIdentifier(data_sheet_name),
+                                                                               quoteIdentifier(key_name))
+        rows = self.__query(sql, (int(project_id), key_val))
+        if rows:
+            return rows[0][val_name]
+
+        return None
+
+
+    def getOutputSpatialRaster(self, scenarioId, dsName, iteration, timestep, id, pkName):
+        '''
+            Get the raster name from the specified Output Spatial datasheet
+
+            :param scenarioId: The scenario of interest
+            :param dsName : The name of the datasheet we're extracting the raster from
+            :param iteration: The iteration of interest
+            :param timestep: The timestep of interest
+            :param id: The ID value of interest. Can also be the lookup value. ie 'Invaded Cover' instead of 156.
+            :param pkName: The name of the PK value column ( ie 'StateAttributeTypeID")
+        '''
+
+        return self.getOutputSpatialRasters(scenarioId, dsName, iteration, timestep, [id], pkName)[id]
+
+
+    def getOutputSpatialRasters(self, scenarioId, dsName, iteration, timestep, ids, pkName):
+        '''
+            Get the raster names for several ID values from the specified Output Spatial datasheet, in a single query.
+
+            :param ids: The ID values of interest. Can also be the lookup values. ie 'Invaded Cover' instead of 156.
+            :return: A dict of raster name by ID value ( None if no raster found)
+        '''
+
+        # If lookup values were specified, resolve them thru the Project's lookup datasheet, which by convention is
+        # named after the PK column. ie StateAttributeTypeID -> STSim_StateAttributeType
+        by_name = not all(str(id).isdigit() for id in ids)
+        if by_name:
+            lookup_sheet = dsName.split('_')[0] + '_' + pkName[:-2]
+            sql = 'SELECT o.{1}, o.Filename, l.Name FROM {0} o LEFT JOIN {2} l ON l.{1} = o.{1} '.format(
+                quoteIdentifier(dsName), quoteIdentifier(pkName), quoteIdentifier(lookup_sheet))
+        else:
+            sql = 'SELECT o.{1}, o.Filename FROM {0} o '.format(quoteIdentifier(dsName), quoteIdentifier(pkName))
+
+        sql += 'WHERE o.ScenarioID = ? AND o.Iteration = ? AND o.Timestep = ?'
+        rows = self.__query(sql, (int(scenarioId), int(iteration), int(timestep)))
+
+        rasters = dict((id, None) for id in ids)
+        for row in rows:
+            for id in ids:
+                if str(id) == row[pkName] or (by_name and id == row['Name']):
+                    rasters[id] = row['Filename']
+
+        return rasters
+
+
+def writeTransitionSpatialMultFile(export_dir, iteration, timestep, transitionGroupId, transitionMultiplierType,
+                                   multiplierFileName):
+    '''
+        Write the Transition Spatial Multiplier import file that SyncroSim picks up from the transfer directory. This
+        doesn't touch the library, so can be used without a SynrosimDB.
+    '''
+
+    # ' Create a CSV file   with following header columms:
+    # Iteration
+    # Timestep
+    # TransitionGroupID
+    # TransitionMultiplierTypeID
+    # MultiplierFileName
+    sheet = 'STSim_TransitionSpatialMultiplier'
+    export_filename = os.path.join(export_dir,sheet + '.csv')
+    # TODO: See of lineterminator and/or open with 'w' vs 'wb' will give us grief in Linux
+    with open(export_filename, 'w') as csvfile:
+        fieldnames = ['Iteration','Timestep','TransitionGroupID','TransitionMultiplierTypeID','MultiplierFileName']
+        writer = csv.DictWriter(csvfile,lineterminator='\n', fieldnames=fieldnames)
+
+        writer.writeheader()
+        writer.writerow({'Iteration': iteration,
+                         'Timestep': timestep,
+                         'TransitionGroupID':transitionGroupId,
+                         'TransitionMultiplierTypeID':transitionMultiplierType,
+                         'MultiplierFileName':multiplierFileName})
+
+
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+
+    logging.debug('Created new Transition Spatial Multiplier Import File "{0}".'.format(export_filename))
+
+
+def findDataSheetVal(rows, key_name, key_val, val_name):
+    '''
+        Find the value of the specified column in the first datasheet row with the specified key value.
+
+        :return: The value, or None if there's no such row
+    '''
+    for row in rows or []:
+        if row[key_name] == key_val:
+            return row[val_name]
+
+    return None
+
+
+def readCsvFile(filename):
+    '''
+        Read the specified datasheet export into a list of dicts, one per row.
+    '''
+    with open(filename, 'rb') as f:
+        reader = csv.DictReader(f)
+        return list(reader)
+
+
+def readCsvRecords(f):
+    '''
+        Read the CSV records from the current position of the file, along with the byte offset of the end of each, so
+        that a later read can seek straight past them.
+
+        DEVNOTE: The lines are read with readline, rather than by iterating over the file, as the read-ahead of file
+        iteration makes tell() unreliable in Python 2.
+
+        :return: A generator of ( record, end offset) tuples
+    '''
+    end = [f.tell()]
+
+    def readLines():
+        while True:
+            line = f.readline()
+            if not line:
+                return
+            end[0] = f.tell()
+            yield line
+
+    for record in csv.reader(readLines()):
+        yield record, end[0]
+
+
+def writeJsonFile(filename, obj):
+    '''
+        Write the object to the specified JSON file, replacing it as a whole so that readers never see a partial file.
+
+        The JSON files are all caches, so this is best-effort: a failed write is logged, and the file is left as it was.
+
+        :return: True if the file was written
+    '''
+    tmp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+    try:
+        with open(tmp_filename, 'w') as f:
+            json.dump(obj, f)
+    except (IOError, OSError) as ex:
+        logging.warning('Could not write "{0}" ({1})'.format(filename, ex))
+        removeFile(tmp_filename)
+        return False
+
+    return replaceFile(tmp_filename, filename)
+
+
+def replaceFile(src_filename, dest_filename):
+    '''
+        Move the source file over the destination file, in a single step, so that readers see either the old file or
+        the new one, but never a partial file or no file.
+
+        Several SyncroSim jobs may be reading or replacing the destination at the same time, so the move can fail ( ie
+        on Windows, if a reader has the old file open without sharing delete). The files moved are all caches, so a
+        failure is logged and the source file removed, and the caller carries on without it.
+
+        :return: True if the destination was replaced
+    '''
+    try:
+        if sys.platform == 'win32':
+            # DEVNOTE: os.rename won't replace an existing file on Windows, and removing it first isn't atomic
+            win32api.MoveFileEx(src_filename, dest_filename, win32con.MOVEFILE_REPLACE_EXISTING)
+        else:
+            os.rename(src_filename, dest_filename)
+
+        return True
+
+    except REPLACE_FILE_ERRORS as ex:
+        logging.warning('Could not replace "{0}" ({1})'.format(dest_filename, ex))
+        removeFile(src_filename)
+        return False
+
+
+def removeFile(filename):
+    '''
+        Remove the file if it exists, ignoring failures ( ie on Windows, if another job has it open or mapped).
+
+        :return: True if the file no longer exists
+    '''
+    try:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return True
+
+    except OSError as ex:
+        logging.debug('Could not remove "{0}" ({1})'.format(filename, ex))
+        return False
+
+
+def quoteIdentifier(name):
+    '''
+        Quote a datasheet or column name for use in a SQL statement.
+    '''
+    if not SQL_IDENTIFIER_PATTERN.match(name):
+        raise sqlite3.ProgrammingError('Invalid datasheet or column name "{0}"'.format(name))
+
+    return '"{0}"'.format(name)
 
 
 
@@ -0,0 +1,187 @@
+﻿import datetime
+import logging
+import os
+import sys
+
+import numpy as np
+
+from syncrosim import replaceFile
+
+# Columns of the Farsite_Weather datasheet, and the array each is loaded into
+WEATHER_COLUMNS = [('Year', 'year', np.int32), ('Month', 'month', np.int32), ('Day', 'day', np.int32),
+                   ('Precipitation', 'precipitation', np.float64),
+                   ('MinTempHour', 'min_temp_hour', np.int32), ('MaxTempHour', 'max_temp_hour', np.int32),
+                   ('MinTemp', 'min_temp', np.int32), ('MaxTemp', 'max_temp', np.int32),
+                   ('MaxHumidity', 'max_humidity', np.int32), ('MinHumidity', 'min_humidity', np.int32),
+                   ('Elevation', 'elevation', np.int32)]
+
+# Columns of the Farsite_Wind datasheet, and the array each is loaded into
+WIND_COLUMNS = [('Year', 'year', np.int32), ('Month', 'month', np.int32), ('Day', 'day', np.int32),
+                ('Hour', 'hour', np.int32), ('Speed', 'speed', np.int32), ('Direction', 'direction', np.int32),
+                ('CloudCover', 'cloud_cover', np.int32)]
+
+# Records are emitted for this many days either side of the fire, so that the weather bookends the fire's start and end
+WINDOW_BUFFER_DAYS = 1
+
+
+def makeStream(rows, columns, name):
+    '''
+        Load datasheet rows into columnar arrays, sorted by time. Each record's time is its key: the proleptic Gregorian
+        ordinal of its date, plus the fraction of the day for hourly records.
+
+        :param rows: The datasheet rows, as dicts of strings
+        :param columns: The (datasheet column, array name, dtype) of each column
+        :param name: The name of the stream, for messages
+        :return: A dict of the arrays, including 'key'
+    '''
+    stream = {}
+    for column, array_name, dtype in columns:
+        try:
+            stream[array_name] = np.array([row[column] for row in rows], dtype=dtype)
+        except (KeyError, ValueError):
+            logging.error('The {0} datasheet has a missing or invalid {1} value'.format(name, column))
+            sys.exit(1)
+
+    try:
+        key = np.array([datetime.date(year, month, day).toordinal() for year, month, day in
+                        zip(stream['year'], stream['month'], stream['day'])], dtype=np.float64)
+    except ValueError as ex:
+        logging.error('The {0} datasheet has an invalid date: {1}'.format(name, ex))
+        sys.exit(1)
+
+    if 'hour' in stream:
+        key += stream['hour'] / 24.0
+
+    order = np.argsort(key, kind='mergesort')
+    stream = dict((array_name, x[order]) for array_name, x in stream.items())
+    stream['key'] = key[order]
+    return stream
+
+
+def saveWeatherStreams(filename, weather_rows, wind_rows):
+    '''
+        Save the Farsite_Weather and Farsite_Wind datasheets as columnar arrays, for WeatherStreams to load.
+
+        :return: The names of the streams saved. ie ['weather', 'wind']. Empty if neither datasheet has any rows.
+    '''
+    arrays = {}
+    streams = []
+    for name, rows, columns in [('weather', weather_rows, WEATHER_COLUMNS), ('wind', wind_rows, WIND_COLUMNS)]:
+        if rows:
+            for array_name, x in makeStream(rows, columns, name).items():
+                arrays[name + '_' + array_name] = x
+            streams.append(name)
+
+    if streams:
+        tmp_filename = '{0}.tmp{1}.npz'.format(filename, os.getpid())
+        np.savez(tmp_filename, **arrays)
+
+        # DEVNOTE: Unlike the caches, the timesteps can't do without the streams
+        if not replaceFile(tmp_filename, filename):
+            logging.error('Could not save the weather streams "{0}"'.format(filename))
+            sys.exit(1)
+
+    return streams
+
+
+class WeatherStreams:
+    '''
+        The time-varying daily weather and hourly wind records of a scenario.
+
+        For each fire, only the records covering the fire, plus a small buffer, are written to the inputs file. These
+        are found by binary search of the records' time keys, rather than scanning or writing every record.
+    '''
+
+    def __init__(self, filename):
+        '''
+            :param filename: The arrays saved by saveWeatherStreams
+        '''
+        arrays = np.load(filename)
+        self.weather = self.__getStream(arrays, 'weather')
+        self.wind = self.__getStream(arrays, 'wind')
+        arrays.close()
+
+
+    @staticmethod
+    def __getStream(arrays, name):
+        prefix = name + '_'
+        stream = dict((key[len(prefix):], arrays[key]) for key in arrays.files if key.startswith(prefix))
+        return stream or None
+
+
+    def getYears(self):
+        '''
+            :return: The sorted years covered by the streams
+        '''
+        years = [stream['year'] for stream in [self.weather, self.wind] if stream]
+        return np.unique(np.concatenate(years))
+
+
+    def chooseYear(self, timestep):
+        '''
+            Choose the year of weather to use for a fire. This is the timestep, if the streams cover it, otherwise a
+            year drawn at random from those they cover.
+        '''
+        years = self.getYears()
+        if timestep in years:
+            return int(timestep)
+
+        return int(np.random.choice(years))
+
+
+    @staticmethod
+    def __getWindow(stream, name, start_datetime, end_datetime):
+        # The records are written as month and day only, so the window must stay within the fire's year
+        year_start = datetime.date(start_datetime.year, 1, 1).toordinal()
+        year_end = datetime.date(start_datetime.year, 12, 31).toordinal() + 1
+        start = max(start_datetime.toordinal() - WINDOW_BUFFER_DAYS, year_start)
+        end = min(end_datetime.toordinal() + 1 + WINDOW_BUFFER_DAYS, year_end)
+        first, last = np.searchsorted(stream['key'], [start, end])
+
+        # Farsite needs the records to bookend the fire
+        if first == last or stream['key'][first] > start_datetime.toordinal() or \
+                stream['key'][last - 1] < end_datetime.toordinal():
+            logging.error('The {0} datasheet does not cover the fire from {1} to {2}'.format(name, start_datetime,
+                                                                                            end_datetime))
+            sys.exit(1)
+
+        return first, last
+
+
+    def formatWeather(self, start_datetime, end_datetime):
+        '''
+            Format the WEATHER_DATA section of the inputs file, for a fire between the specified times.
+        '''
+        s = self.weather
+        first, last = self.__getWindow(s, 'Farsite_Weather', start_datetime, end_datetime)
+
+        lines = ['WEATHER_DATA: {0}\n'.format(last - first)]
+        for i in range(first, last):
+            # DEVNOTE: Precipitation Times are supposed to optional, but seem to be required if a precip value of <> 0
+            # enter, so hack in 0 and 24
+            precip_time = '' if s['precipitation'][i] == 0 else '0 24'
+            lines.append('{0:02d} {1:02d} {2} {3} {4} {5} {6} {7} {8} {9} {10}\n'.format(
+                s['month'][i], s['day'][i], int(s['precipitation'][i] * 100),
+                s['min_temp_hour'][i] * 100, s['max_temp_hour'][i] * 100, s['min_temp'][i], s['max_temp'][i],
+                s['max_humidity'][i], s['min_humidity'][i], s['elevation'][i], precip_time))
+
+        # DEVNOTE: Hardcode units to English, to match the units in the STSim UI boilerplate
+        lines.append('WEATHER_DATA_UNITS: English\n\n')
+        return ''.join(lines)
+
+
+    def formatWind(self, start_datetime, end_datetime):
+        '''
+            Format the WIND_DATA section of the inputs file, for a fire between the specified times.
+        '''
+        s = self.wind
+        first, last = self.__getWindow(s, 'Farsite_Wind', start_datetime, end_datetime)
+
+        lines = ['WIND_DATA: {0}\n'.format(last - first)]
+        for i in range(first, last):
+            lines.append('{0:02d} {1:02d} {2} {3} {4} {5}\n'.format(
+                s['month'][i], s['day'][i], s['hour'][i] * 100, s['speed'][i], s['direction'][i], s['cloud_cover'][i]))
+
+        # DEVNOTE: Hardcode units to English, to match the units in the STSim UI boilerplate
+        lines.append('WIND_DATA_UNITS: English\n\n')
+        return ''.join(lines)
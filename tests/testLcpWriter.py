@@ -0,0 +1,59 @@
+﻿import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'Scripts'))
+
+import lcpWriter
+
+LANDSCAPE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'landscape')
+
+# The themes of the sample landscape, and the names recorded for them in the header of sample.lcp. It was made with:
+#   lcpmake -latitude 45 -landscape sample -elevation elevation.asc -slope slope.asc -aspect aspect.asc
+#       -fuel fuel.asc -cover cover.asc
+THEME_FILENAMES = ['elevation.asc', 'slope.asc', 'aspect.asc', 'fuel.asc', 'cover.asc']
+LATITUDE = 45
+
+
+class TestWriteLCP(unittest.TestCase):
+    '''
+        writeLCP should write the same bytes as lcpmake.exe. The sample landscape has NoData cells in every theme but
+        slope, more elevation values than the header can list, and an origin that isn't a whole km.
+    '''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        with open(os.path.join(LANDSCAPE_DIR, 'sample.lcp'), 'rb') as f:
+            self.expected = f.read()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
+    def writeSample(self, block_rows = lcpWriter.ROW_BLOCK_SIZE):
+        sources = [os.path.join(LANDSCAPE_DIR, filename) for filename in THEME_FILENAMES]
+        landscape_filename = os.path.join(self.temp_dir, 'sample.lcp')
+        lcpWriter.writeLCP(landscape_filename, sources, LATITUDE, sources[0], THEME_FILENAMES, block_rows)
+        with open(landscape_filename, 'rb') as f:
+            return f.read()
+
+
+    def assertSameLCP(self, actual):
+        self.assertEqual(len(actual), len(self.expected))
+        self.assertEqual(lcpWriter.unpackHeader(actual), lcpWriter.unpackHeader(self.expected))
+        self.assertEqual(actual, self.expected)
+
+
+    def testMatchesLcpMake(self):
+        self.assertSameLCP(self.writeSample())
+
+
+    def testRowBlocks(self):
+        self.assertSameLCP(self.writeSample(block_rows = 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
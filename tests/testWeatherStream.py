@@ -0,0 +1,92 @@
+﻿import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'Scripts'))
+
+from weatherStream import WeatherStreams, saveWeatherStreams
+
+# Wind records are made for these hours of each day
+WIND_HOURS = [0, 6, 12, 18]
+
+
+def makeRows(first_date, last_date):
+    '''
+        Make Farsite_Weather and Farsite_Wind datasheet rows for every day in the range, with the day of the month as the
+        weather's MinTemp and the wind's Speed, so the records can be told apart.
+    '''
+    weather_rows = []
+    wind_rows = []
+    date = first_date
+    while date <= last_date:
+        values = {'Year': str(date.year), 'Month': str(date.month), 'Day': str(date.day)}
+        weather = dict(values, Precipitation='0', MinTempHour='5', MaxTempHour='15', MinTemp=str(date.day),
+                       MaxTemp='80', MaxHumidity='60', MinHumidity='20', Elevation='1000')
+        weather_rows.append(weather)
+        for hour in WIND_HOURS:
+            wind_rows.append(dict(values, Hour=str(hour), Speed=str(date.day), Direction='270', CloudCover='0'))
+        date += datetime.timedelta(days=1)
+
+    return weather_rows, wind_rows
+
+
+def getRecordDays(section):
+    '''
+        :return: The ( month, day) of each record of a formatted WEATHER_DATA or WIND_DATA section
+    '''
+    lines = section.splitlines()
+    num_records = int(lines[0].split(':')[1])
+    return [tuple(int(value) for value in line.split()[:2]) for line in lines[1:num_records + 1]]
+
+
+class TestWeatherWindow(unittest.TestCase):
+    '''
+        The records written for a fire cover it plus a day either side, without running into the years either side of
+        the fire's year.
+    '''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        filename = os.path.join(self.temp_dir, 'weather.npz')
+        weather_rows, wind_rows = makeRows(datetime.date(2015, 12, 20), datetime.date(2017, 1, 10))
+        saveWeatherStreams(filename, weather_rows, wind_rows)
+        self.streams = WeatherStreams(filename)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
+    def assertWindow(self, start_datetime, end_datetime, expected_days):
+        self.assertEqual(getRecordDays(self.streams.formatWeather(start_datetime, end_datetime)), expected_days)
+        self.assertEqual(getRecordDays(self.streams.formatWind(start_datetime, end_datetime)),
+                         [day for day in expected_days for hour in WIND_HOURS])
+
+
+    def testBuffer(self):
+        self.assertWindow(datetime.datetime(2016, 6, 10, 12), datetime.datetime(2016, 6, 11, 6),
+                          [(6, 9), (6, 10), (6, 11), (6, 12)])
+
+
+    def testYearStart(self):
+        self.assertWindow(datetime.datetime(2016, 1, 1, 8), datetime.datetime(2016, 1, 2, 8),
+                          [(1, 1), (1, 2), (1, 3)])
+
+
+    def testYearEnd(self):
+        self.assertWindow(datetime.datetime(2016, 12, 30, 8), datetime.datetime(2016, 12, 31, 23, 59, 59),
+                          [(12, 29), (12, 30), (12, 31)])
+
+
+    def testLeapDay(self):
+        self.assertWindow(datetime.datetime(2016, 2, 29, 8), datetime.datetime(2016, 2, 29, 20),
+                          [(2, 28), (2, 29), (3, 1)])
+        self.assertWindow(datetime.datetime(2016, 2, 27, 8), datetime.datetime(2016, 2, 28, 20),
+                          [(2, 26), (2, 27), (2, 28), (2, 29)])
+
+
+if __name__ == '__main__':
+    unittest.main()